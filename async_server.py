@@ -0,0 +1,409 @@
+import asyncio
+import contextvars
+import time
+from mmp_protocol import (MMPMessage, JobOperation, MonitoringOperation, ConnectionOperation, HEADER_SIZE, read_exact_async,
+                          ChecksumError)
+from storage_manager import current_workspace
+from job_scheduler import AsyncJobScheduler, QueueFullError, job_priority
+from server import VideoProcessingServer, INTERMEDIATE_STATUSES, _response_flags
+from upload_manager import UploadError
+
+class AsyncVideoProcessingServer(VideoProcessingServer):
+    # 1つのイベントループで全接続を扱うサーバー。接続ごとのスレッドを作らないため、
+    # アップロード待ちの接続が多くてもメモリ・スレッド数が増えない
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+
+    def _create_scheduler(self, max_workers, max_queue_size):
+        return AsyncJobScheduler(max_workers=max_workers, max_queue_size=max_queue_size, metrics=self.metrics)
+
+    async def _run_blocking(self, func, *args):
+        # ロック待ちやハッシュ計算などのブロッキング処理はスレッドプールで実行する。
+        # 処理時間をリクエストのトレースに記録できるよう、コンテキストを引き継ぐ
+        return await self.loop.run_in_executor(None, contextvars.copy_context().run, func, *args)
+
+    async def _run_blocking_with_context(self, func, *args):
+        # func が設定したコンテキスト変数 (確保したワークスペースなど) を、このタスクのコンテキストにも反映する
+        context = contextvars.copy_context()
+        result = await self.loop.run_in_executor(None, context.run, func, *args)
+        for var, value in context.items():
+            var.set(value)
+        return result
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = writer.get_extra_info('peername')
+        client_ip = address[0]
+        message = None
+        trace = self.metrics.start_trace(client_ip)
+        try:
+            message = await self._receive_message(reader, writer)
+            if not message:
+                return
+
+            if message.json_data.get('operation') == ConnectionOperation.MULTIPLEX.value:
+                # ストリームの処理はスレッドで行う実装のため、このモードでは1接続1リクエストのみ扱う
+                trace.request = message.json_data['operation']
+                await self._send_error(writer, 400, "Multiplexing not supported",
+                                       "Open a new connection for each request")
+                return
+
+            # 重複確認・アップロード再開の問い合わせに応答した後、同じ接続で本来のリクエストを受け取る
+            while message.json_data.get('operation') in self.transfer_operations:
+                response = await self._run_blocking(self._transfer_operation_response, message)
+                await self._send_message(writer, response)
+                message = await self._receive_message(reader, writer)
+                if not message:
+                    return
+
+            operation = message.json_data.get('operation')
+            trace.request = self._trace_request(message)
+            if operation in self.worker_operations:
+                await self._send_message(writer, self._worker_operation_response(message, client_ip))
+                return
+            if operation == MonitoringOperation.STATS.value:
+                # 一時ファイルの合計サイズの取得はディスクを走査するため、スレッドプールで実行する
+                await self._send_message(writer, await self._run_blocking(self._stats_response, message))
+                return
+            if operation == JobOperation.JOB_STATUS.value:
+                await self._send_message(writer, self._job_status_response(message))
+                return
+            if operation == JobOperation.FETCH_RESULT.value:
+                response, job = self._job_result_response(message)
+                if await self._send_message(writer, response) and job:
+                    self.job_store.remove(job.job_id)
+                return
+
+            if not self._can_process_request(client_ip):
+                await self._send_error(writer, 429, "Too many requests", "Please wait for your current process to complete")
+                return
+
+            if operation == JobOperation.SUBMIT_JOB.value:
+                await self._submit_job(writer, message, client_ip)
+                return
+
+            self._hold_client_slot(client_ip)
+            try:
+                await self._process_request(writer, message)
+            finally:
+                self._release_client_slot()
+
+        except Exception as e:
+            print(f"Error handling client {address}: {e}")
+            await self._send_error(writer, 500, "Internal server error", str(e))
+        finally:
+            if message and message.payload_path:
+                self.video_processor.cleanup_temp_file(message.payload_path)
+            writer.close()
+            # ワークスペースの削除 (rmtree) もイベントループを止めないようにする
+            await self._run_blocking(self._release_workspace)
+            self.metrics.finish_trace(trace)
+
+    async def _receive_message(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> MMPMessage:
+        try:
+            header_bytes = await read_exact_async(reader, HEADER_SIZE)
+        except Exception as e:
+            print(f"Error receiving message: {e}")
+            return None
+        start = time.perf_counter()
+        message = await self._read_message(reader, writer, header_bytes)
+        if message:
+            self._observe_receive(header_bytes, start)
+        return message
+
+    async def _read_message(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                            header_bytes: bytes) -> MMPMessage:
+        try:
+            message, _ = await MMPMessage.decode_body_from_stream(reader, header_bytes)
+            _response_flags.set(message.flags)
+            # 空き容量の計算はディレクトリを走査するため、スレッドプールで実行する
+            error = await self._run_blocking_with_context(self._reserve_workspace, message)
+            if error:
+                async for _ in message.iter_payload_from_stream(reader, self.chunk_size):
+                    pass
+                await self._send_message(writer, error)
+                return None
+            if 'upload_offset' in message.json_data:
+                return await self._receive_resumable_upload(reader, message)
+
+            payload_path = self._generate_temp_path(message.media_type) if message.payload_size > 0 else None
+            await message.read_payload_from_stream(reader, payload_path, chunk_size=self.chunk_size,
+                                                   hash_algorithm='sha256')
+            if message.payload_size == 0 and message.json_data.get('content_hash'):
+                # 保持の確認ではキャッシュのファイルを読むため、スレッドプールで実行する
+                if await self._run_blocking(self._verify_content_proof, message):
+                    message.payload_hash = message.json_data['content_hash']
+            return message
+        except UploadError as e:
+            await self._send_error(writer, 409, "Upload error", str(e))
+            return None
+        except ChecksumError as e:
+            print(f"Corrupt upload: {e}")
+            await self._send_message(writer, self._corrupt_transfer_response(e))
+            return None
+        except Exception as e:
+            print(f"Error receiving message: {e}")
+            return None
+
+    async def _receive_resumable_upload(self, reader: asyncio.StreamReader, message: MMPMessage) -> MMPMessage:
+        upload_id = message.json_data['upload_id']
+        offset = int(message.json_data.get('upload_offset', 0))
+        part_path = await self._run_blocking(self.upload_manager.begin_receive, upload_id, offset,
+                                             message.payload_size)
+        try:
+            await message.read_payload_from_stream(reader, part_path, chunk_size=self.chunk_size,
+                                                   payload_offset=offset)
+        finally:
+            self.upload_manager.end_receive(upload_id)
+        return await self._run_blocking(self._finalize_resumable_upload, message)
+
+    async def _process_request(self, writer: asyncio.StreamWriter, message: MMPMessage):
+        if 'operations' in message.json_data:
+            await self._process_pipeline_request(writer, message)
+            return
+
+        error = self._process_type_error(message)
+        if error:
+            await self._send_message(writer, error)
+            return
+        process_type = message.json_data['process_type']
+
+        cache_key = self._result_cache_key(process_type, message)
+        # キャッシュからのリンク・コピーはファイル操作のため、スレッドプールで実行する
+        output_file = await self._run_blocking(self._get_cached_result, cache_key)
+        if output_file:
+            try:
+                await self._send_message(writer, self._processed_file_response(output_file))
+            finally:
+                self.video_processor.cleanup_temp_file(output_file)
+            return
+
+        input_file = await self._run_blocking(self._save_temp_file, message)
+        if not input_file:
+            await self._send_message(writer, self._content_unavailable_response())
+            return
+        try:
+            error = await self._run_blocking(self._input_error, input_file, [message.json_data])
+            if error:
+                await self._send_message(writer, error)
+                return
+
+            # 進捗フレームは書き込みバッファに積むだけで、送信はイベントループに任せる
+            progress_callback = None
+            if message.json_data.get('report_progress'):
+                progress_callback = lambda progress: self._write_message_nowait(writer, self._progress_message(progress))
+
+            try:
+                future = self.scheduler.submit(
+                    lambda threads: self._run_processing(
+                        process_type, input_file, message.json_data, cache_key, threads, progress_callback),
+                    priority=job_priority(process_type, message.json_data)
+                )
+            except QueueFullError:
+                await self._send_message(writer, self._busy_response())
+                return
+
+            success, msg, output_file = await future
+            if success and output_file:
+                await self._send_message(writer, self._processed_file_response(output_file))
+            else:
+                await self._send_error(writer, 500, "Processing failed", msg)
+        finally:
+            self.video_processor.cleanup_temp_file(input_file)
+            if output_file:
+                self.video_processor.cleanup_temp_file(output_file)
+
+    async def _run_processing(self, process_type: str, input_file: str, params: dict, key: str,
+                              threads: int, progress_callback=None):
+        if self.worker_pool:
+            # ワーカーへの割り当てはブロッキング処理のため、スレッドプールで実行する
+            callback = None
+            if progress_callback:
+                callback = lambda progress: self.loop.call_soon_threadsafe(progress_callback, progress)
+            success, msg, output_file = await self._run_blocking(
+                self.worker_pool.process, process_type, input_file, params, threads, callback)
+        else:
+            success, msg, output_file = await self.video_processor.process_async(
+                process_type, input_file, params, threads, progress_callback)
+        if success and output_file and key:
+            await self._run_blocking(self.result_cache.put, key, output_file)
+        return success, msg, output_file
+
+    async def _process_pipeline_request(self, writer: asyncio.StreamWriter, message: MMPMessage):
+        error = self._pipeline_error(message)
+        if error:
+            await self._send_message(writer, error)
+            return
+        operations = message.json_data['operations']
+
+        keys = [self._result_cache_key(operation['process_type'], message, operation) for operation in operations]
+        output_files = [await self._run_blocking(self._get_cached_result, key) for key in keys]
+        pending = [i for i, output_file in enumerate(output_files) if not output_file]
+        input_file = None
+        try:
+            if pending:
+                input_file = await self._run_blocking(self._save_temp_file, message)
+                if not input_file:
+                    await self._send_message(writer, self._content_unavailable_response())
+                    return
+                error = await self._run_blocking(self._input_error, input_file, [operations[i] for i in pending])
+                if error:
+                    await self._send_message(writer, error)
+                    return
+
+                progress_callback = None
+                if message.json_data.get('report_progress'):
+                    progress_callback = lambda progress: self._write_message_nowait(writer, self._progress_message(progress))
+                try:
+                    future = self.scheduler.submit(
+                        lambda threads: self._run_pipeline(
+                            input_file, [operations[i] for i in pending], [keys[i] for i in pending],
+                            threads, progress_callback),
+                        priority=self._pipeline_priority(operations)
+                    )
+                except QueueFullError:
+                    await self._send_message(writer, self._busy_response())
+                    return
+
+                success, msg, processed_files = await future
+                if not success:
+                    await self._send_error(writer, 500, "Processing failed", msg)
+                    return
+                for i, output_file in zip(pending, processed_files):
+                    output_files[i] = output_file
+
+            for index, output_file in enumerate(output_files):
+                if not await self._send_message(writer, self._pipeline_part_message(index, operations[index], output_file)):
+                    return
+            await self._send_message(writer, self._pipeline_complete_message(operations))
+        finally:
+            if input_file:
+                self.video_processor.cleanup_temp_file(input_file)
+            for output_file in output_files:
+                if output_file:
+                    self.video_processor.cleanup_temp_file(output_file)
+
+    async def _run_pipeline(self, input_file: str, operations: list, keys: list, threads: int, progress_callback=None):
+        if self.worker_pool:
+            # コーディネーターでは WorkerPool の上限の範囲で実行する (空きを待つためスレッドプールで実行する)
+            callback = None
+            if progress_callback:
+                callback = lambda progress: self.loop.call_soon_threadsafe(progress_callback, progress)
+            success, msg, output_files = await self._run_blocking(
+                self.worker_pool.run_locally, lambda local_threads: self.video_processor.process_pipeline(
+                    input_file, operations, local_threads, callback))
+        else:
+            success, msg, output_files = await self.video_processor.process_pipeline_async(
+                input_file, operations, threads, progress_callback)
+        await self._run_blocking(self._cache_pipeline_results, keys, output_files)
+        return success, msg, output_files
+
+    async def _submit_job(self, writer: asyncio.StreamWriter, message: MMPMessage, client_ip: str):
+        error = self._process_type_error(message)
+        if error:
+            await self._send_message(writer, error)
+            return
+        process_type = message.json_data['process_type']
+
+        stored_job = self.job_store.create(process_type, client_ip, current_workspace())
+        cache_key = self._result_cache_key(process_type, message)
+        cached_output = await self._run_blocking(self._get_cached_result, cache_key)
+        if cached_output:
+            self.job_store.complete(stored_job.job_id, True, "Success (cached)", cached_output)
+            await self._send_message(writer, self._accepted_message(stored_job))
+            return
+
+        input_file = await self._run_blocking(self._save_temp_file, message)
+        if not input_file:
+            self.job_store.remove(stored_job.job_id)
+            await self._send_message(writer, self._content_unavailable_response())
+            return
+        error = await self._run_blocking(self._input_error, input_file, [message.json_data])
+        if error:
+            self.job_store.remove(stored_job.job_id)
+            self.video_processor.cleanup_temp_file(input_file)
+            await self._send_message(writer, error)
+            return
+
+        async def run(threads):
+            self.job_store.mark_running(stored_job.job_id)
+            try:
+                success, msg, output_file = await self._run_processing(
+                    process_type, input_file, message.json_data, cache_key, threads,
+                    lambda progress: self.job_store.update_progress(stored_job.job_id, progress))
+                self.job_store.complete(stored_job.job_id, success, msg, output_file)
+            except Exception as e:
+                self.job_store.complete(stored_job.job_id, False, str(e), None)
+            finally:
+                self.video_processor.cleanup_temp_file(input_file)
+                self._remove_client_process(client_ip)
+
+        self._add_client_process(client_ip)
+        try:
+            self.scheduler.submit(run, priority=job_priority(process_type, message.json_data))
+        except QueueFullError:
+            self._remove_client_process(client_ip)
+            self.job_store.remove(stored_job.job_id)
+            await self._send_message(writer, self._busy_response())
+            return
+
+        message.payload_path = None
+        await self._send_message(writer, self._accepted_message(stored_job))
+
+    def _write_message_nowait(self, writer: asyncio.StreamWriter, message: MMPMessage):
+        # JSON のみのメッセージ用。スレッド版の _send_message と同じく、リクエストの転送フラグを付ける
+        message.flags |= _response_flags.get()
+        header_bytes, body_bytes = message._encode_header_and_body()
+        writer.write(header_bytes + body_bytes)
+
+    async def _send_error(self, writer: asyncio.StreamWriter, code: int, description: str, solution: str):
+        await self._send_message(writer, MMPMessage.create_error_message(code, description, solution))
+
+    async def _send_message(self, writer: asyncio.StreamWriter, message: MMPMessage) -> bool:
+        start = time.perf_counter()
+        message.flags |= _response_flags.get()
+        if message.json_data.get('status') not in INTERMEDIATE_STATUSES:
+            self._release_client_slot()
+        try:
+            await message.encode_to_stream(writer, chunk_size=self.chunk_size)
+        except Exception as e:
+            print(f"Error sending message: {e}")
+            self._observe_send(message, None)
+            return False
+        self._observe_send(message, start)
+        return True
+
+    async def _expire_jobs_loop(self):
+        while self.running:
+            await asyncio.sleep(self.expire_interval)
+            for job_id in self.job_store.expire():
+                print(f"Expired unfetched result of job {job_id}")
+            for upload_id in await self._run_blocking(self.upload_manager.expire):
+                print(f"Expired incomplete upload {upload_id}")
+            if self.worker_pool:
+                for worker_id in self.worker_pool.expire():
+                    print(f"Removed unresponsive worker {worker_id}")
+            for path in await self._run_blocking(self.storage.collect_orphans):
+                print(f"Removed orphaned temp file {path}")
+
+    async def serve(self):
+        self.loop = asyncio.get_event_loop()
+        self.scheduler.start()
+        self.server_socket = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.running = True
+        print(f"Server started on {self.host}:{self.port} (async)")
+        self._start_metrics_endpoint()
+        expire_task = asyncio.ensure_future(self._expire_jobs_loop())
+        try:
+            await self.server_socket.serve_forever()
+        finally:
+            expire_task.cancel()
+
+    def start(self):
+        asyncio.run(self.serve())
+
+    def stop(self):
+        self.running = False
+        if self.server_socket:
+            self.server_socket.close()
+        self.scheduler.shutdown()
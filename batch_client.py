@@ -0,0 +1,333 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+from mmp_protocol import MMPMessage, VideoProcessType, MediaType, JobOperation, ChecksumError
+from client import VideoProcessingClient, _action_operation
+
+# ディレクトリ内の全ての動画、または JSON Lines のマニフェストに記載された動画を、
+# 1台以上のサーバーで並行して処理する
+
+# 処理タイプごとの出力のメディアタイプ (出力が最新かどうかの確認に使う)
+OUTPUT_MEDIA_TYPES = {
+    VideoProcessType.COMPRESS: MediaType.MP4,
+    VideoProcessType.RESIZE_RESOLUTION: MediaType.MP4,
+    VideoProcessType.CHANGE_ASPECT_RATIO: MediaType.MP4,
+    VideoProcessType.EXTRACT_AUDIO: MediaType.MP3,
+    VideoProcessType.CREATE_GIF: MediaType.GIF,
+    VideoProcessType.CREATE_WEBM: MediaType.WEBM,
+}
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+OUTPUT_NAME_PATTERN = re.compile(r'_processed(_\d+)?$')  # 以前の実行の出力は入力として扱わない
+RETRYABLE_ERROR_CODES = [429, 507]  # 処理枠・待ち行列・容量が空けば成功するエラー
+DEFAULT_RETRIES = 5
+DEFAULT_RETRY_INTERVAL = 5  # 再試行までの待機時間 (秒)。再試行のたびに2倍にする
+MAX_RETRY_INTERVAL = 300
+# サーバーは1つのIPアドレスから同時に1つの処理のみ受け付けるため、サーバーごとの同時リクエスト数の既定値は1
+DEFAULT_REQUESTS_PER_SERVER = 1
+
+class BatchItem:
+    def __init__(self, file_path: str, operations: List[Tuple[VideoProcessType, Dict[str, Any]]]):
+        self.file_path = file_path
+        self.operations = operations
+
+class BatchServer:
+    def __init__(self, client: VideoProcessingClient, max_active: int):
+        self.client = client
+        self.max_active = max_active
+        self.active = 0
+        self.busy_until = 0.0  # エラーを返したサーバーには、この時刻まで次のリクエストを送らない
+        self.completed = 0
+
+    @property
+    def label(self) -> str:
+        return f"{self.client.host}:{self.client.port}"
+
+class BatchStats:
+    def __init__(self, total: int):
+        self.total = total
+        self.processed = 0
+        self.skipped = 0
+        self.retries = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.failures: List[Tuple[str, str]] = []  # (ファイル, エラー)
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    def print_summary(self, servers: List[BatchServer]):
+        elapsed = max(self.elapsed, 1e-6)
+        mb = 1024 * 1024
+        print(f"\nBatch complete in {self.elapsed:.1f}s: {self.processed} processed, {self.skipped} up to date, "
+              f"{len(self.failures)} failed, {self.retries} retries")
+        print(f"Throughput: {self.processed / elapsed * 60:.2f} files/min, "
+              f"input {self.input_bytes / mb:.1f} MB ({self.input_bytes / mb / elapsed:.2f} MB/s), "
+              f"output {self.output_bytes / mb:.1f} MB")
+        for server in servers:
+            print(f"  {server.label}: {server.completed} files")
+        if self.failures:
+            print("Failed files:")
+            for file_path, error in self.failures:
+                print(f"  {file_path}: {error}")
+
+def parse_server(value: str) -> Tuple[str, int]:
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f"Invalid server address: {value} (expected HOST:PORT)")
+    return host, int(port)
+
+def items_from_directory(directory: str, operations: List[Tuple[VideoProcessType, Dict[str, Any]]],
+                         output_dir: Optional[str] = None) -> List[BatchItem]:
+    items = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs
+                         if not output_dir or os.path.abspath(os.path.join(root, d)) != os.path.abspath(output_dir))
+        for name in sorted(files):
+            stem, extension = os.path.splitext(name)
+            if extension.lower() in VIDEO_EXTENSIONS and not OUTPUT_NAME_PATTERN.search(stem):
+                items.append(BatchItem(os.path.join(root, name), operations))
+    return items
+
+def items_from_manifest(path: str, defaults) -> List[BatchItem]:
+    # 1行に1つの JSON オブジェクト ({"file": ..., "action": "resize", "width": 1280, "height": 720} など)。
+    # "action" は複数の処理のリストでもよく、省略したパラメータはコマンドライン引数の値を使う
+    items = []
+    base_dir = os.path.dirname(os.path.abspath(path))
+    listed: Dict[str, int] = {}  # 入力ファイル -> 記載された行番号
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                file_path = entry['file']
+            except (ValueError, KeyError, TypeError):
+                print(f"Error: Invalid manifest entry on line {line_number}")
+                continue
+            actions = entry.get('action') or defaults.action or []
+            if isinstance(actions, str):
+                actions = [actions]
+            args = SimpleNamespace(**{**vars(defaults), **entry})
+            operations = [_action_operation(args, action) for action in actions]
+            if not operations or not all(operations):
+                print(f"Error: Invalid or missing action on line {line_number}")
+                continue
+            # 出力のパスは入力ファイルから決まるため、同じファイルを複数の行に書くと出力が上書きされる
+            input_path = os.path.normpath(os.path.join(base_dir, file_path))
+            if input_path in listed:
+                print(f"Error: {file_path} on line {line_number} is already listed on line {listed[input_path]} "
+                      f"(list all of its actions in one entry)")
+                continue
+            listed[input_path] = line_number
+            items.append(BatchItem(input_path, operations))
+    return items
+
+class BatchRunner:
+    def __init__(self, clients: List[VideoProcessingClient], concurrency: Optional[int] = None,
+                 retries: int = DEFAULT_RETRIES, retry_interval: float = DEFAULT_RETRY_INTERVAL,
+                 force: bool = False, requests_per_server: int = DEFAULT_REQUESTS_PER_SERVER):
+        self.servers = [BatchServer(client, requests_per_server) for client in clients]
+        # 既定では全てのサーバーの処理枠を埋める数だけ並行してアップロードする。
+        # それ以上のファイルを同時に処理しても、空いているサーバーを待つだけになる
+        capacity = requests_per_server * len(self.servers)
+        if concurrency and concurrency > capacity:
+            print(f"Concurrency limited to {capacity} ({requests_per_server} request(s) per server, "
+                  f"see --per-server)")
+            concurrency = capacity
+        self.concurrency = concurrency or capacity
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.force = force  # 出力が最新でも処理し直す
+        self._condition = threading.Condition()
+        for client in clients:
+            client.quiet = True
+
+    def output_paths(self, item: BatchItem) -> List[str]:
+        client = self.servers[0].client
+        if len(item.operations) == 1:
+            return [client._generate_output_path(item.file_path, OUTPUT_MEDIA_TYPES[item.operations[0][0]].value)]
+        return [client._generate_output_path(item.file_path, OUTPUT_MEDIA_TYPES[process_type].value, index)
+                for index, (process_type, _) in enumerate(item.operations)]
+
+    def is_up_to_date(self, item: BatchItem) -> bool:
+        # 全ての出力が入力より新しければ処理しない
+        input_mtime = os.path.getmtime(item.file_path)
+        return all(os.path.exists(path) and os.path.getmtime(path) >= input_mtime for path in self.output_paths(item))
+
+    def run(self, items: List[BatchItem]) -> BatchStats:
+        stats = BatchStats(len(items))
+        pending: queue.Queue = queue.Queue()
+        for item in items:
+            if not self.force and os.path.exists(item.file_path) and self.is_up_to_date(item):
+                stats.skipped += 1
+            else:
+                pending.put(item)
+
+        threads = [threading.Thread(target=self._worker, args=(pending, stats), daemon=True)
+                   for _ in range(min(self.concurrency, pending.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats.elapsed = time.time() - stats.started
+        return stats
+
+    def _worker(self, pending: queue.Queue, stats: BatchStats):
+        while True:
+            try:
+                item = pending.get_nowait()
+            except queue.Empty:
+                return
+            self._process(item, stats)
+
+    def _process(self, item: BatchItem, stats: BatchStats):
+        name = os.path.basename(item.file_path)
+        if not self.servers[0].client._validate_file(item.file_path):
+            self._record(stats, item, "Invalid input file")
+            return
+
+        start = time.time()
+        for attempt in range(self.retries + 1):
+            server = self._acquire_server()
+            retryable, delay = False, 0.0
+            try:
+                response, outputs = self._request(server.client, item)
+                if "error_code" in response.json_data:
+                    error = f"{response.json_data['description']} ({response.json_data['error_code']})"
+                    retryable = response.json_data['error_code'] in RETRYABLE_ERROR_CODES
+                elif not outputs:
+                    error = "Invalid response from server"
+                else:
+                    error = None
+            except OSError as e:
+                # 接続できない・接続が切れたサーバーはしばらく使わず、他のサーバーで再試行する
+                error, retryable = f"Connection error: {e}", True
+            except ChecksumError as e:
+                error, retryable = f"Corrupt transfer: {e}", True
+            except Exception as e:
+                error = str(e)
+            if error and retryable and attempt < self.retries:
+                delay = min(self.retry_interval * 2 ** attempt, MAX_RETRY_INTERVAL)
+            self._release_server(server, delay, completed=not error)
+
+            if not error:
+                self._record(stats, item, None, outputs, time.time() - start)
+                return
+            if not delay:
+                self._record(stats, item, error)
+                return
+            with self._condition:
+                stats.retries += 1
+            print(f"Retrying {name} ({server.label}: {error}, pausing this server for {delay:.0f}s)")
+
+    def _record(self, stats: BatchStats, item: BatchItem, error: Optional[str],
+                outputs: Optional[List[str]] = None, seconds: float = 0.0):
+        with self._condition:
+            if error:
+                stats.failures.append((item.file_path, error))
+            else:
+                stats.processed += 1
+                stats.input_bytes += os.path.getsize(item.file_path)
+                stats.output_bytes += sum(os.path.getsize(path) for path in outputs)
+            prefix = f"[{stats.processed + len(stats.failures)}/{stats.total - stats.skipped}]"
+        if error:
+            print(f"{prefix} Failed {item.file_path}: {error}")
+        else:
+            print(f"{prefix} {item.file_path} -> {', '.join(outputs)} ({seconds:.1f}s)")
+
+    def _acquire_server(self) -> BatchServer:
+        # 処理枠が空いているサーバーのうち、処理した数が最も少ないものを使う
+        with self._condition:
+            while True:
+                now = time.time()
+                free = [s for s in self.servers if s.active < s.max_active]
+                ready = [s for s in free if s.busy_until <= now]
+                if ready:
+                    server = min(ready, key=lambda s: (s.active, s.completed))
+                    server.active += 1
+                    return server
+                timeout = min(s.busy_until for s in free) - now if free else None
+                self._condition.wait(timeout)
+
+    def _release_server(self, server: BatchServer, delay: float, completed: bool):
+        with self._condition:
+            server.active -= 1
+            server.busy_until = max(server.busy_until, time.time() + delay)
+            if completed:
+                server.completed += 1
+            self._condition.notify_all()
+
+    def _request(self, client: VideoProcessingClient, item: BatchItem) -> Tuple[MMPMessage, List[str]]:
+        if len(item.operations) > 1:
+            response = client._exchange(client._create_pipeline_request(item.file_path, item.operations),
+                                        item.file_path)
+            return response, [part.payload_path for part in response.parts]
+
+        process_type, params = item.operations[0]
+        if client.async_jobs:
+            submitted = client._exchange(
+                client._create_request(item.file_path, process_type, params, operation=JobOperation.SUBMIT_JOB))
+            if "error_code" in submitted.json_data:
+                return submitted, []
+            response = self._wait_for_job(client, submitted.json_data['job_id'], item.file_path)
+        else:
+            response = client._exchange(client._create_request(item.file_path, process_type, params), item.file_path)
+        return response, [response.payload_path] if response.payload_path else []
+
+    def _wait_for_job(self, client: VideoProcessingClient, job_id: str, file_path: str) -> MMPMessage:
+        # ジョブはサーバーで処理が続いているため、状態確認中の接続エラーでは再投入しない
+        while True:
+            try:
+                status = client._exchange(
+                    MMPMessage({"operation": JobOperation.JOB_STATUS.value, "job_id": job_id}, MediaType.JSON.value))
+                if "error_code" in status.json_data:
+                    return status
+                if status.json_data['job_status'] in ('done', 'failed'):
+                    return client._exchange(
+                        MMPMessage({"operation": JobOperation.FETCH_RESULT.value, "job_id": job_id},
+                                   MediaType.JSON.value), file_path)
+            except OSError as e:
+                print(f"Connection error while waiting for job {job_id} ({e})")
+            time.sleep(client.status_check_interval)
+
+def run_batch(args) -> Optional[BatchStats]:
+    # client.py のコマンドライン引数で、入力にディレクトリまたは .jsonl のマニフェストが指定された場合に呼ばれる
+    if os.path.isdir(args.file):
+        operations = [_action_operation(args, action) for action in args.action or []]
+        if not operations or not all(operations):
+            print("Error: --action is required when processing a directory")
+            return None
+        items = items_from_directory(args.file, operations, args.output_dir)
+    else:
+        items = items_from_manifest(args.file, args)
+
+    try:
+        addresses = [parse_server(value) for value in args.server] if args.server else [(args.host, args.port)]
+    except ValueError as e:
+        print(f"Error: {e}")
+        return None
+    clients = []
+    for host, port in addresses:
+        client = VideoProcessingClient(host=host, port=port, chunk_size=args.chunk_size,
+                                       async_jobs=args.async_jobs, dedup=args.dedup, resumable=args.resumable,
+                                       stream=args.stream, parallel_segments=args.segments, profile=args.profile,
+                                       multiplex=args.multiplex, output_dir=args.output_dir,
+                                       checksum=args.checksum, compress=args.compress)
+        client.status_check_interval = args.status_interval
+        clients.append(client)
+
+    runner = BatchRunner(clients, concurrency=args.concurrency, retries=args.retries, force=args.force,
+                         requests_per_server=args.per_server)
+    print(f"Processing {len(items)} files on {len(clients)} server(s)")
+    try:
+        stats = runner.run(items)
+    finally:
+        for client in clients:
+            client.close()
+    stats.print_summary(runner.servers)
+    return stats
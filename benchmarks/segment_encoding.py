@@ -0,0 +1,78 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from video_processor import VideoProcessor
+
+# 1つの FFmpeg プロセスでのエンコードと、区間に分割した並列エンコードの処理時間を比較する
+
+def create_test_video(path: str, duration: int, size: str, gop: int):
+    # テストパターン映像とサイン波の音声から合成した動画を作る
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate=30',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100',
+        '-t', str(duration),
+        '-c:v', 'libx264', '-g', str(gop), '-c:a', 'aac', '-shortest',
+        path
+    ], check=True)
+
+def measure(processor: VideoProcessor, process_type: str, input_file: str, params: dict, threads: int) -> float:
+    start = time.perf_counter()
+    success, message, output_file = processor.process(process_type, input_file, params, threads)
+    elapsed = time.perf_counter() - start
+    if not success:
+        raise RuntimeError(message)
+    processor.cleanup_temp_file(output_file)
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark segment-parallel encoding against a single FFmpeg process')
+    parser.add_argument('--input', help='Video to encode (default: a generated test video)')
+    parser.add_argument('--duration', type=int, default=60, help='Length of the generated test video in seconds')
+    parser.add_argument('--size', default='1280x720', help='Resolution of the generated test video')
+    parser.add_argument('--gop', type=int, default=60, help='Keyframe interval of the generated test video in frames')
+    parser.add_argument('--segments', type=int, default=os.cpu_count() or 1, help='Number of parallel segments')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1, help='FFmpeg threads for each run')
+    parser.add_argument('--action', choices=['compress', 'resize'], default='compress')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per mode (the fastest is reported)')
+    parser.add_argument('--json', action='store_true', help='Print the result as JSON')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        input_file = args.input
+        if not input_file:
+            input_file = os.path.join(work_dir, 'input.mp4')
+            create_test_video(input_file, args.duration, args.size, args.gop)
+
+        processor = VideoProcessor(os.path.join(work_dir, 'tmp'))
+        process_type = 'compress' if args.action == 'compress' else 'resize_resolution'
+        params = {} if args.action == 'compress' else {'width': 640, 'height': 360}
+
+        single = min(measure(processor, process_type, input_file, params, args.threads) for _ in range(args.repeat))
+        segmented_params = {**params, 'parallel_segments': args.segments}
+        segmented = min(measure(processor, process_type, input_file, segmented_params, args.threads)
+                        for _ in range(args.repeat))
+
+    result = {
+        "action": args.action,
+        "threads": args.threads,
+        "segments": args.segments,
+        "single_seconds": round(single, 3),
+        "segmented_seconds": round(segmented, 3),
+        "speedup": round(single / segmented, 2),
+    }
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(f"{'Single process:':<20}{single:.2f}s")
+        print(f"{f'{args.segments} segments:':<20}{segmented:.2f}s")
+        print(f"{'Speedup:':<20}{result['speedup']:.2f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+from mmp_protocol import MMPMessage, VideoProcessType, HEADER_SIZE, DEFAULT_CHUNK_SIZE, recv_exact
+
+# ローカルで起動したサーバーに対して、プロトコルの処理速度・アップロード速度・処理ごとの所要時間・
+# 同時接続数を増やした場合のスループットを計測し、リリース間で比較できるよう JSON で出力する
+
+TARGET_PACKETS_PER_SECOND = 5000  # README の目標 (1,400 バイトのパケットを毎秒 5,000 個)
+PACKET_SIZE = 1400
+LARGE_PAYLOAD_MB = 64
+SERVER_START_TIMEOUT = 15
+
+# 処理タイプごとのリクエストのパラメータ
+OPERATION_PARAMS = {
+    VideoProcessType.COMPRESS.value: {},
+    VideoProcessType.RESIZE_RESOLUTION.value: {"width": 320, "height": 180},
+    VideoProcessType.CHANGE_ASPECT_RATIO.value: {"aspect_ratio": "16:9"},
+    VideoProcessType.EXTRACT_AUDIO.value: {},
+    VideoProcessType.CREATE_GIF.value: {"start_time": "00:00:01", "duration": "00:00:03"},
+    VideoProcessType.CREATE_WEBM.value: {"start_time": "00:00:01", "duration": "00:00:03"},
+}
+
+def create_test_video(path: str, duration: int, size: str):
+    # テストパターン映像とサイン波の音声から合成した動画を作る
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc=size={size}:rate=30',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100',
+        '-t', str(duration),
+        '-c:v', 'libx264', '-c:a', 'aac', '-shortest',
+        path
+    ], check=True)
+
+def create_random_file(path: str, size: int):
+    with open(path, 'wb') as f:
+        block = os.urandom(1024 * 1024)
+        for offset in range(0, size, len(block)):
+            f.write(block[:size - offset])
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    return {
+        "runs": len(ordered),
+        "min": round(ordered[0], 4),
+        "median": round(statistics.median(ordered), 4),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+        "max": round(ordered[-1], 4),
+    }
+
+def peak_rss_mb(pid: Optional[int] = None) -> Optional[float]:
+    # 自プロセスは getrusage、サーバーは /proc/<pid>/status の VmHWM (Linux のみ) から取得する
+    if pid is None:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS はバイト、Linux は KB 単位
+        return round(max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+def loopback_source_ips(count: int) -> List[Optional[str]]:
+    # サーバーは IP アドレスごとに同時に1つの処理しか受け付けないため、
+    # 同時接続の計測では 127.0.0.2 以降の送信元アドレスを使う (使えない環境では 127.0.0.1 のみ)
+    try:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.2', 0))
+    except OSError:
+        return [None] * count
+    return [f'127.0.0.{i + 2}' for i in range(count)]
+
+class LocalServer:
+    # 作業ディレクトリでサーバーを別プロセスとして起動する (メモリ使用量をクライアントと分けて計測するため)
+    def __init__(self, work_dir: str, mode: str, workers: Optional[int]):
+        self.work_dir = work_dir
+        self.port = free_port()
+        command = [sys.executable, os.path.join(REPO_DIR, 'server.py'), '--port', str(self.port),
+                   '--mode', mode, '--cache-dir', os.path.join(work_dir, 'cache'),
+                   '--cache-size', '0']  # キャッシュされた結果を返さないようにする
+        if workers:
+            command += ['--workers', str(workers)]
+        self.log_path = os.path.join(work_dir, 'server.log')
+        self._log = open(self.log_path, 'w')
+        self.process = subprocess.Popen(command, cwd=work_dir, stdout=self._log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self):
+        deadline = time.time() + SERVER_START_TIMEOUT
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                socket.create_connection(('localhost', self.port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        self.stop()
+        with open(self.log_path) as f:
+            raise RuntimeError(f"Server did not start:\n{f.read()}")
+
+    def stop(self) -> Optional[float]:
+        rss = peak_rss_mb(self.process.pid)
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self._log.close()
+        return rss
+
+def send_request(port: int, input_file: str, json_data: Dict[str, Any], output_dir: str,
+                 source_ip: Optional[str] = None, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Tuple[float, Dict[str, Any]]:
+    # 1つのリクエストを送り、最終的なレスポンスを受信するまでの時間とレスポンスの JSON を返す
+    start = time.perf_counter()
+    source_address = (source_ip, 0) if source_ip else None
+    output_files = []
+
+    def output_path(response_json, media_type):
+        output_files.append(os.path.join(output_dir, f'{uuid.uuid4().hex}.{media_type}'))
+        return output_files[-1]
+
+    try:
+        with socket.create_connection(('localhost', port), source_address=source_address) as sock:
+            request = MMPMessage.from_file(json_data, input_file.split('.')[-1], input_file)
+            request.encode_to_socket(sock, chunk_size=chunk_size)
+            while True:
+                response = MMPMessage.decode_from_socket(sock, recv_exact(sock, HEADER_SIZE),
+                                                         payload_path_factory=output_path, chunk_size=chunk_size)
+                if response.json_data.get('status') not in ['progress', 'part']:
+                    break
+        return time.perf_counter() - start, response.json_data
+    finally:
+        for path in output_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+def bench_mmp_codec(messages: int) -> Dict[str, Any]:
+    # メモリ上でのヘッダー・JSON のエンコードとデコード (1,400 バイトのパケット)
+    packet = MMPMessage({"seq": 0}, "mp4", os.urandom(PACKET_SIZE))
+    start = time.perf_counter()
+    for i in range(messages):
+        packet.json_data["seq"] = i
+        MMPMessage.decode(*packet.encode())
+    return {"packets_per_second": round(messages / (time.perf_counter() - start))}
+
+def _socket_transfer_seconds(messages: List[MMPMessage], chunk_size: int) -> float:
+    # ローカルのソケットペアでメッセージを送信し、全て受信するまでの時間を返す
+    sender, receiver = socket.socketpair()
+
+    def send_all():
+        for message in messages:
+            message.encode_to_socket(sender, chunk_size=chunk_size)
+
+    thread = threading.Thread(target=send_all)
+    start = time.perf_counter()
+    thread.start()
+    for _ in messages:
+        MMPMessage.decode_from_socket(receiver, recv_exact(receiver, HEADER_SIZE), chunk_size=chunk_size)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    sender.close()
+    receiver.close()
+    return elapsed
+
+def bench_mmp_socket(messages: int, large_payload_mb: int, chunk_size: int) -> Dict[str, Any]:
+    payload = os.urandom(PACKET_SIZE)
+    packets_per_second = messages / _socket_transfer_seconds(
+        [MMPMessage({"seq": i}, "mp4", payload) for i in range(messages)], chunk_size)
+    large = MMPMessage({"seq": 0}, "mp4", os.urandom(large_payload_mb * 1024 * 1024))
+    large_seconds = _socket_transfer_seconds([large], chunk_size)
+    return {
+        "packets_per_second": round(packets_per_second),
+        "target_packets_per_second": TARGET_PACKETS_PER_SECOND,
+        "meets_target": packets_per_second >= TARGET_PACKETS_PER_SECOND,
+        "large_payload_mb_per_second": round(large_payload_mb / large_seconds, 1),
+    }
+
+def bench_upload(port: int, work_dir: str, size_mb: int, repeat: int, chunk_size: int) -> Dict[str, Any]:
+    # 処理タイプを指定しないリクエストは、サーバーがペイロードを全て受信 (一時ファイルへの書き込みと
+    # SHA-256 の計算を含む) してからエラーを返すため、アップロードのみの時間を計測できる
+    upload_file = os.path.join(work_dir, 'upload.bin')
+    create_random_file(upload_file, size_mb * 1024 * 1024)
+    times = []
+    for _ in range(repeat):
+        elapsed, response = send_request(port, upload_file, {"benchmark": "upload"}, work_dir, chunk_size=chunk_size)
+        if response.get('error_code') != 400:
+            raise RuntimeError(f"Unexpected upload response: {response}")
+        times.append(elapsed)
+    os.remove(upload_file)
+    return {
+        "size_mb": size_mb,
+        "mb_per_second": round(size_mb / statistics.median(times), 1),
+        "seconds": summarize(times),
+    }
+
+def bench_operations(port: int, input_file: str, work_dir: str, repeat: int, chunk_size: int) -> Dict[str, Any]:
+    results = {}
+    for process_type, params in OPERATION_PARAMS.items():
+        times = []
+        for _ in range(repeat):
+            elapsed, response = send_request(port, input_file, {"process_type": process_type, **params},
+                                             work_dir, chunk_size=chunk_size)
+            if 'error_code' in response:
+                raise RuntimeError(f"{process_type} failed: {response}")
+            times.append(elapsed)
+        results[process_type] = summarize(times)
+    return results
+
+def bench_concurrency(port: int, input_file: str, work_dir: str, levels: List[int], jobs_per_client: int,
+                      process_type: str, chunk_size: int) -> List[Dict[str, Any]]:
+    results = []
+    source_ips = loopback_source_ips(max(levels))
+    for clients in levels:
+        latencies: List[float] = []
+        errors: Dict[str, int] = {}
+        lock = threading.Lock()
+
+        def run_client(source_ip):
+            for _ in range(jobs_per_client):
+                elapsed, response = send_request(
+                    port, input_file, {"process_type": process_type, **OPERATION_PARAMS[process_type]},
+                    work_dir, source_ip, chunk_size)
+                with lock:
+                    if 'error_code' in response:
+                        errors[str(response['error_code'])] = errors.get(str(response['error_code']), 0) + 1
+                    else:
+                        latencies.append(elapsed)
+
+        threads = [threading.Thread(target=run_client, args=(source_ips[i],)) for i in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        result = {
+            "clients": clients,
+            "completed": len(latencies),
+            "errors": errors,
+            "seconds": round(elapsed, 3),
+            "jobs_per_second": round(len(latencies) / elapsed, 3),
+        }
+        if latencies:
+            result["latency"] = summarize(latencies)
+        results.append(result)
+    return results
+
+def environment() -> Dict[str, Any]:
+    info = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+    try:
+        info["ffmpeg"] = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout.split('\n')[0]
+        info["git_revision"] = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR,
+                                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        pass
+    return info
+
+def print_report(result: Dict[str, Any]):
+    if 'mmp' in result:
+        mmp = result['mmp']
+        print(f"{'MMP encode/decode:':<28}{mmp['codec']['packets_per_second']:>10} packets/s")
+        print(f"{'MMP over socket:':<28}{mmp['socket']['packets_per_second']:>10} packets/s"
+              f"  (target {TARGET_PACKETS_PER_SECOND}: {'met' if mmp['socket']['meets_target'] else 'NOT met'})")
+        print(f"{'MMP large payload:':<28}{mmp['socket']['large_payload_mb_per_second']:>10} MB/s")
+    if 'upload' in result:
+        print(f"{'Upload:':<28}{result['upload']['mb_per_second']:>10} MB/s")
+    for process_type, stats in result.get('operations', {}).items():
+        print(f"{process_type + ':':<28}{stats['median']:>10.3f} s (median of {stats['runs']})")
+    for level in result.get('concurrency', []):
+        errors = f", errors {level['errors']}" if level['errors'] else ''
+        print(f"{str(level['clients']) + ' clients:':<28}{level['jobs_per_second']:>10.3f} jobs/s{errors}")
+    rss = result['peak_rss_mb']
+    print(f"{'Peak RSS:':<28}client {rss.get('client')} MB, server {rss.get('server')} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the MMP protocol and a local video processing server')
+    parser.add_argument('--sections', default='mmp,upload,operations,concurrency',
+                        help='Comma-separated sections to run (mmp, upload, operations, concurrency)')
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded', help='Server mode')
+    parser.add_argument('--workers', type=int, help='Server --workers setting')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Socket I/O chunk size in bytes')
+    parser.add_argument('--messages', type=int, default=50000, help='Messages for the MMP benchmarks')
+    parser.add_argument('--upload-size', type=int, default=256, help='Upload benchmark size in MB')
+    parser.add_argument('--duration', type=int, default=10, help='Length of the generated test video in seconds')
+    parser.add_argument('--size', default='640x360', help='Resolution of the generated test video')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per upload/operation measurement')
+    parser.add_argument('--clients', default='1,2,4,8', help='Comma-separated numbers of simultaneous clients')
+    parser.add_argument('--jobs-per-client', type=int, default=2, help='Requests each concurrent client sends')
+    parser.add_argument('--concurrency-operation', choices=list(OPERATION_PARAMS),
+                        default=VideoProcessType.COMPRESS.value, help='Process type for the concurrency benchmark')
+    parser.add_argument('--output', help='Write the JSON result to this file')
+    parser.add_argument('--json', action='store_true', help='Print the result as JSON')
+    args = parser.parse_args()
+    sections = set(args.sections.split(','))
+
+    result: Dict[str, Any] = {
+        "environment": environment(),
+        "settings": {k: v for k, v in vars(args).items() if k not in ['output', 'json']},
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        server_rss = None
+        if sections & {'upload', 'operations', 'concurrency'}:
+            server = LocalServer(work_dir, args.mode, args.workers)
+            try:
+                server.wait_ready()
+                if 'upload' in sections:
+                    result["upload"] = bench_upload(server.port, work_dir, args.upload_size, args.repeat, args.chunk_size)
+                if sections & {'operations', 'concurrency'}:
+                    input_file = os.path.join(work_dir, 'input.mp4')
+                    create_test_video(input_file, args.duration, args.size)
+                    if 'operations' in sections:
+                        result["operations"] = bench_operations(server.port, input_file, work_dir,
+                                                                args.repeat, args.chunk_size)
+                    if 'concurrency' in sections:
+                        result["concurrency"] = bench_concurrency(
+                            server.port, input_file, work_dir, [int(n) for n in args.clients.split(',')],
+                            args.jobs_per_client, args.concurrency_operation, args.chunk_size)
+            finally:
+                server_rss = server.stop()
+
+        # クライアント側のメモリ使用量は、大きなペイロードをメモリ上に作るプロトコルの計測より前に記録する
+        client_rss = peak_rss_mb()
+        if 'mmp' in sections:
+            result["mmp"] = {
+                "codec": bench_mmp_codec(args.messages),
+                "socket": bench_mmp_socket(args.messages, LARGE_PAYLOAD_MB, args.chunk_size),
+            }
+        result["peak_rss_mb"] = {"client": client_rss, "server": server_rss}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print_report(result)
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,36 @@
 import socket
 import os
 import argparse
+import threading
 import time
-from typing import Optional, Dict, Any
-from mmp_protocol import MMPMessage, VideoProcessType, MediaType
+from typing import Optional, Dict, Any, List, Tuple
+from mmp_protocol import (MMPMessage, VideoProcessType, MediaType, JobOperation, TransferOperation,
+                          HEADER_SIZE, DEFAULT_CHUNK_SIZE, FLAG_CHECKSUM, FLAG_COMPRESSED, recv_exact, hash_file,
+                          content_proof)
+from mmp_mux import MMPConnectionPool, MultiplexNotSupportedError
 
 class VideoProcessingClient:
-    def __init__(self, host='localhost', port=8000):
+    def __init__(self, host='localhost', port=8000, chunk_size=DEFAULT_CHUNK_SIZE, async_jobs=False, dedup=True,
+                 resumable=True, stream=False, parallel_segments=0, profile=None, multiplex=False, output_dir=None,
+                 checksum=False, compress=False):
         self.host = host
         self.port = port
+        self.chunk_size = chunk_size  # ソケット送受信の単位 (バイト)
+        self.async_jobs = async_jobs  # ジョブを投入し、完了後に別の接続で結果を取得する
+        self.dedup = dedup  # サーバーが同じファイルを保持していればアップロードを省略する
+        self.resumable = resumable  # 接続が切れた場合に受信済みの位置からアップロードを再開する
+        self.stream = stream  # サーバーで一時ファイルを介さずに処理し、結果を生成された順に受信する
+        self.parallel_segments = parallel_segments  # 圧縮・解像度変更を区間に分割して並列にエンコードする数
+        self.profile = profile  # エンコードのプロファイル (None の場合はサーバーの既定値)
+        # 多重化した接続を使い回し、リクエストごとの接続の確立を省く (複数のスレッドから同時に使える)
+        self.pool = MMPConnectionPool(host, port) if multiplex else None
+        self.output_dir = output_dir  # 処理結果の保存先 (None の場合は入力ファイルと同じディレクトリ)
+        self.quiet = False  # 複数のファイルを並行して処理する場合は進捗を表示しない
+        # 送受信するペイロードにブロックごとのチェックサムを付ける・圧縮する (サーバーもレスポンスで同じ形式を使う)
+        self.transfer_flags = (FLAG_CHECKSUM if checksum else 0) | (FLAG_COMPRESSED if compress else 0)
+        self.max_upload_retries = 5
+        self.upload_finish_timeout = 5  # レスポンスの受信後、残りの送信の完了を待つ時間 (秒)
+        self.retry_interval = 5  # 再接続までの待機時間 (秒)
         self.status_check_interval = 60  # 1分間隔で処理状況を確認
 
     def _validate_file(self, file_path: str) -> bool:
@@ -27,74 +49,353 @@ class VideoProcessingClient:
 
         return True
 
+    def _exchange(self, message: MMPMessage, file_path: Optional[str] = None,
+                  show_progress: bool = False, dedup: bool = True) -> MMPMessage:
+        # 1つのリクエストを送信し、レスポンスを受信する (多重化しない場合は接続をリクエストごとに確立する)
+        content_hash = None
+        if message.payload_path and (self.dedup or self.resumable):
+            content_hash = hash_file(message.payload_path)
+        upload: Dict[str, Any] = {}  # 再開可能なアップロードの状態
+        retries = 0
+        while True:
+            client_socket = self._connect()
+            try:
+                request = self._prepare_upload(client_socket, message, content_hash, upload, self.dedup and dedup)
+                if "error_code" in request.json_data:
+                    # サーバーに保存する容量がない場合は、アップロードせずにエラーを返す
+                    return request
+                response = self._send_and_receive(client_socket, request, file_path, show_progress)
+            except OSError as e:
+                # アップロードIDを受け取った後に接続が切れた場合は、受信済みの位置から再開する
+                if not upload.get('upload_id') or retries >= self.max_upload_retries:
+                    raise
+                retries += 1
+                print(f"\nConnection lost ({e}), resuming in {self.retry_interval} seconds...")
+                time.sleep(self.retry_interval)
+                continue
+            finally:
+                client_socket.close()
+
+            if self._is_corrupt_transfer(response) and retries < self.max_upload_retries:
+                # サーバーは検証済みのブロックまでを保存しているため、再開可能なアップロードはその続きから送り直す
+                retries += 1
+                print("\nUpload was corrupted in transit, sending it again...")
+                continue
+
+            # 確認後にサーバー側のデータが削除されていた場合はアップロードし直す
+            upload_skipped = message.payload_path and not request.payload_path
+            if upload_skipped and response.json_data.get('error_code') == 410:
+                return self._exchange(message, file_path, show_progress, dedup=False)
+            return response
+
+    def _is_corrupt_transfer(self, response: MMPMessage) -> bool:
+        return (response.json_data.get('error_code') == 400
+                and response.json_data.get('description') == "Corrupt transfer")
+
+    def _connect(self):
+        # 多重化した接続のストリームは、ソケットと同じように読み書きできる
+        if self.pool:
+            try:
+                return self.pool.open_stream()
+            except MultiplexNotSupportedError:
+                print("Server does not support multiplexed connections, using one connection per request")
+                self.pool = None
+        return socket.create_connection((self.host, self.port))
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+
+    def _prepare_upload(self, client_socket: socket.socket, message: MMPMessage, content_hash: Optional[str],
+                        upload: Dict[str, Any], dedup: bool) -> MMPMessage:
+        if not message.payload_path:
+            return message
+
+        # 動画をアップロードする場合は、先にハッシュ値を送ってサーバーが保持しているか確認する
+        challenge = self._content_challenge(client_socket, message, content_hash) if dedup else None
+        if challenge:
+            if not self.quiet:
+                print("Server already has this file, skipping upload")
+            return MMPMessage({**message.json_data, "content_hash": content_hash,
+                               "content_proof": self._content_proof(message.payload_path, challenge)},
+                              message.media_type)
+
+        # ストリーミング処理では受信したデータをそのまま FFmpeg に渡すため、アップロードを再開できない
+        if not self.resumable or message.json_data.get('stream'):
+            return message
+
+        # アップロードIDを取得 (再接続時は受信済みのオフセットを問い合わせる)
+        if upload.get('upload_id'):
+            query = {"operation": TransferOperation.UPLOAD_STATUS.value, "upload_id": upload['upload_id']}
+        else:
+            query = {"operation": TransferOperation.UPLOAD_INIT.value, "content_hash": content_hash,
+                     "payload_size": message.payload_size, "media_type": message.media_type}
+        status = self._send_and_receive(client_socket, MMPMessage(query, MediaType.JSON.value))
+        if status.json_data.get('error_code') == 507:
+            return status
+        if "error_code" in status.json_data:
+            # 途中のアップロードが見つからない場合は最初から送る
+            upload.clear()
+            return message
+
+        upload['upload_id'] = status.json_data['upload_id']
+        offset = status.json_data['offset']
+        if offset:
+            print(f"Resuming upload from {offset} of {message.payload_size} bytes")
+        return MMPMessage.from_file(
+            json_data={**message.json_data, "upload_id": upload['upload_id'], "upload_offset": offset},
+            media_type=message.media_type,
+            payload_path=message.payload_path,
+            payload_offset=offset
+        )
+
+    def _content_challenge(self, client_socket: socket.socket, message: MMPMessage,
+                           content_hash: str) -> Optional[Dict[str, Any]]:
+        # サーバーが入力を保持している場合は、アップロードの代わりにハッシュ値を求めるファイルの範囲が返される
+        check = MMPMessage({
+            **message.json_data,
+            "operation": TransferOperation.CHECK_CONTENT.value,
+            "content_hash": content_hash,
+            "payload_size": message.payload_size,
+        }, MediaType.JSON.value)
+        status = self._send_and_receive(client_socket, check)
+        return status.json_data.get('challenge')
+
+    def _content_proof(self, file_path: str, challenge: Dict[str, Any]) -> Dict[str, str]:
+        with open(file_path, 'rb') as f:
+            f.seek(challenge['offset'])
+            data = f.read(challenge['length'])
+        return {"nonce": challenge['nonce'], "digest": content_proof(challenge['nonce'], data)}
+
+    def _send_and_receive(self, client_socket: socket.socket, message: MMPMessage,
+                          file_path: Optional[str] = None, show_progress: bool = False) -> MMPMessage:
+        message.flags = self.transfer_flags
+        progress_callback = self._print_upload_progress if show_progress else None
+        uploader = None
+        if message.json_data.get('stream') and message.payload_size > 0:
+            # ストリーミング処理ではサーバーが入力の受信中に処理結果を送るため、
+            # アップロードは別のスレッドで行い、その間にレスポンスを読む (送信と受信が互いに待ち続けないように)
+            uploader = threading.Thread(target=self._upload_in_background,
+                                        args=(client_socket, message, progress_callback), daemon=True)
+            uploader.start()
+        else:
+            message.encode_to_socket(client_socket, chunk_size=self.chunk_size, progress_callback=progress_callback)
+            if show_progress:
+                print("\nRequest sent, waiting for response...")
+
+        # 処理結果は受信しながら出力ファイルへ書き込む
+        payload_path_factory = None
+        if file_path:
+            payload_path_factory = lambda json_data, media_type: self._generate_output_path(
+                file_path, media_type, json_data.get('index'))
+
+        # 進捗フレームを表示しながら最終的なレスポンスを待つ
+        parts: List[MMPMessage] = []  # 複数の処理結果を返す場合の各パート
+        stream_path = None
+        stream_file = None
+        try:
+            while True:
+                try:
+                    header_bytes = recv_exact(client_socket, HEADER_SIZE)
+                except ConnectionError:
+                    raise ConnectionError("No response from server")
+
+                response, _ = MMPMessage.decode_body_from_socket(client_socket, header_bytes)
+                status = response.json_data.get('status')
+                if status == 'chunk':
+                    # ストリーミングされた処理結果は受信した順に出力ファイルへ追記する
+                    if not stream_file:
+                        stream_path = payload_path_factory(response.json_data, response.media_type)
+                        stream_file = open(stream_path, 'wb')
+                    for chunk in response.iter_payload_from_socket(client_socket, self.chunk_size):
+                        stream_file.write(chunk)
+                    self._print_stream_progress(stream_file.tell())
+                    continue
+
+                payload_path = None
+                if payload_path_factory is not None and response.payload_size > 0:
+                    payload_path = payload_path_factory(response.json_data, response.media_type)
+                response.read_payload_from_socket(client_socket, payload_path, chunk_size=self.chunk_size)
+                if status == 'part':
+                    parts.append(response)
+                    continue
+                if status != 'progress':
+                    break
+                self._print_processing_progress(response.json_data)
+        finally:
+            if stream_file:
+                stream_file.close()
+            if uploader:
+                self._finish_upload(client_socket, uploader)
+
+        if parts:
+            if "error_code" in response.json_data:
+                for part in parts:
+                    os.remove(part.payload_path)
+            else:
+                response.parts = parts
+
+        if stream_path:
+            if response.json_data.get('streamed'):
+                response.payload_path = stream_path
+            else:
+                # 途中でエラーになった場合は不完全な出力を残さない
+                os.remove(stream_path)
+        return response
+
+    def _upload_in_background(self, client_socket: socket.socket, message: MMPMessage, progress_callback):
+        try:
+            message.encode_to_socket(client_socket, chunk_size=self.chunk_size, progress_callback=progress_callback)
+        except OSError as e:
+            # 送信の失敗は、受信側でレスポンスが届かないことで検出する
+            if not self.quiet:
+                print(f"\nUpload interrupted: {e}")
+
+    def _finish_upload(self, client_socket: socket.socket, uploader: threading.Thread):
+        # サーバーが入力を最後まで読まずに応答した場合 (壊れたブロックを受信した場合など) は送信を中断させる
+        uploader.join(self.upload_finish_timeout)
+        if uploader.is_alive():
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            uploader.join()
+
+    def _print_error(self, response: MMPMessage) -> bool:
+        if "error_code" not in response.json_data:
+            return False
+        print(f"Error: {response.json_data['description']}")
+        print(f"Solution: {response.json_data['solution']}")
+        return True
+
+    def _create_request(self, file_path: str, process_type: VideoProcessType,
+                        params: Optional[Dict[str, Any]] = None, operation: Optional[JobOperation] = None) -> MMPMessage:
+        json_data = {"process_type": process_type.value}
+        if operation:
+            json_data["operation"] = operation.value
+        else:
+            json_data["report_progress"] = True
+            if self.stream:
+                json_data["stream"] = True
+        if self.parallel_segments > 1 and process_type in [VideoProcessType.COMPRESS, VideoProcessType.RESIZE_RESOLUTION]:
+            json_data["parallel_segments"] = self.parallel_segments
+        if self.profile:
+            json_data["profile"] = self.profile
+        if params:
+            json_data.update(params)
+
+        # ファイル全体をメモリに読み込まず、送信時にファイルから直接ストリーミングする
+        return MMPMessage.from_file(
+            json_data=json_data,
+            media_type=self._media_type(file_path),
+            payload_path=file_path
+        )
+
     def _send_request(self, file_path: str, process_type: VideoProcessType, params: Optional[Dict[str, Any]] = None) -> bool:
         if not self._validate_file(file_path):
             return False
 
+        if self.async_jobs:
+            job_id = self.submit_job(file_path, process_type, params)
+            return bool(job_id) and self.wait_for_job(job_id, file_path)
+
         try:
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect((self.host, self.port))
-
-            # ファイルを読み込んでメッセージを作成
-            with open(file_path, 'rb') as f:
-                file_content = f.read()
-
-            json_data = {"process_type": process_type.value}
-            if params:
-                json_data.update(params)
-
-            message = MMPMessage(
-                json_data=json_data,
-                media_type=MediaType.MP4.value,
-                payload=file_content
-            )
-
-            # リクエストを送信
-            header_bytes, body_bytes, payload = message.encode()
-            client_socket.sendall(header_bytes)
-            client_socket.sendall(body_bytes)
-            client_socket.sendall(payload)
-
-            print("Request sent, waiting for response...")
-
-            # レスポンスを受信
-            header_bytes = client_socket.recv(8)
-            if not header_bytes:
-                print("Error: No response from server")
-                return False
+            message = self._create_request(file_path, process_type, params)
+            response = self._exchange(message, file_path, show_progress=True)
 
-            response = MMPMessage.decode_from_socket(client_socket, header_bytes)
-            if not response:
-                print("Error: Invalid response from server")
+            if self._print_error(response):
                 return False
 
-            if "error_code" in response.json_data:
-                print(f"Error: {response.json_data['description']}")
-                print(f"Solution: {response.json_data['solution']}")
+            if not response.payload_path:
+                print("Error: Invalid response from server")
                 return False
 
-            # 処理結果をファイルに保存
-            output_path = self._generate_output_path(file_path, response.media_type)
-            with open(output_path, 'wb') as f:
-                f.write(response.payload)
-
-            print(f"\nProcessing complete! Output saved to: {output_path}")
+            print(f"\nProcessing complete! Output saved to: {response.payload_path}")
             return True
 
         except ConnectionRefusedError:
             print("Error: Could not connect to server. Make sure the server is running.")
         except Exception as e:
             print(f"Error: {e}")
-        finally:
-            if 'client_socket' in locals():
-                client_socket.close()
 
         return False
 
-    def _generate_output_path(self, input_path: str, output_type: str) -> str:
-        directory = os.path.dirname(input_path)
+    def submit_job(self, file_path: str, process_type: VideoProcessType,
+                   params: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        # アップロード後すぐにジョブIDを受け取り、処理中は接続を保持しない
+        try:
+            message = self._create_request(file_path, process_type, params, operation=JobOperation.SUBMIT_JOB)
+            response = self._exchange(message, show_progress=True)
+        except ConnectionRefusedError:
+            print("Error: Could not connect to server. Make sure the server is running.")
+            return None
+        except Exception as e:
+            print(f"Error: {e}")
+            return None
+
+        if self._print_error(response):
+            return None
+        job_id = response.json_data['job_id']
+        print(f"Job submitted: {job_id}")
+        return job_id
+
+    def get_job_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        # 接続エラーは呼び出し元で再試行できるようにそのまま送出する
+        message = MMPMessage({"operation": JobOperation.JOB_STATUS.value, "job_id": job_id}, MediaType.JSON.value)
+        response = self._exchange(message)
+        if self._print_error(response):
+            return None
+        return response.json_data
+
+    def fetch_result(self, job_id: str, file_path: str) -> bool:
+        message = MMPMessage({"operation": JobOperation.FETCH_RESULT.value, "job_id": job_id}, MediaType.JSON.value)
+        response = self._exchange(message, file_path)
+        if self._print_error(response):
+            return False
+        if not response.payload_path:
+            print("Error: Invalid response from server")
+            return False
+        print(f"\nProcessing complete! Output saved to: {response.payload_path}")
+        return True
+
+    def wait_for_job(self, job_id: str, file_path: str) -> bool:
+        # status_check_interval ごとに状態を確認し、接続が切れても再接続して待機を続ける
+        while True:
+            try:
+                status = self.get_job_status(job_id)
+                if status is None:
+                    return False
+                if status['job_status'] in ('done', 'failed'):
+                    return self.fetch_result(job_id, file_path)
+                progress = status.get('progress') or {}
+                print(f"Job {job_id} is {status['job_status']}... time={progress.get('out_time', '-')} "
+                      f"speed={progress.get('speed', '-')}")
+            except OSError as e:
+                print(f"Connection error ({e}), retrying in {self.status_check_interval} seconds")
+            time.sleep(self.status_check_interval)
+
+    def _print_upload_progress(self, sent: int, total: int):
+        if self.quiet:
+            return
+        print(f"\rUpload progress: {sent / total * 100:.2f}%", end='', flush=True)
+
+    def _print_processing_progress(self, progress: Dict[str, Any]):
+        if self.quiet:
+            return
+        print(f"\rProcessing: time={progress.get('out_time')} frame={progress.get('frame')} "
+              f"fps={progress.get('fps')} speed={progress.get('speed')}", end='', flush=True)
+
+    def _print_stream_progress(self, received: int):
+        if self.quiet:
+            return
+        print(f"\rReceived: {received / (1024 * 1024):.1f} MB", end='', flush=True)
+
+    def _generate_output_path(self, input_path: str, output_type: str, index: Optional[int] = None) -> str:
+        directory = self.output_dir or os.path.dirname(input_path)
         filename = os.path.splitext(os.path.basename(input_path))[0]
-        return os.path.join(directory, f"{filename}_processed.{output_type}")
+        # 複数の処理結果を受け取る場合は処理の順番で区別する
+        suffix = "processed" if index is None else f"processed_{index + 1}"
+        return os.path.join(directory, f"{filename}_{suffix}.{output_type}")
 
     def compress_video(self, file_path: str) -> bool:
         return self._send_request(file_path, VideoProcessType.COMPRESS)
@@ -118,23 +419,146 @@ class VideoProcessingClient:
         params = {"start_time": start_time, "duration": duration}
         return self._send_request(file_path, VideoProcessType.CREATE_WEBM, params)
 
+    def _create_pipeline_request(self, file_path: str,
+                                 operations: List[Tuple[VideoProcessType, Optional[Dict[str, Any]]]]) -> MMPMessage:
+        return MMPMessage.from_file(
+            json_data={
+                "operations": [{"process_type": process_type.value, **(params or {})}
+                               for process_type, params in operations],
+                "report_progress": True,
+                **({"profile": self.profile} if self.profile else {}),
+            },
+            media_type=self._media_type(file_path),
+            payload_path=file_path
+        )
+
+    def _media_type(self, file_path: str) -> str:
+        # 拡張子をそのまま送る (サーバーは一時ファイルの拡張子や、先頭から順に読めるかの判定に使う)
+        return os.path.splitext(file_path)[1][1:].lower()
+
+    def process_pipeline(self, file_path: str, operations: List[Tuple[VideoProcessType, Optional[Dict[str, Any]]]]) -> bool:
+        # 複数の処理を1回のアップロードで依頼し、全ての結果を1つのレスポンスで受け取る
+        if not self._validate_file(file_path):
+            return False
+        if self.async_jobs:
+            print("Error: Multiple actions cannot be submitted as a background job")
+            return False
+
+        try:
+            message = self._create_pipeline_request(file_path, operations)
+            response = self._exchange(message, file_path, show_progress=True)
+
+            if self._print_error(response):
+                return False
+
+            if not response.parts:
+                print("Error: Invalid response from server")
+                return False
+
+            print("\nProcessing complete! Outputs saved to:")
+            for part in response.parts:
+                print(f"  {part.json_data.get('process_type')}: {part.payload_path}")
+            return True
+
+        except ConnectionRefusedError:
+            print("Error: Could not connect to server. Make sure the server is running.")
+        except Exception as e:
+            print(f"Error: {e}")
+
+        return False
+
+def _action_operation(args, action: str) -> Optional[Tuple[VideoProcessType, Dict[str, Any]]]:
+    # コマンドライン引数から1つの処理とそのパラメータを作る (不足している場合は None)
+    if action == 'compress':
+        return VideoProcessType.COMPRESS, {}
+    if action == 'resize':
+        if not args.width or not args.height:
+            print("Error: Width and height are required for resize")
+            return None
+        return VideoProcessType.RESIZE_RESOLUTION, {"width": args.width, "height": args.height}
+    if action == 'aspect':
+        if not args.aspect_ratio:
+            print("Error: Aspect ratio is required (e.g., --aspect-ratio '16:9')")
+            return None
+        return VideoProcessType.CHANGE_ASPECT_RATIO, {"aspect_ratio": args.aspect_ratio}
+    if action == 'audio':
+        return VideoProcessType.EXTRACT_AUDIO, {}
+    if not args.start_time or not args.duration:
+        print("Error: Start time and duration are required for gif/webm creation")
+        return None
+    process_type = VideoProcessType.CREATE_GIF if action == 'gif' else VideoProcessType.CREATE_WEBM
+    return process_type, {"start_time": args.start_time, "duration": args.duration}
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process a video file')
-    parser.add_argument('file', help='Path to the video file')
+    parser.add_argument('file', help='Path to the video file, a directory of videos or a JSONL manifest')
     parser.add_argument('--host', default='localhost', help='Server host')
     parser.add_argument('--port', type=int, default=8000, help='Server port')
-    parser.add_argument('--action', choices=['compress', 'resize', 'aspect', 'audio', 'gif', 'webm'],
-                        required=True, help='Processing action to perform')
+    parser.add_argument('--action', action='append', choices=['compress', 'resize', 'aspect', 'audio', 'gif', 'webm'],
+                        help='Processing action to perform; repeat to run several actions with one upload and one decode')
     parser.add_argument('--width', type=int, help='Width for resize')
     parser.add_argument('--height', type=int, help='Height for resize')
     parser.add_argument('--aspect-ratio', help='Aspect ratio (e.g., "16:9")')
     parser.add_argument('--start-time', help='Start time for gif/webm (e.g., "00:00:00")')
     parser.add_argument('--duration', help='Duration for gif/webm (e.g., "00:00:10")')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Socket I/O chunk size in bytes')
+    parser.add_argument('--async', dest='async_jobs', action='store_true',
+                        help='Submit as a background job and poll for the result')
+    parser.add_argument('--job-id', help='Resume waiting for a previously submitted job')
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false',
+                        help='Always upload the file even if the server already has it')
+    parser.add_argument('--no-resume', dest='resumable', action='store_false',
+                        help='Do not resume interrupted uploads')
+    parser.add_argument('--stream', action='store_true',
+                        help='Pipe the upload straight into FFmpeg and receive the output as it is produced')
+    parser.add_argument('--segments', type=int, default=0,
+                        help='Split compress/resize into this many keyframe-aligned segments encoded in parallel')
+    parser.add_argument('--profile', choices=['fast', 'balanced', 'archive'],
+                        help='Encoder speed/quality profile (default: server setting)')
+    parser.add_argument('--status-interval', type=int, default=60, help='Seconds between job status checks')
+    parser.add_argument('--multiplex', action='store_true',
+                        help='Reuse one persistent connection for all requests (e.g. job status checks)')
+    parser.add_argument('--checksum', action='store_true',
+                        help='Verify a CRC32 per 64KB block of uploads and downloads while they are received')
+    parser.add_argument('--compress', action='store_true',
+                        help='Compress payloads and large JSON with zlib where it saves space (e.g. on slow links)')
+    parser.add_argument('--output-dir', help='Directory for processed files (default: next to each input)')
+    batch_group = parser.add_argument_group('batch mode (directory or .jsonl manifest input)')
+    batch_group.add_argument('--server', action='append', metavar='HOST:PORT',
+                             help='Server to distribute files to; repeat for several servers (default: --host/--port)')
+    batch_group.add_argument('--concurrency', type=int,
+                             help='Number of files processed at once (default: --per-server for each server)')
+    batch_group.add_argument('--per-server', type=int, default=1,
+                             help='Requests sent to each server at once (raise only for servers without the per-IP limit)')
+    batch_group.add_argument('--retries', type=int, default=5,
+                             help='Retries per file for busy servers and connection errors')
+    batch_group.add_argument('--force', action='store_true', help='Reprocess files whose outputs are up to date')
 
     args = parser.parse_args()
-    client = VideoProcessingClient(host=args.host, port=args.port)
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    if os.path.isdir(args.file) or args.file.endswith('.jsonl'):
+        from batch_client import run_batch
+        run_batch(args)
+        raise SystemExit
+    if not args.action and not args.job_id:
+        parser.error("--action is required unless --job-id is given")
+    client = VideoProcessingClient(host=args.host, port=args.port, chunk_size=args.chunk_size,
+                                   async_jobs=args.async_jobs, dedup=args.dedup, resumable=args.resumable,
+                                   stream=args.stream, parallel_segments=args.segments, profile=args.profile,
+                                   multiplex=args.multiplex, output_dir=args.output_dir,
+                                   checksum=args.checksum, compress=args.compress)
+    client.status_check_interval = args.status_interval
+    actions = args.action or []
+    args.action = actions[0] if actions else None
 
-    if args.action == 'compress':
+    if args.job_id:
+        client.wait_for_job(args.job_id, args.file)
+    elif len(actions) > 1:
+        operations = [_action_operation(args, action) for action in actions]
+        if all(operations):
+            client.process_pipeline(args.file, operations)
+    elif args.action == 'compress':
         client.compress_video(args.file)
     elif args.action == 'resize':
         if not args.width or not args.height:
@@ -156,3 +580,4 @@ if __name__ == '__main__':
                 client.create_gif(args.file, args.start_time, args.duration)
             else:
                 client.create_webm(args.file, args.start_time, args.duration)
+    client.close()
@@ -0,0 +1,210 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from mmp_protocol import VideoProcessType
+from media_probe import parse_timestamp
+
+# サーバーのリソースの60%を動画処理に割り当てる
+DEFAULT_CPU_SHARE = 0.6
+DEFAULT_THREADS_PER_JOB = 2
+DEFAULT_MAX_QUEUE_SIZE = 32
+
+# 優先度 (小さいほど先に処理される)
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# この長さ以下の GIF/WEBM は短いジョブとして優先する
+SHORT_CLIP_SECONDS = 30
+
+class QueueFullError(Exception):
+    pass
+
+def job_priority(process_type: str, params: Dict[str, Any]) -> int:
+    # 軽い処理 (音声抽出・短いクリップ) が長時間の圧縮処理の後ろで待たされないようにする
+    if process_type == VideoProcessType.EXTRACT_AUDIO.value:
+        return PRIORITY_HIGH
+    if process_type in [VideoProcessType.CREATE_GIF.value, VideoProcessType.CREATE_WEBM.value]:
+        try:
+            duration = parse_timestamp(params.get('duration', '00:00:10'))
+        except ValueError:
+            return PRIORITY_NORMAL
+        return PRIORITY_HIGH if duration <= SHORT_CLIP_SECONDS else PRIORITY_NORMAL
+    return PRIORITY_LOW
+
+def worker_pool_size(max_workers: Optional[int] = None, cpu_share: float = DEFAULT_CPU_SHARE) -> Tuple[int, int]:
+    # (同時実行ジョブ数, ジョブあたりの FFmpeg スレッド数) を CPU 予算から決める
+    cpu_budget = max(1, int((os.cpu_count() or 1) * cpu_share))
+    workers = max_workers or max(1, cpu_budget // DEFAULT_THREADS_PER_JOB)
+    return workers, max(1, cpu_budget // workers)
+
+class Job:
+    def __init__(self, func: Callable[[int], Any], priority: int):
+        self.func = func
+        self.priority = priority
+        self.status = "queued"  # queued -> running -> done / failed
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self._done = threading.Event()
+        # ジョブは投入したリクエストのコンテキスト (処理時間のトレースなど) で実行する
+        self._context = contextvars.copy_context()
+        self._submitted_at = time.perf_counter()
+
+    def _run(self, threads: int, metrics=None):
+        self.status = "running"
+        try:
+            self.result = self._context.run(self._call, threads, metrics)
+            self.status = "done"
+        except BaseException as e:
+            self.error = e
+            self.status = "failed"
+        finally:
+            self._done.set()
+
+    def _call(self, threads: int, metrics=None) -> Any:
+        if metrics:
+            metrics.observe('queue_wait', time.perf_counter() - self._submitted_at)
+        return self.func(threads)
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> Any:
+        if not self._done.wait(timeout):
+            raise TimeoutError("Job did not finish in time")
+        if self.error:
+            raise self.error
+        return self.result
+
+class JobScheduler:
+    def __init__(self, max_workers: Optional[int] = None, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+                 cpu_share: float = DEFAULT_CPU_SHARE, metrics=None):
+        # 各ジョブの FFmpeg スレッド数は CPU 予算をワーカー数で割った値
+        self.max_workers, self.threads_per_job = worker_pool_size(max_workers, cpu_share)
+        self.max_queue_size = max_queue_size
+        self.metrics = metrics  # 待ち行列での待ち時間を記録する (metrics.Metrics)
+        self._queue: List[tuple] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._running = True
+        self._active = 0  # 実行中のジョブ数
+        self._workers = []
+        for i in range(self.max_workers):
+            worker = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, func: Callable[[int], Any], priority: int = PRIORITY_NORMAL) -> Job:
+        # func はスレッド数を引数に受け取る
+        job = Job(func, priority)
+        with self._condition:
+            if not self._running:
+                raise RuntimeError("Scheduler is shut down")
+            if len(self._queue) >= self.max_queue_size:
+                raise QueueFullError(f"Job queue is full ({self.max_queue_size} jobs waiting)")
+            # 同じ優先度では投入順 (FIFO) に処理する
+            heapq.heappush(self._queue, (priority, next(self._sequence), job))
+            self._condition.notify()
+        return job
+
+    def queue_depth(self) -> int:
+        with self._condition:
+            return len(self._queue)
+
+    def active_jobs(self) -> int:
+        with self._condition:
+            return self._active
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                while self._running and not self._queue:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                _, _, job = heapq.heappop(self._queue)
+                self._active += 1
+            try:
+                job._run(self.threads_per_job, self.metrics)
+            finally:
+                with self._condition:
+                    self._active -= 1
+
+    def shutdown(self):
+        with self._condition:
+            self._running = False
+            pending = [job for _, _, job in self._queue]
+            self._queue.clear()
+            self._condition.notify_all()
+        for job in pending:
+            job.error = RuntimeError("Scheduler shut down before the job started")
+            job.status = "failed"
+            job._done.set()
+
+class AsyncJobScheduler:
+    # asyncio サーバー用のスケジューラ。JobScheduler と同じ優先度・上限で、ジョブはコルーチンとして実行する
+    def __init__(self, max_workers: Optional[int] = None, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE,
+                 cpu_share: float = DEFAULT_CPU_SHARE, metrics=None):
+        self.max_workers, self.threads_per_job = worker_pool_size(max_workers, cpu_share)
+        self.max_queue_size = max_queue_size
+        self.metrics = metrics
+        self._sequence = itertools.count()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: List[asyncio.Task] = []
+        self._active = 0
+
+    def start(self):
+        # イベントループ上で呼び出す
+        self._queue = asyncio.PriorityQueue(self.max_queue_size)
+        self._workers = [asyncio.ensure_future(self._worker_loop()) for _ in range(self.max_workers)]
+
+    def submit(self, func: Callable[[int], Awaitable[Any]], priority: int = PRIORITY_NORMAL) -> asyncio.Future:
+        # func はスレッド数を引数に受け取るコルーチン関数
+        future = asyncio.get_event_loop().create_future()
+        try:
+            self._queue.put_nowait((priority, next(self._sequence), func, future,
+                                    contextvars.copy_context(), time.perf_counter()))
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Job queue is full ({self.max_queue_size} jobs waiting)")
+        return future
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    def active_jobs(self) -> int:
+        return self._active
+
+    async def _worker_loop(self):
+        while True:
+            _, _, func, future, context, submitted_at = await self._queue.get()
+            if future.cancelled():
+                continue
+            self._active += 1
+            try:
+                if self.metrics:
+                    context.run(self.metrics.observe, 'queue_wait', time.perf_counter() - submitted_at)
+                # 投入したリクエストのコンテキストを引き継いだタスクとして実行する
+                result = await context.run(asyncio.ensure_future, func(self.threads_per_job))
+                if not future.cancelled():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except BaseException as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self._active -= 1
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.cancel()
+        while self._queue and not self._queue.empty():
+            _, _, _, future, _, _ = self._queue.get_nowait()
+            future.cancel()
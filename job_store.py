@@ -0,0 +1,98 @@
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+DEFAULT_RESULT_TTL = 60 * 60  # 処理結果は取得されなければ1時間で削除
+
+class StoredJob:
+    def __init__(self, job_id: str, process_type: str, client_ip: str):
+        self.job_id = job_id
+        self.process_type = process_type
+        self.client_ip = client_ip
+        self.status = "queued"  # queued -> running -> done / failed
+        self.message = ""
+        self.output_file: Optional[str] = None
+        self.progress: Dict = {}  # FFmpeg の最新の進捗情報
+        self.workspace = None  # 結果を取得するまで保持する一時ファイルの置き場所 (storage_manager.Workspace)
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def to_json(self) -> Dict:
+        return {
+            "job_id": self.job_id,
+            "process_type": self.process_type,
+            "job_status": self.status,
+            "message": self.message,
+            "progress": self.progress,
+        }
+
+class JobStore:
+    def __init__(self, cleanup: Callable[[str], None], result_ttl: float = DEFAULT_RESULT_TTL):
+        self.cleanup = cleanup  # 出力ファイルの削除処理
+        self.result_ttl = result_ttl
+        self._jobs: Dict[str, StoredJob] = {}
+        self._lock = threading.Lock()
+
+    def create(self, process_type: str, client_ip: str, workspace=None) -> StoredJob:
+        job = StoredJob(uuid.uuid4().hex, process_type, client_ip)
+        if workspace:
+            # 接続が終了しても、ジョブが削除されるまで入力・出力を保持する
+            workspace.hold()
+            job.workspace = workspace
+        with self._lock:
+            self._jobs[job.job_id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[StoredJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def mark_running(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job.status = "running"
+
+    def update_progress(self, job_id: str, progress: Dict):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job.progress = progress
+
+    def complete(self, job_id: str, success: bool, message: str, output_file: Optional[str]):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job.status = "done" if success else "failed"
+                job.message = message
+                job.output_file = output_file
+                job.finished_at = time.time()
+                return
+        # ジョブが既に削除されている場合は出力を保持しない
+        if output_file:
+            self.cleanup(output_file)
+
+    def remove(self, job_id: str):
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job:
+            self._discard(job)
+
+    def _discard(self, job: StoredJob):
+        if job.output_file:
+            self.cleanup(job.output_file)
+        if job.workspace:
+            job.workspace.release()
+
+    def expire(self) -> List[str]:
+        # 完了後 result_ttl を過ぎても取得されていないジョブを削除する
+        now = time.time()
+        with self._lock:
+            expired = [job for job in self._jobs.values()
+                       if job.finished_at is not None and now - job.finished_at > self.result_ttl]
+            for job in expired:
+                del self._jobs[job.job_id]
+        for job in expired:
+            self._discard(job)
+        return [job.job_id for job in expired]
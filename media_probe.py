@@ -0,0 +1,166 @@
+import json
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from mmp_protocol import VideoProcessType
+
+MAX_PROBE_CACHE_ENTRIES = 1024  # メモリに保持する入力ファイルの情報の数
+
+# 映像・音声の入力が必要な処理
+VIDEO_PROCESS_TYPES = [VideoProcessType.COMPRESS.value, VideoProcessType.RESIZE_RESOLUTION.value,
+                       VideoProcessType.CHANGE_ASPECT_RATIO.value, VideoProcessType.CREATE_GIF.value,
+                       VideoProcessType.CREATE_WEBM.value]
+AUDIO_PROCESS_TYPES = [VideoProcessType.EXTRACT_AUDIO.value]
+CLIP_PROCESS_TYPES = [VideoProcessType.CREATE_GIF.value, VideoProcessType.CREATE_WEBM.value]
+
+def parse_timestamp(value: str) -> float:
+    # "HH:MM:SS(.ms)" 形式または秒数を秒に変換する
+    seconds = 0.0
+    for part in str(value).split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+def probe_duration(input_file: str) -> float:
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', input_file],
+        capture_output=True, text=True, check=True)
+    return float(result.stdout.strip())
+
+def probe_keyframes(input_file: str) -> List[float]:
+    # パケットのフラグのみを読み、デコードせずに映像のキーフレームの時刻を取得する
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags',
+         '-of', 'csv=p=0', input_file],
+        capture_output=True, text=True, check=True)
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ['', 'N/A']:
+            keyframes.append(float(pts_time))
+    return sorted(keyframes)
+
+def _to_number(value: Any, cast=float) -> Optional[Any]:
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return None
+
+class MediaInfo:
+    # ffprobe で取得した入力ファイルの情報 (コンテナ・最初の映像/音声ストリーム)
+    def __init__(self, probe_result: Dict[str, Any]):
+        format_info = probe_result.get('format', {})
+        streams = probe_result.get('streams', [])
+        # MP3 のカバー画像などは映像ストリームとして扱わない
+        video = next((s for s in streams if s.get('codec_type') == 'video'
+                      and not s.get('disposition', {}).get('attached_pic')), {})
+        audio = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+
+        self.format_name: str = format_info.get('format_name', '')
+        self.duration: Optional[float] = _to_number(format_info.get('duration'))
+        self.video_codec: Optional[str] = video.get('codec_name')
+        self.width: Optional[int] = _to_number(video.get('width'), int)
+        self.height: Optional[int] = _to_number(video.get('height'), int)
+        self.rotation: int = self._rotation(video)
+        self.audio_codec: Optional[str] = audio.get('codec_name')
+        self.sample_rate: Optional[int] = _to_number(audio.get('sample_rate'), int)
+        self.channels: Optional[int] = _to_number(audio.get('channels'), int)
+        self.audio_bit_rate: Optional[int] = _to_number(audio.get('bit_rate'), int)
+        self.keyframes: Optional[List[float]] = None  # 必要になった時に取得する
+
+    @staticmethod
+    def _rotation(stream: Dict[str, Any]) -> int:
+        # 回転情報はバージョンによってタグまたはサイドデータに入っている
+        for side_data in stream.get('side_data_list', []):
+            if 'rotation' in side_data:
+                return int(_to_number(side_data['rotation']) or 0) % 360
+        return int(_to_number(stream.get('tags', {}).get('rotate')) or 0) % 360
+
+def probe_media(input_file: str) -> MediaInfo:
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_format', '-show_streams', '-of', 'json', input_file],
+        capture_output=True, text=True, check=True)
+    return MediaInfo(json.loads(result.stdout))
+
+def input_error(process_type: str, params: Dict[str, Any], info: MediaInfo) -> Optional[str]:
+    # FFmpeg を起動する前に、入力に対して実行できない処理を見つける
+    if process_type in VIDEO_PROCESS_TYPES and not info.video_codec:
+        return "Input has no video stream"
+    if process_type in AUDIO_PROCESS_TYPES and not info.audio_codec:
+        return "Input has no audio stream"
+    if process_type in CLIP_PROCESS_TYPES and info.duration is not None:
+        start_time = params.get('start_time', '00:00:00')
+        try:
+            start_seconds = parse_timestamp(start_time)
+        except ValueError:
+            return f"Invalid start time: {start_time}"
+        if start_seconds >= info.duration:
+            return f"Start time {start_time} is beyond the end of the input ({info.duration:.2f}s)"
+    return None
+
+class MediaProbeCache:
+    # 入力ファイルの情報を入力の SHA-256 ごとに保持し、同じ入力に対して ffprobe を繰り返さない
+    def __init__(self, max_entries: int = MAX_PROBE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        # キー -> 情報 (古い順)。解析できなかった入力は None を保持し、ffprobe を繰り返さない
+        self._entries: "OrderedDict[str, Optional[MediaInfo]]" = OrderedDict()
+        self._input_hashes: Dict[str, str] = {}  # 一時ファイルのパス -> 入力の SHA-256
+        self._lock = threading.Lock()
+
+    def register_input(self, input_file: str, content_hash: Optional[str]):
+        if content_hash:
+            with self._lock:
+                self._input_hashes[os.path.abspath(input_file)] = content_hash
+
+    def forget_input(self, input_file: str):
+        with self._lock:
+            self._input_hashes.pop(os.path.abspath(input_file), None)
+
+    def _key(self, input_file: str) -> Optional[str]:
+        path = os.path.abspath(input_file)
+        with self._lock:
+            content_hash = self._input_hashes.get(path)
+        if content_hash:
+            return content_hash
+        # SHA-256 が分からない入力はパス・サイズ・更新時刻で区別する
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def get(self, input_file: str) -> Optional[MediaInfo]:
+        # 取得できない場合 (ffprobe がない、入力を解析できないなど) は None
+        key = self._key(input_file)
+        if not key:
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        try:
+            info = probe_media(input_file)
+        except OSError as e:
+            # ffprobe がない・ファイルを開けないなどの一時的な失敗は、解消した後に取得し直せるようキャッシュしない
+            print(f"Could not probe {input_file}: {e}")
+            return None
+        except (subprocess.CalledProcessError, ValueError) as e:
+            # 入力を解析できない場合は、同じ入力で何度も ffprobe を実行しないよう None をキャッシュする
+            print(f"Could not probe {input_file}: {e}")
+            info = None
+        with self._lock:
+            self._entries[key] = info
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return info
+
+    def keyframes(self, input_file: str) -> List[float]:
+        # キーフレームの一覧は全パケットを読むため、分割エンコードで必要になった時だけ取得する
+        info = self.get(input_file)
+        if info is None:
+            return probe_keyframes(input_file)
+        if info.keyframes is None:
+            info.keyframes = probe_keyframes(input_file)
+        return info.keyframes
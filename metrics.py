@@ -0,0 +1,211 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, Callable, Dict, List, Optional
+
+# 処理時間のヒストグラムの区切り (秒)。アップロードや FFmpeg は数分かかることもあるため長めまで取る
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[tuple]:
+        # Prometheus の形式 (上限, その値以下の件数) で返す
+        result, total = [], 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "buckets": {str(bound): count for bound, count in self.cumulative()},
+        }
+
+class RequestTrace:
+    # 1つのリクエストの各処理段階の所要時間と送受信量
+    def __init__(self, client_ip: str):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.client_ip = client_ip
+        self.request = None  # 処理タイプまたは操作
+        self.status = None  # 最後に送信したレスポンスの結果 ("ok" またはエラーコード)
+        self.phases: Dict[str, float] = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._start = time.perf_counter()
+
+    def add(self, phase: str, seconds: float):
+        # 分割エンコードなど、同じ段階が複数回ある場合は合計する
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "client_ip": self.client_ip,
+            "request": self.request,
+            "status": self.status,
+            "total_seconds": round(time.perf_counter() - self._start, 6),
+            "phases": {phase: round(seconds, 6) for phase, seconds in self.phases.items()},
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+        }
+
+# 処理中のリクエストのトレース。スレッド・asyncio タスクごとに分かれ、ジョブの実行時にも引き継がれる
+_current_trace: contextvars.ContextVar = contextvars.ContextVar('current_trace', default=None)
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+class Metrics:
+    def __init__(self, trace_log: Optional[str] = None):
+        # trace_log を指定すると、リクエストごとのトレースを JSON Lines で書き出す ("-" は標準出力)
+        self.trace_log = trace_log
+        self._phases: Dict[str, Histogram] = {}
+        self._requests: Dict[str, int] = {}  # 結果 -> 件数
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def observe(self, phase: str, seconds: float):
+        with self._lock:
+            if phase not in self._phases:
+                self._phases[phase] = Histogram()
+            self._phases[phase].observe(seconds)
+        trace = current_trace()
+        if trace:
+            trace.add(phase, seconds)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def add_bytes_received(self, size: int):
+        with self._lock:
+            self.bytes_received += size
+        trace = current_trace()
+        if trace:
+            trace.bytes_received += size
+
+    def add_bytes_sent(self, size: int):
+        with self._lock:
+            self.bytes_sent += size
+        trace = current_trace()
+        if trace:
+            trace.bytes_sent += size
+
+    def start_trace(self, client_ip: str) -> RequestTrace:
+        trace = RequestTrace(client_ip)
+        _current_trace.set(trace)
+        return trace
+
+    def finish_trace(self, trace: RequestTrace):
+        _current_trace.set(None)
+        if trace.status is None:
+            return  # レスポンスを送らずに終わった接続は数えない
+        with self._lock:
+            self._requests[trace.status] = self._requests.get(trace.status, 0) + 1
+            if self.trace_log:
+                line = json.dumps(trace.to_json())
+                if self.trace_log == '-':
+                    print(f"trace {line}")
+                else:
+                    with open(self.trace_log, 'a') as f:
+                        f.write(line + '\n')
+
+    def to_json(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "phases": {phase: histogram.to_json() for phase, histogram in self._phases.items()},
+                "requests": dict(self._requests),
+                "bytes_received": self.bytes_received,
+                "bytes_sent": self.bytes_sent,
+            }
+
+    def render_prometheus(self, gauges: Dict[str, Any]) -> str:
+        # gauges はサーバーの現在の状態 (名前 -> 値、またはラベル値 -> 値の dict)
+        lines = [
+            '# HELP mmp_phase_seconds Time spent in each phase of request handling',
+            '# TYPE mmp_phase_seconds histogram',
+        ]
+        with self._lock:
+            for phase, histogram in sorted(self._phases.items()):
+                for bound, count in histogram.cumulative():
+                    lines.append(f'mmp_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {count}')
+                lines.append(f'mmp_phase_seconds_sum{{phase="{phase}"}} {histogram.sum}')
+                lines.append(f'mmp_phase_seconds_count{{phase="{phase}"}} {histogram.count}')
+            lines.append('# TYPE mmp_requests_total counter')
+            for status, count in sorted(self._requests.items()):
+                lines.append(f'mmp_requests_total{{status="{status}"}} {count}')
+            lines.append('# TYPE mmp_received_bytes_total counter')
+            lines.append(f'mmp_received_bytes_total {self.bytes_received}')
+            lines.append('# TYPE mmp_sent_bytes_total counter')
+            lines.append(f'mmp_sent_bytes_total {self.bytes_sent}')
+        for name, value in gauges.items():
+            lines.append(f'# TYPE mmp_{name} gauge')
+            if isinstance(value, dict):
+                # ラベル付きの値 (IP アドレスごとの処理数など)
+                label, values = value['label'], value['values']
+                for label_value, count in sorted(values.items()):
+                    lines.append(f'mmp_{name}{{{label}="{label_value}"}} {count}')
+            else:
+                lines.append(f'mmp_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+def directory_size(path: str) -> int:
+    # 一時ファイルの合計サイズ。走査中に削除されたファイルは数えない
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def start_http_endpoint(host: str, port: int, render: Callable[[], str]) -> HTTPServer:
+    # Prometheus が収集する /metrics をバックグラウンドのスレッドで提供する
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', PROMETHEUS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    http_server = _ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return http_server
@@ -0,0 +1,298 @@
+import itertools
+import socket
+import threading
+from typing import Callable, Dict, List, Optional
+
+from mmp_protocol import MMPMessage, ConnectionOperation, HEADER_SIZE, recv_exact
+
+# 多重化した接続では、各フレームを JSON に stream_id を持つ MMP メッセージとして送る。
+# フレームのペイロードはそのストリーム上の通常の MMP メッセージのバイト列の一部で、
+# JSON の "window" は受信側が読み出したバイト数 (送信側はその分だけ追加で送信できる)、
+# "close" はそれ以上送信しないこと、"reset" はストリームの中断を表す。
+# ストリームを開く側は、ストリームIDの昇順に JSON が stream_id のみのフレームを送って開始を通知する
+MUX_FRAME_SIZE = 256 * 1024  # 1フレームで送るデータの上限 (他のストリームのフレームを挟めるように分割する)
+MUX_WINDOW_SIZE = 2 * 1024 * 1024  # 受信側の通知を待たずに送信できるストリームごとのデータ量
+DEFAULT_MAX_STREAMS = 16  # 1つの接続で同時に開けるストリーム数
+DEFAULT_POOL_CONNECTIONS = 2
+
+class MultiplexNotSupportedError(Exception):
+    pass
+
+class MuxStream:
+    # 多重化した接続上の1つのストリーム。ソケットと同じ recv/sendall/sendfile/close で読み書きできる
+    def __init__(self, connection: 'MultiplexedConnection', stream_id: int):
+        self.connection = connection
+        self.stream_id = stream_id
+        self._buffer = bytearray()
+        self._condition = threading.Condition()
+        self._send_window = MUX_WINDOW_SIZE
+        self._consumed = 0  # 読み出したが、まだ相手に通知していないバイト数
+        self._recv_window = MUX_WINDOW_SIZE  # 相手がこちらの通知を待たずに送信できる残りのバイト数
+        self._remote_closed = False
+        self._local_closed = False
+        self._reset: Optional[str] = None
+        self._timeout: Optional[float] = None
+
+    def settimeout(self, timeout: Optional[float]):
+        self._timeout = timeout
+
+    def recv(self, size: int) -> bytes:
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._buffer or self._remote_closed or self._reset, self._timeout):
+                raise socket.timeout("timed out")
+            if self._reset:
+                raise ConnectionResetError(self._reset)
+            # 相手が送信を終えていて未読のデータもなければ、ソケットと同様に b"" を返す
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            self._consumed += len(data)
+            window = 0
+            if self._consumed >= MUX_WINDOW_SIZE // 2:
+                window, self._consumed = self._consumed, 0
+                self._recv_window += window
+        if window:
+            self.connection.send_frame({"stream_id": self.stream_id, "window": window})
+        return data
+
+    def sendall(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            with self._condition:
+                if not self._condition.wait_for(
+                        lambda: self._send_window > 0 or self._reset or self._local_closed, self._timeout):
+                    raise socket.timeout("timed out")
+                if self._reset:
+                    raise ConnectionResetError(self._reset)
+                if self._local_closed:
+                    raise OSError("Stream is closed")
+                size = min(len(view), self._send_window, MUX_FRAME_SIZE)
+                self._send_window -= size
+            self.connection.send_frame({"stream_id": self.stream_id}, view[:size])
+            view = view[size:]
+
+    def sendfile(self, file, offset: int = 0, count: Optional[int] = None) -> int:
+        # フレームに分割して送るため、os.sendfile によるゼロコピー送信はできない
+        file.seek(offset)
+        sent = 0
+        while count is None or sent < count:
+            block = file.read(MUX_FRAME_SIZE if count is None else min(MUX_FRAME_SIZE, count - sent))
+            if not block:
+                break
+            self.sendall(block)
+            sent += len(block)
+        return sent
+
+    def shutdown(self, how: int):
+        # ソケットと同じく、ブロックしている送受信を中断させる (多重化したストリームでは片方向のみの終了はしない)
+        self.close()
+
+    def close(self):
+        with self._condition:
+            if self._local_closed:
+                return
+            self._local_closed = True
+            reset = self._reset
+            self._condition.notify_all()
+        if not reset:
+            try:
+                self.connection.send_frame({"stream_id": self.stream_id, "close": True})
+            except OSError:
+                pass
+        self.connection._remove_if_finished(self)
+
+    def _on_frame(self, frame: MMPMessage) -> Optional[str]:
+        # 受信スレッドから呼ばれる。ストリームを中断させる必要がある場合はその理由を返す
+        with self._condition:
+            if 'reset' in frame.json_data:
+                self._reset = frame.json_data['reset'] or "Stream reset by peer"
+            if 'window' in frame.json_data:
+                self._send_window += int(frame.json_data['window'])
+            error = None
+            if frame.payload:
+                if self._local_closed:
+                    # 処理を終えたストリームへの送信は中断させる
+                    error = "Stream closed"
+                elif len(frame.payload) > self._recv_window:
+                    # 通知した量を超えて送られたデータはバッファに溜めない
+                    error = "Flow control window exceeded"
+                else:
+                    self._recv_window -= len(frame.payload)
+                    self._buffer.extend(frame.payload)
+            if frame.json_data.get('close'):
+                self._remote_closed = True
+            self._condition.notify_all()
+        return error
+
+    def _fail(self, reason: str):
+        with self._condition:
+            if not self._reset:
+                self._reset = reason
+            self._condition.notify_all()
+
+    def _finished(self) -> bool:
+        with self._condition:
+            return self._local_closed and (self._remote_closed or self._reset is not None)
+
+class MultiplexedConnection:
+    # 1つの TCP 接続で複数のリクエストを並行してやり取りする。
+    # on_stream を指定した場合 (サーバー側) は、相手が開いたストリームをそれぞれ別のスレッドで処理する
+    def __init__(self, sock, max_streams: int = DEFAULT_MAX_STREAMS,
+                 on_stream: Optional[Callable[[MuxStream], None]] = None):
+        self.sock = sock
+        self.max_streams = max_streams
+        self.on_stream = on_stream
+        self.closed = False
+        self._streams: Dict[int, MuxStream] = {}
+        self._stream_ids = itertools.count(1)
+        self._last_stream_id = 0  # 相手が最後に開いたストリームのID
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def active_streams(self) -> int:
+        with self._lock:
+            return len(self._streams)
+
+    def open_stream(self) -> MuxStream:
+        # 相手は以前のIDのフレームを終了したストリームのものとして無視するため、
+        # IDの割り当てと開始の通知を送信ロックの中で行い、IDの順に届くようにする
+        with self._send_lock:
+            with self._lock:
+                if self.closed:
+                    raise ConnectionError("Multiplexed connection is closed")
+                stream = MuxStream(self, next(self._stream_ids))
+                self._streams[stream.stream_id] = stream
+            try:
+                self._write_frame({"stream_id": stream.stream_id})
+            except OSError:
+                with self._lock:
+                    self._streams.pop(stream.stream_id, None)
+                raise
+        return stream
+
+    def send_frame(self, json_data: dict, data: bytes = b""):
+        with self._send_lock:
+            self._write_frame(json_data, data)
+
+    def _write_frame(self, json_data: dict, data: bytes = b""):
+        header_bytes, body_bytes = MMPMessage(json_data, "", data)._encode_header_and_body()
+        self.sock.sendall(header_bytes + body_bytes)
+        if data:
+            self.sock.sendall(data)
+
+    def start(self):
+        # クライアント側ではフレームの受信を別スレッドで行う
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        # 接続が閉じられるまでフレームを受信し、各ストリームに振り分ける
+        try:
+            while True:
+                header_bytes = recv_exact(self.sock, HEADER_SIZE)
+                frame, _ = MMPMessage.decode_body_from_socket(self.sock, header_bytes)
+                if frame.payload_size > MUX_FRAME_SIZE:
+                    # 上限を超えるフレームはメモリに読み込まず、接続ごと閉じる
+                    raise ValueError(f"Frame of {frame.payload_size} bytes exceeds {MUX_FRAME_SIZE} bytes")
+                if frame.payload_size:
+                    frame.payload = recv_exact(self.sock, frame.payload_size)
+                self._dispatch(frame)
+        except (OSError, ValueError) as e:
+            self._shutdown(f"Connection lost: {e}")
+
+    def _dispatch(self, frame: MMPMessage):
+        stream_id = frame.json_data.get('stream_id')
+        accepted_stream = None
+        with self._lock:
+            stream = self._streams.get(stream_id)
+            if stream is None:
+                # 終了したストリームに遅れて届いたフレームは無視する
+                if self.on_stream is None or not isinstance(stream_id, int) or stream_id <= self._last_stream_id:
+                    return
+                self._last_stream_id = stream_id
+                if len(self._streams) < self.max_streams:
+                    stream = accepted_stream = MuxStream(self, stream_id)
+                    self._streams[stream_id] = stream
+        if stream is None:
+            self.send_frame({"stream_id": stream_id, "reset": "Too many streams"})
+            return
+        if accepted_stream:
+            threading.Thread(target=self._serve_stream, args=(accepted_stream,), daemon=True).start()
+        error = stream._on_frame(frame)
+        if error:
+            stream._fail(error)
+            self.send_frame({"stream_id": stream_id, "reset": error})
+        self._remove_if_finished(stream)
+
+    def _serve_stream(self, stream: MuxStream):
+        try:
+            self.on_stream(stream)
+        finally:
+            stream.close()
+
+    def _remove_if_finished(self, stream: MuxStream):
+        if stream._finished():
+            with self._lock:
+                self._streams.pop(stream.stream_id, None)
+
+    def _shutdown(self, reason: str):
+        with self._lock:
+            self.closed = True
+            streams = list(self._streams.values())
+            self._streams.clear()
+        for stream in streams:
+            stream._fail(reason)
+        self.close()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class MMPConnectionPool:
+    # 同じサーバーへの多重化した接続を保持し、リクエストごとにストリームを割り当てる。
+    # 接続の確立 (TCP ハンドシェイク) はストリームが足りなくなった時だけ行う
+    def __init__(self, host: str, port: int, max_connections: int = DEFAULT_POOL_CONNECTIONS):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self._connections: List[MultiplexedConnection] = []
+        self._condition = threading.Condition()
+
+    def _connect(self) -> MultiplexedConnection:
+        sock = socket.create_connection((self.host, self.port))
+        try:
+            MMPMessage({"operation": ConnectionOperation.MULTIPLEX.value}, "json").encode_to_socket(sock)
+            response, _ = MMPMessage.decode_body_from_socket(sock, recv_exact(sock, HEADER_SIZE))
+            if response.payload_size:
+                recv_exact(sock, response.payload_size)
+        except OSError:
+            sock.close()
+            raise
+        if "error_code" in response.json_data:
+            sock.close()
+            raise MultiplexNotSupportedError(response.json_data.get('solution', ''))
+        connection = MultiplexedConnection(sock, int(response.json_data.get('max_streams', DEFAULT_MAX_STREAMS)))
+        connection.start()
+        return connection
+
+    def open_stream(self) -> MuxStream:
+        # 最も空いている接続にストリームを開く。全ての接続が上限に達している場合は新しく接続するか、空くまで待つ
+        with self._condition:
+            while True:
+                self._connections = [c for c in self._connections if not c.closed]
+                available = [c for c in self._connections if c.active_streams() < c.max_streams]
+                if available:
+                    return min(available, key=lambda c: c.active_streams()).open_stream()
+                if len(self._connections) < self.max_connections:
+                    connection = self._connect()
+                    self._connections.append(connection)
+                    return connection.open_stream()
+                # ストリームの終了は各接続の受信スレッドで処理されるため、一定間隔で確認する
+                self._condition.wait(0.05)
+
+    def close(self):
+        with self._condition:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
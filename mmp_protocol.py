@@ -1,7 +1,36 @@
+import asyncio
+import hashlib
+import io
 import json
+import os
 import struct
+import zlib
 from enum import Enum
-from typing import Dict, Any, Tuple
+from typing import Dict, Any, Tuple, Optional, Callable, Iterator, AsyncIterator, List
+
+HEADER_SIZE = 8
+DEFAULT_CHUNK_SIZE = 1400  # flow_chart.md の 1400 バイト単位の送受信
+MAX_PAYLOAD_SIZE = (1 << 40) - 1  # 5バイトで表現できる最大値 (約1TB)
+
+# メディアタイプサイズの上位3ビットはフラグとして使う (メディアタイプは31バイトまで)
+FLAG_CHECKSUM = 0x80  # ペイロードをブロックに分け、各ブロックに CRC32 を付ける
+FLAG_COMPRESSED = 0x40  # ペイロードのブロックを zlib で圧縮する (小さくならないブロックはそのまま送る)
+FLAG_COMPRESSED_JSON = 0x20  # JSON が zlib で圧縮されている
+PAYLOAD_FLAGS = FLAG_CHECKSUM | FLAG_COMPRESSED
+MAX_MEDIA_TYPE_SIZE = 0x1F
+# フラグ付きのペイロードは「4バイトのブロック長 + データ (+ 4バイトの CRC32)」の繰り返し。
+# ブロック長の最上位ビットは圧縮したブロックを表し、ヘッダーのペイロードサイズは元のデータのサイズ
+PAYLOAD_BLOCK_SIZE = 64 * 1024  # 圧縮・チェックサムの単位 (元のデータのサイズ)
+MAX_WIRE_BLOCK_SIZE = PAYLOAD_BLOCK_SIZE + 1024  # 圧縮で大きくなる分を含めたブロック長の上限
+BLOCK_COMPRESSED = 0x80000000
+BLOCK_HEADER_SIZE = 4
+CHECKSUM_SIZE = 4
+COMPRESSION_LEVEL = 1  # 転送量より CPU 時間を優先する
+MIN_COMPRESSION_RATIO = 0.9  # これ以上小さくならないデータ (圧縮済みの動画など) は以降のブロックも圧縮しない
+MIN_COMPRESS_JSON_SIZE = 1024  # これより小さい JSON (進捗など) は圧縮しない
+MAX_JSON_SIZE = 1024 * 1024  # 展開後の JSON の上限
+
+ProgressCallback = Callable[[int, int], None]  # (転送済みバイト数, 総バイト数)
 
 class MediaType(Enum):
     MP4 = "mp4"
@@ -9,31 +38,156 @@ class MediaType(Enum):
     GIF = "gif"
     WEBM = "webm"
     JSON = "json"
+    TXT = "txt"
+
+class ChecksumError(ValueError):
+    pass
+
+def check_media_type(media_type: str):
+    # メディアタイプサイズの上位3ビットをフラグに使うため、32バイト以上のメディアタイプは送れない
+    size = len(media_type.encode('utf-8'))
+    if size > MAX_MEDIA_TYPE_SIZE:
+        raise ValueError(f"Media type too long: {size} bytes (max {MAX_MEDIA_TYPE_SIZE})")
 
 class MMPHeader:
-    def __init__(self, json_size: int, media_type_size: int, payload_size: int):
+    def __init__(self, json_size: int, media_type_size: int, payload_size: int, flags: int = 0):
+        if media_type_size > MAX_MEDIA_TYPE_SIZE:
+            # 上位ビットに入るとフラグとして解釈されるため、送信前に拒否する
+            raise ValueError(f"Media type too long: {media_type_size} bytes (max {MAX_MEDIA_TYPE_SIZE})")
         self.json_size = json_size  # JSONサイズバイト (max 64KB)
-        self.media_type_size = media_type_size  # メディアタイプサイズバイト (max 255)
+        self.media_type_size = media_type_size  # メディアタイプサイズバイト (max 31)
         self.payload_size = payload_size  # プレイロードサイズバイト (max 1TB)
+        self.flags = flags  # FLAG_* の組み合わせ
 
     @classmethod
     def from_bytes(cls, header_bytes: bytes) -> 'MMPHeader':
         json_size = struct.unpack('!H', header_bytes[0:2])[0]  # unsigned short (2バイト)
-        media_type_size = struct.unpack('!B', header_bytes[2:3])[0]  # unsigned char (1バイト)
-        payload_size = struct.unpack('!Q', header_bytes[3:8])[0]  # unsigned long long (5バイト使用)
-        return cls(json_size, media_type_size, payload_size)
+        media_type_byte = struct.unpack('!B', header_bytes[2:3])[0]  # unsigned char (1バイト)
+        payload_size = int.from_bytes(header_bytes[3:8], 'big')  # 5バイト
+        flags = media_type_byte & ~MAX_MEDIA_TYPE_SIZE
+        return cls(json_size, media_type_byte & MAX_MEDIA_TYPE_SIZE, payload_size, flags)
 
     def to_bytes(self) -> bytes:
-        return struct.pack('!HBQ', 
-                         self.json_size,
-                         self.media_type_size,  
-                         self.payload_size)
+        if self.payload_size > MAX_PAYLOAD_SIZE:
+            raise ValueError(f"Payload too large: {self.payload_size} bytes")
+        return struct.pack('!HB', self.json_size, self.media_type_size | self.flags) + \
+            self.payload_size.to_bytes(5, 'big')
+
+class PayloadEncoder:
+    # 送信するペイロードをブロックごとに圧縮し、チェックサムを付ける
+    def __init__(self, flags: int):
+        self.checksum = bool(flags & FLAG_CHECKSUM)
+        self.compress = bool(flags & FLAG_COMPRESSED)
+
+    def encode(self, block: bytes) -> bytes:
+        data, length = block, len(block)
+        if self.compress:
+            compressed = zlib.compress(block, COMPRESSION_LEVEL)
+            if len(compressed) < len(block) * MIN_COMPRESSION_RATIO:
+                data, length = compressed, len(compressed) | BLOCK_COMPRESSED
+            else:
+                self.compress = False
+        trailer = struct.pack('!I', zlib.crc32(block)) if self.checksum else b""
+        return struct.pack('!I', length) + data + trailer
+
+class PayloadDecoder:
+    # ブロック単位で受信したペイロードを展開し、チェックサムを検証する。
+    # 壊れたブロックは書き込む前に検出するため、残りのペイロードを受信せずに中断できる
+    def __init__(self, flags: int, payload_size: int):
+        self.checksum = bool(flags & FLAG_CHECKSUM)
+        self.remaining = payload_size
+        self.received = 0
+
+    def block_size(self, block_header: bytes) -> Tuple[int, bool]:
+        # ブロック長から、続けて読み込むバイト数 (チェックサムを含む) と圧縮の有無を返す
+        value = struct.unpack('!I', block_header)[0]
+        size = value & ~BLOCK_COMPRESSED
+        if size == 0 or size > MAX_WIRE_BLOCK_SIZE:
+            raise ValueError(f"Invalid payload block size: {size}")
+        return size + (CHECKSUM_SIZE if self.checksum else 0), bool(value & BLOCK_COMPRESSED)
+
+    def decode(self, data: bytes, compressed: bool) -> bytes:
+        if self.checksum:
+            data, expected = data[:-CHECKSUM_SIZE], struct.unpack('!I', data[-CHECKSUM_SIZE:])[0]
+        block = data
+        if compressed:
+            decompressor = zlib.decompressobj()
+            try:
+                block = decompressor.decompress(data, PAYLOAD_BLOCK_SIZE)
+            except zlib.error as e:
+                raise ChecksumError(f"Corrupt compressed block at byte {self.received}: {e}")
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ChecksumError(f"Corrupt compressed block at byte {self.received}")
+        if len(block) > self.remaining:
+            raise ValueError("Payload blocks exceed the declared payload size")
+        if self.checksum and zlib.crc32(block) != expected:
+            raise ChecksumError(f"Checksum mismatch in payload block at byte {self.received}")
+        self.remaining -= len(block)
+        self.received += len(block)
+        return block
+
+def recv_exact(sock, size: int) -> bytes:
+    # recv は要求サイズより短いデータを返すことがあるため、揃うまで繰り返す
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError(f"Connection closed after {len(buffer)} of {size} bytes")
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+def iter_socket_payload(sock, payload_size: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+    # ペイロードを chunk_size 単位で読み出す。メモリ使用量はペイロードサイズに依存しない
+    remaining = payload_size
+    while remaining > 0:
+        chunk = sock.recv(min(chunk_size, remaining))
+        if not chunk:
+            raise ConnectionError(f"Connection closed with {remaining} payload bytes remaining")
+        remaining -= len(chunk)
+        yield chunk
+
+def iter_framed_payload(read_exact: Callable[[int], bytes], flags: int, payload_size: int) -> Iterator[bytes]:
+    # フラグ付きのペイロードをブロックごとに展開・検証して返す (read_exact は指定サイズを読み込む関数)
+    decoder = PayloadDecoder(flags, payload_size)
+    while decoder.remaining > 0:
+        size, compressed = decoder.block_size(read_exact(BLOCK_HEADER_SIZE))
+        yield decoder.decode(read_exact(size), compressed)
+
+async def iter_framed_stream_payload(reader, flags: int, payload_size: int) -> AsyncIterator[bytes]:
+    # iter_framed_payload の asyncio の StreamReader 版
+    decoder = PayloadDecoder(flags, payload_size)
+    while decoder.remaining > 0:
+        size, compressed = decoder.block_size(await read_exact_async(reader, BLOCK_HEADER_SIZE))
+        yield decoder.decode(await read_exact_async(reader, size), compressed)
+
+async def iter_stream_payload(reader, payload_size: int, chunk_size: int = DEFAULT_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    # iter_socket_payload の asyncio の StreamReader 版
+    remaining = payload_size
+    while remaining > 0:
+        chunk = await reader.read(min(chunk_size, remaining))
+        if not chunk:
+            raise ConnectionError(f"Connection closed with {remaining} payload bytes remaining")
+        remaining -= len(chunk)
+        yield chunk
 
 class MMPMessage:
-    def __init__(self, json_data: Dict[str, Any], media_type: str, payload: bytes):
+    def __init__(self, json_data: Dict[str, Any], media_type: str, payload: bytes = b"",
+                 payload_path: Optional[str] = None, payload_size: Optional[int] = None,
+                 payload_offset: int = 0):
         self.json_data = json_data
         self.media_type = media_type
         self.payload = payload
+        # payload_path が指定されている場合、ペイロードはメモリではなくファイル上にある
+        self.payload_path = payload_path
+        self.payload_offset = payload_offset  # ファイルのこの位置以降をペイロードとして送る
+        if payload_size is None:
+            payload_size = os.path.getsize(payload_path) - payload_offset if payload_path else len(payload)
+        self.payload_size = payload_size
+        self.payload_hash: Optional[str] = None  # 受信時に計算したペイロードのハッシュ値 (16進数)
+        # 送信時はペイロードのチェックサム・圧縮 (PAYLOAD_FLAGS)、受信時は受信したペイロードの形式。
+        # FLAG_COMPRESSED を指定すると、大きな JSON も圧縮する
+        self.flags = 0
+        self.parts: List['MMPMessage'] = []  # 複数の処理結果を返すレスポンスで、先に受信した各パート
 
     @classmethod
     def create_error_message(cls, error_code: int, description: str, solution: str) -> 'MMPMessage':
@@ -44,24 +198,281 @@ class MMPMessage:
         }
         return cls(error_json, "json", b"")
 
-    def encode(self) -> Tuple[bytes, bytes, bytes]:
+    @classmethod
+    def from_file(cls, json_data: Dict[str, Any], media_type: str, payload_path: str,
+                  payload_offset: int = 0) -> 'MMPMessage':
+        # 大きなファイルを読み始める前に、送れないメディアタイプを拒否する
+        check_media_type(media_type)
+        return cls(json_data, media_type, payload_path=payload_path, payload_offset=payload_offset)
+
+    def _encode_header_and_body(self) -> Tuple[bytes, bytes]:
         json_bytes = json.dumps(self.json_data).encode('utf-8')
         media_type_bytes = self.media_type.encode('utf-8')
-        
+        # ペイロードがなくても、相手がレスポンスで同じ形式を使えるようにフラグを送る
+        flags = self.flags & PAYLOAD_FLAGS
+        if self.flags & FLAG_COMPRESSED and len(json_bytes) >= MIN_COMPRESS_JSON_SIZE:
+            compressed = zlib.compress(json_bytes, COMPRESSION_LEVEL)
+            if len(compressed) < len(json_bytes):
+                json_bytes = compressed
+                flags |= FLAG_COMPRESSED_JSON
+
         header = MMPHeader(
             len(json_bytes),
             len(media_type_bytes),
-            len(self.payload)
+            self.payload_size,
+            flags
         )
-        
-        return header.to_bytes(), json_bytes + media_type_bytes, self.payload
+        return header.to_bytes(), json_bytes + media_type_bytes
+
+    def _iter_payload_blocks(self, block_size: int = PAYLOAD_BLOCK_SIZE) -> Iterator[bytes]:
+        if self.payload_path:
+            with open(self.payload_path, 'rb') as f:
+                f.seek(self.payload_offset)
+                remaining = self.payload_size
+                while remaining > 0:
+                    block = f.read(min(block_size, remaining))
+                    if not block:
+                        raise ValueError(f"{self.payload_path} is shorter than the payload size")
+                    remaining -= len(block)
+                    yield block
+        else:
+            view = memoryview(self.payload)
+            for offset in range(0, len(view), block_size):
+                yield bytes(view[offset:offset + block_size])
+
+    def _iter_framed_blocks(self) -> Iterator[Tuple[bytes, int]]:
+        # フラグ付きのペイロードの送信用。(送信するバイト列, 送信済みの元のデータのサイズ) を返す
+        encoder = PayloadEncoder(self.flags)
+        sent = 0
+        for block in self._iter_payload_blocks():
+            sent += len(block)
+            yield encoder.encode(block), sent
+
+    def encode(self) -> Tuple[bytes, bytes, bytes]:
+        header_bytes, body_bytes = self._encode_header_and_body()
+        if self.flags & PAYLOAD_FLAGS:
+            return header_bytes, body_bytes, b"".join(data for data, _ in self._iter_framed_blocks())
+        if self.payload_path:
+            with open(self.payload_path, 'rb') as f:
+                f.seek(self.payload_offset)
+                return header_bytes, body_bytes, f.read(self.payload_size)
+        return header_bytes, body_bytes, self.payload
+
+    def encode_to_socket(self, sock, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                         progress_callback: Optional[ProgressCallback] = None):
+        header_bytes, body_bytes = self._encode_header_and_body()
+        sock.sendall(header_bytes + body_bytes)
+
+        if self.flags & PAYLOAD_FLAGS:
+            # ブロックごとに加工するため、sendfile によるゼロコピー送信は行わない
+            for data, sent in self._iter_framed_blocks():
+                sock.sendall(data)
+                if progress_callback:
+                    progress_callback(self.payload_offset + sent, self.payload_offset + self.payload_size)
+        elif self.payload_path:
+            with open(self.payload_path, 'rb') as f:
+                send_file(sock, f, self.payload_size, chunk_size, progress_callback, self.payload_offset)
+        elif self.payload:
+            view = memoryview(self.payload)
+            for offset in range(0, len(view), chunk_size):
+                sock.sendall(view[offset:offset + chunk_size])
+                if progress_callback:
+                    progress_callback(min(offset + chunk_size, len(view)), len(view))
 
     @classmethod
     def decode(cls, header_bytes: bytes, body_bytes: bytes, payload_bytes: bytes) -> 'MMPMessage':
         header = MMPHeader.from_bytes(header_bytes)
-        json_data = json.loads(body_bytes[:header.json_size].decode('utf-8'))
+        json_data, media_type = cls._decode_body(header, body_bytes)
+        if header.flags & PAYLOAD_FLAGS:
+            buffer = io.BytesIO(payload_bytes)
+
+            def read_exact(size: int) -> bytes:
+                data = buffer.read(size)
+                if len(data) < size:
+                    raise ValueError("Truncated payload block")
+                return data
+            payload_bytes = b"".join(iter_framed_payload(read_exact, header.flags, header.payload_size))
+        message = cls(json_data, media_type, payload_bytes)
+        message.flags = header.flags & PAYLOAD_FLAGS
+        return message
+
+    @staticmethod
+    def _decode_body(header: MMPHeader, body_bytes: bytes) -> Tuple[Dict[str, Any], str]:
+        json_bytes = body_bytes[:header.json_size]
+        if header.flags & FLAG_COMPRESSED_JSON:
+            decompressor = zlib.decompressobj()
+            json_bytes = decompressor.decompress(json_bytes, MAX_JSON_SIZE)
+            if decompressor.unconsumed_tail:
+                raise ValueError(f"JSON exceeds {MAX_JSON_SIZE} bytes")
+        json_data = json.loads(json_bytes.decode('utf-8'))
         media_type = body_bytes[header.json_size:header.json_size + header.media_type_size].decode('utf-8')
-        return cls(json_data, media_type, payload_bytes)
+        return json_data, media_type
+
+    @classmethod
+    def _from_header(cls, header: MMPHeader, body_bytes: bytes) -> 'MMPMessage':
+        json_data, media_type = cls._decode_body(header, body_bytes)
+        message = cls(json_data, media_type, b"", payload_size=header.payload_size)
+        message.flags = header.flags & PAYLOAD_FLAGS
+        return message
+
+    @classmethod
+    def decode_body_from_socket(cls, sock, header_bytes: bytes) -> Tuple['MMPMessage', MMPHeader]:
+        # JSON とメディアタイプのみを受信し、ペイロードは未読のまま残す
+        header = MMPHeader.from_bytes(header_bytes)
+        body_bytes = recv_exact(sock, header.json_size + header.media_type_size)
+        return cls._from_header(header, body_bytes), header
+
+    def iter_payload_from_socket(self, sock, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[bytes]:
+        # 未読のペイロードを読み出す。フラグ付きの場合はブロックごとに展開・検証した元のデータを返す
+        if self.flags & PAYLOAD_FLAGS:
+            return iter_framed_payload(lambda size: recv_exact(sock, size), self.flags, self.payload_size)
+        return iter_socket_payload(sock, self.payload_size, chunk_size)
+
+    def iter_payload_from_stream(self, reader, chunk_size: int = DEFAULT_CHUNK_SIZE) -> AsyncIterator[bytes]:
+        if self.flags & PAYLOAD_FLAGS:
+            return iter_framed_stream_payload(reader, self.flags, self.payload_size)
+        return iter_stream_payload(reader, self.payload_size, chunk_size)
+
+    @classmethod
+    def decode_from_socket(cls, sock, header_bytes: bytes,
+                           payload_path_factory: Optional[Callable[[Dict[str, Any], str], str]] = None,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE,
+                           progress_callback: Optional[ProgressCallback] = None,
+                           hash_algorithm: Optional[str] = None) -> 'MMPMessage':
+        message, header = cls.decode_body_from_socket(sock, header_bytes)
+        payload_path = None
+        if payload_path_factory is not None and header.payload_size > 0:
+            payload_path = payload_path_factory(message.json_data, message.media_type)
+        message.read_payload_from_socket(sock, payload_path, chunk_size, progress_callback, hash_algorithm)
+        return message
+
+    def read_payload_from_socket(self, sock, payload_path: Optional[str] = None,
+                                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                                 progress_callback: Optional[ProgressCallback] = None,
+                                 hash_algorithm: Optional[str] = None,
+                                 payload_offset: Optional[int] = None):
+        # payload_offset を指定すると、既存ファイルのその位置から続きを書き込む (再開可能なアップロード用)
+        if self.payload_size == 0:
+            return
+        with PayloadWriter(self, payload_path, hash_algorithm, payload_offset, progress_callback) as writer:
+            for chunk in self.iter_payload_from_socket(sock, chunk_size):
+                writer.write(chunk)
+
+    @classmethod
+    async def decode_body_from_stream(cls, reader, header_bytes: bytes) -> Tuple['MMPMessage', MMPHeader]:
+        # asyncio の StreamReader 版。JSON とメディアタイプのみを受信する
+        header = MMPHeader.from_bytes(header_bytes)
+        body_bytes = await read_exact_async(reader, header.json_size + header.media_type_size)
+        return cls._from_header(header, body_bytes), header
+
+    async def read_payload_from_stream(self, reader, payload_path: Optional[str] = None,
+                                       chunk_size: int = DEFAULT_CHUNK_SIZE,
+                                       hash_algorithm: Optional[str] = None,
+                                       payload_offset: Optional[int] = None):
+        if self.payload_size == 0:
+            return
+        with PayloadWriter(self, payload_path, hash_algorithm, payload_offset) as writer:
+            async for chunk in self.iter_payload_from_stream(reader, chunk_size):
+                writer.write(chunk)
+
+    async def encode_to_stream(self, writer, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        header_bytes, body_bytes = self._encode_header_and_body()
+        writer.write(header_bytes + body_bytes)
+        if self.flags & PAYLOAD_FLAGS:
+            for data, _ in self._iter_framed_blocks():
+                writer.write(data)
+                await writer.drain()
+        elif self.payload_path:
+            # loop.sendfile は可能な場合 os.sendfile によるゼロコピー送信を行う
+            with open(self.payload_path, 'rb') as f:
+                await writer.drain()
+                await asyncio.get_event_loop().sendfile(writer.transport, f, self.payload_offset, self.payload_size)
+        elif self.payload:
+            view = memoryview(self.payload)
+            for offset in range(0, len(view), chunk_size):
+                writer.write(view[offset:offset + chunk_size])
+                await writer.drain()
+        await writer.drain()
+
+class PayloadWriter:
+    # 受信したペイロードをファイル (またはメモリ) に書き込み、必要に応じてハッシュ値を計算する
+    def __init__(self, message: MMPMessage, payload_path: Optional[str], hash_algorithm: Optional[str] = None,
+                 payload_offset: Optional[int] = None, progress_callback: Optional[ProgressCallback] = None):
+        self.message = message
+        self.payload_path = payload_path
+        self.payload_offset = payload_offset
+        self.resume = payload_offset is not None
+        # 受信しながらハッシュ値を計算する (再読み込み不要)。再開時は一部しか受信しないため計算しない
+        self.hasher = hashlib.new(hash_algorithm) if hash_algorithm and not self.resume else None
+        self.progress_callback = progress_callback
+        self.received = 0
+        self._file = None
+        self._chunks: list = []
+
+    def __enter__(self) -> 'PayloadWriter':
+        if self.payload_path:
+            self.message.payload_path = self.payload_path
+            self._file = open(self.payload_path, 'r+b' if self.resume else 'wb')
+            if self.resume:
+                self._file.seek(self.payload_offset)
+                self._file.truncate()
+        return self
+
+    def write(self, chunk: bytes):
+        if self._file:
+            self._file.write(chunk)
+        else:
+            # ファイルの保存先が指定されていない場合はメモリ上に受信する (JSON レスポンス等の小さいメッセージ向け)
+            self._chunks.append(chunk)
+        if self.hasher:
+            self.hasher.update(chunk)
+        self.received += len(chunk)
+        if self.progress_callback:
+            self.progress_callback(self.received, self.message.payload_size)
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._file:
+            self._file.close()
+            # 再開可能なアップロードでは受信済みの部分を残す
+            if exc_type and not self.resume and os.path.exists(self.payload_path):
+                os.remove(self.payload_path)
+        else:
+            self.message.payload = b"".join(self._chunks)
+        if not exc_type and self.hasher:
+            self.message.payload_hash = self.hasher.hexdigest()
+        return False
+
+async def read_exact_async(reader, size: int) -> bytes:
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError(f"Connection closed after {len(e.partial)} of {size} bytes")
+
+def hash_file(path: str, algorithm: str = 'sha256', block_size: int = 1024 * 1024) -> str:
+    hasher = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def content_proof(nonce: str, data: bytes) -> str:
+    # アップロードを省略する場合に、サーバーが指定した範囲のデータを保持していることを示す
+    return hashlib.sha256(nonce.encode('ascii') + data).hexdigest()
+
+def send_file(sock, f, size: int, chunk_size: int = DEFAULT_CHUNK_SIZE,
+              progress_callback: Optional[ProgressCallback] = None, offset: int = 0):
+    # socket.sendfile は利用可能なら os.sendfile によるゼロコピー送信を行う
+    if progress_callback is None:
+        sock.sendfile(f, offset, size)
+        return
+
+    # 進捗表示が必要な場合は一定サイズごとに sendfile を呼び出す
+    block_size = max(chunk_size, 1024 * 1024)
+    sent = 0
+    while sent < size:
+        count = min(block_size, size - sent)
+        sent += sock.sendfile(f, offset + sent, count)
+        progress_callback(offset + sent, offset + size)
 
 # 動画処理タイプの定義
 class VideoProcessType(Enum):
@@ -71,3 +482,28 @@ class VideoProcessType(Enum):
     EXTRACT_AUDIO = "extract_audio"
     CREATE_GIF = "create_gif"
     CREATE_WEBM = "create_webm"
+
+# 非同期ジョブAPIの操作 (JSON の "operation" で指定する)
+class JobOperation(Enum):
+    SUBMIT_JOB = "submit_job"
+    JOB_STATUS = "job_status"
+    FETCH_RESULT = "fetch_result"
+
+# 転送に関する操作 (JSON の "operation" で指定する)
+class TransferOperation(Enum):
+    CHECK_CONTENT = "check_content"  # ハッシュ値を送り、サーバーが入力・出力を保持しているか確認する
+    UPLOAD_INIT = "upload_init"  # 再開可能なアップロードを開始し、アップロードIDを受け取る
+    UPLOAD_STATUS = "upload_status"  # 受信済みのオフセットを確認する
+
+# コーディネーターとワーカーノード間の操作 (JSON の "operation" で指定する)
+class WorkerOperation(Enum):
+    REGISTER_WORKER = "register_worker"  # ワーカーの登録・ハートビート (処理能力と負荷を送る)
+    WORKER_STATUS = "worker_status"  # ノードの負荷 (コーディネーターの場合は登録済みワーカーの一覧も) を確認する
+
+# 接続に関する操作 (JSON の "operation" で指定する)
+class ConnectionOperation(Enum):
+    MULTIPLEX = "multiplex"  # 以降、この接続ではストリームIDで区別した複数のリクエストを並行してやり取りする (mmp_mux.py)
+
+# 監視用の操作 (JSON の "operation" で指定する)
+class MonitoringOperation(Enum):
+    STATS = "stats"  # 処理段階ごとの所要時間・送受信量・待ち行列などの統計を取得する
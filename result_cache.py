@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# 処理結果に影響しないリクエストのキーはキャッシュキーに含めない
+NON_CACHE_KEY_PARAMS = {'process_type', 'operation', 'report_progress', 'job_id', 'stream',
+                        'content_hash', 'content_proof', 'payload_size', 'upload_id', 'upload_offset'}
+
+def normalize_params(params: Dict[str, Any]) -> str:
+    filtered = {k: v for k, v in params.items() if k not in NON_CACHE_KEY_PARAMS}
+    return json.dumps(filtered, sort_keys=True, separators=(',', ':'))
+
+def cache_key(input_hash: str, process_type: str, params: Dict[str, Any]) -> str:
+    key_source = f"{input_hash}\0{process_type}\0{normalize_params(params)}"
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+def input_key(content_hash: str) -> str:
+    # アップロードされた入力ファイルも同じキャッシュに保持し、再アップロードを省略できるようにする
+    return f"input_{content_hash}"
+
+def link_or_copy(source: str, destination: str):
+    # 同じファイルシステム上ではハードリンクでコピーを避ける
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+class ResultCache:
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, str]" = OrderedDict()  # キー -> ファイルパス (古い順)
+        self._sizes: Dict[str, int] = {}
+        self._total_size = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._load_entries()
+
+    def _load_entries(self):
+        # 再起動後も既存のキャッシュを最終利用時刻順に復元する
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)]
+        paths = [path for path in paths if os.path.isfile(path)]
+        for path in sorted(paths, key=os.path.getmtime):
+            key = os.path.basename(path).split('.')[0]
+            self._add_entry(key, path)
+        self._evict()
+
+    def _add_entry(self, key: str, path: str):
+        size = os.path.getsize(path)
+        self._entries[key] = path
+        self._sizes[key] = size
+        self._total_size += size
+
+    def _remove_entry(self, key: str):
+        path = self._entries.pop(key)
+        self._total_size -= self._sizes.pop(key)
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Error removing cache entry {path}: {e}")
+
+    def _evict(self):
+        # 上限を超えた分を最も長く使われていないものから削除する
+        while self._total_size > self.max_size and self._entries:
+            self._remove_entry(next(iter(self._entries)))
+
+    def total_size(self) -> int:
+        with self._lock:
+            return self._total_size
+
+    def contains(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def entry_size(self, key: str) -> Optional[int]:
+        with self._lock:
+            return self._sizes.get(key)
+
+    def get(self, key: str, dest_dir: str) -> Optional[str]:
+        # ヒットした場合はキャッシュを dest_dir にリンクし、そのパスを返す
+        with self._lock:
+            path = self._entries.get(key)
+            if not path:
+                return None
+            extension = path.split('.')[-1]
+            destination = os.path.join(dest_dir, f'cached_{uuid.uuid4().hex}.{extension}')
+            try:
+                link_or_copy(path, destination)
+            except OSError as e:
+                print(f"Error reading cache entry {path}: {e}")
+                self._remove_entry(key)
+                return None
+            self._entries.move_to_end(key)
+            os.utime(path)
+            return destination
+
+    def read(self, key: str, offset: int, size: int) -> Optional[bytes]:
+        # エントリをリンクせずに一部だけ読む (アップロードを省略するクライアントの確認用)
+        with self._lock:
+            path = self._entries.get(key)
+        if not path:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                return f.read(size)
+        except OSError:
+            # 読み込み中に削除された
+            return None
+
+    def put(self, key: str, source_file: str):
+        size = os.path.getsize(source_file)
+        if size > self.max_size:
+            return
+        extension = source_file.split('.')[-1]
+        path = os.path.join(self.cache_dir, f'{key}.{extension}')
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            try:
+                link_or_copy(source_file, path)
+            except OSError as e:
+                print(f"Error storing cache entry {path}: {e}")
+                return
+            self._add_entry(key, path)
+            self._evict()
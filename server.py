@@ -1,22 +1,100 @@
+import contextvars
+import hmac
+import ipaddress
+import itertools
+import secrets
 import socket
 import threading
 import os
 import argparse
+import time
+import uuid
 from datetime import datetime
-from typing import Dict, Set
-from mmp_protocol import MMPMessage, VideoProcessType
-from video_processor import VideoProcessor
+from typing import Dict, Set, Tuple
+from mmp_protocol import (MMPMessage, MMPHeader, PayloadWriter, VideoProcessType, JobOperation, TransferOperation,
+                          WorkerOperation, MonitoringOperation, ConnectionOperation, HEADER_SIZE, DEFAULT_CHUNK_SIZE, recv_exact,
+                          ChecksumError, content_proof)
+from video_processor import (VideoProcessor, PIPE_PROBE_SIZE, ENCODER_PROFILES, DEFAULT_PROFILE, DEFAULT_MAX_PROFILE,
+                             input_requires_seeking)
+from job_scheduler import JobScheduler, QueueFullError, job_priority, DEFAULT_MAX_QUEUE_SIZE
+from job_store import JobStore, DEFAULT_RESULT_TTL
+from result_cache import ResultCache, cache_key, input_key
+from upload_manager import UploadManager, UploadError
+from worker_pool import WorkerPool, DEFAULT_DISPATCH_SLOTS
+from metrics import Metrics, current_trace, directory_size, start_http_endpoint
+from storage_manager import StorageManager, StorageQuotaError, current_workspace, workspace_dir
+from mmp_mux import MultiplexedConnection, MuxStream, DEFAULT_MAX_STREAMS
+
+DEFAULT_MAX_STORAGE = 4 * 1024 * 1024 * 1024 * 1024  # 4TB
+# アップロードを省略するクライアントには、保持している入力のランダムな範囲のハッシュ値を求める。
+# ハッシュ値を知っているだけでは、他のユーザーの入力を処理させたり結果を取得したりできない
+CONTENT_PROOF_SIZE = 64 * 1024
+CONTENT_CHALLENGE_TTL = 300  # 確認に使う範囲を通知してから、リクエストを受け付けるまでの時間 (秒)
+MAX_CONTENT_CHALLENGES = 10000  # 使われていない確認の範囲を保持する数 (超えた分は古いものから破棄する)
+
+# 最終的な結果ではないレスポンス (トレースの結果として記録しない)
+INTERMEDIATE_STATUSES = ['progress', 'chunk', 'part']
+
+# クライアントがリクエストで指定したペイロードの形式 (チェックサム・圧縮)。レスポンスも同じ形式で送る
+_response_flags: contextvars.ContextVar = contextvars.ContextVar('response_flags', default=0)
+# リクエストが確保した IP アドレスごとの処理枠 (解放済みの場合は空のリスト)
+_client_slot: contextvars.ContextVar = contextvars.ContextVar('client_slot', default=None)
 
 class VideoProcessingServer:
-    def __init__(self, host='localhost', port=8000):
+    def __init__(self, host='localhost', port=8000, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_workers=None, max_queue_size=DEFAULT_MAX_QUEUE_SIZE, result_ttl=DEFAULT_RESULT_TTL,
+                 cache_dir='cache', cache_size=None, coordinator=False,
+                 default_profile=DEFAULT_PROFILE, max_profile=DEFAULT_MAX_PROFILE,
+                 metrics_port=None, trace_log=None, max_storage=DEFAULT_MAX_STORAGE, worker_secret=None):
         self.host = host
         self.port = port
-        self.max_storage = 4 * 1024 * 1024 * 1024 * 1024  # 4TB
+        self.chunk_size = chunk_size  # ソケット送受信の単位 (バイト)
+        self.max_storage = max_storage  # 一時ファイルと処理結果のキャッシュの合計の上限
         self.server_socket = None
         self.running = False
         self.active_clients: Dict[str, int] = {}  # IP address -> active processes count
-        self.video_processor = VideoProcessor()
+        self.metrics = Metrics(trace_log)
+        self.metrics_port = metrics_port  # Prometheus 形式の /metrics を提供する HTTP ポート
+        self.video_processor = VideoProcessor(metrics=self.metrics)
+        # キャッシュは max_storage の一部を使い、残りを一時ファイルの上限とする。
+        # 一時ファイルの分が残るよう、キャッシュは max_storage の半分までとする
+        if cache_size is None:
+            cache_size = self.max_storage // 4
+        if cache_size > self.max_storage // 2:
+            print(f"Cache size limited to {self.max_storage // 2} bytes (half of the storage limit)")
+            cache_size = self.max_storage // 2
+        # 受信前に容量を確保し、リクエストごとのワークスペースに一時ファイルを置く
+        self.storage = StorageManager(self.video_processor.temp_dir, self.max_storage - cache_size,
+                                      instance=str(port))
+        # 前回の実行で異常終了したジョブの一時ファイルを削除する
+        removed = self.storage.collect_orphans(startup=True)
+        if removed:
+            print(f"Removed {len(removed)} orphaned temp files")
         self.processing_files: Set[str] = set()
+        if coordinator and max_workers is None:
+            # コーディネーターでは FFmpeg を実行しないため、CPU 数ではなく割り当て待ちのジョブ数で決める
+            max_workers = DEFAULT_DISPATCH_SLOTS
+        self.scheduler = self._create_scheduler(max_workers, max_queue_size)
+        self.result_cache = ResultCache(cache_dir, cache_size)
+        self.job_store = JobStore(self.video_processor.cleanup_temp_file, result_ttl=result_ttl)
+        self.upload_manager = UploadManager(os.path.join(self.video_processor.temp_dir, 'uploads'))
+        self.transfer_operations = [op.value for op in TransferOperation]
+        self.worker_operations = [op.value for op in WorkerOperation]
+        # コーディネーターとして動作する場合は、登録されたワーカーノードに処理を割り当てる
+        self.worker_pool = WorkerPool(self.video_processor) if coordinator else None
+        # ワーカーの登録に必要な共有シークレット (None の場合は同じマシンのワーカーのみ登録できる)
+        self.worker_secret = worker_secret
+        self.expire_interval = 60  # 期限切れの処理結果を確認する間隔 (秒)
+        self.max_pipeline_operations = 8  # 1つのリクエストで指定できる処理の数
+        self.default_profile = default_profile  # プロファイルが指定されなかった場合に使う
+        self.max_profile = max_profile  # 1つのリクエストが遅いプロファイルで CPU を占有しないよう上限を設ける
+        self.max_streams_per_connection = DEFAULT_MAX_STREAMS  # 多重化した接続で同時に処理するリクエストの数
+        # 入力の保持の確認に使う範囲 (nonce -> (ハッシュ値, オフセット, サイズ, 期限))
+        self._content_challenges: Dict[str, Tuple[str, int, int, float]] = {}
+        self._challenge_lock = threading.Lock()
+
+    def _create_scheduler(self, max_workers, max_queue_size):
+        return JobScheduler(max_workers=max_workers, max_queue_size=max_queue_size, metrics=self.metrics)
 
     def _can_process_request(self, client_ip: str) -> bool:
       # 一つのクライアントから同時に1つの処理のみ受け付ける
@@ -28,76 +106,334 @@ class VideoProcessingServer:
     def _remove_client_process(self, client_ip: str):
         self.active_clients[client_ip] = max(0, self.active_clients.get(client_ip, 0) - 1)
 
+    def _hold_client_slot(self, client_ip: str):
+        self._add_client_process(client_ip)
+        _client_slot.set([client_ip])
+
+    def _release_client_slot(self):
+        # 最終的なレスポンスの送信前と処理の終了時の両方から呼ばれるため、解放は1回のみ行う
+        slot = _client_slot.get()
+        if slot:
+            self._remove_client_process(slot.pop())
+
     def handle_client(self, client_socket: socket.socket, address: tuple):
         client_ip = address[0]
+        message = None
+        trace = self.metrics.start_trace(client_ip)
         try:
             # ヘッダーを受信（8バイト）
-            header_bytes = client_socket.recv(8)
-            if not header_bytes or len(header_bytes) != 8:
-                return
+            header_bytes = recv_exact(client_socket, HEADER_SIZE)
 
             # ボディとペイロードを受信
             message = self._receive_message(client_socket, header_bytes)
             if not message:
                 return
 
+            if message.json_data.get('operation') == ConnectionOperation.MULTIPLEX.value:
+                trace.request = message.json_data['operation']
+                self._serve_multiplexed(client_socket, address)
+                return
+
+            # 重複確認・アップロード再開の問い合わせに応答した後、同じ接続で本来のリクエストを受け取る
+            while message.json_data.get('operation') in self.transfer_operations:
+                self._handle_transfer_operation(client_socket, message)
+                try:
+                    header_bytes = recv_exact(client_socket, HEADER_SIZE)
+                except ConnectionError:
+                    # 問い合わせの結果 (容量不足など) を受けて、クライアントがリクエストを送らずに終了した
+                    return
+                message = self._receive_message(client_socket, header_bytes)
+                if not message:
+                    return
+
+            # 非同期ジョブの状態確認・結果取得は処理枠を消費しない
+            operation = message.json_data.get('operation')
+            trace.request = self._trace_request(message)
+            if operation in self.worker_operations:
+                self._send_message(client_socket, self._worker_operation_response(message, client_ip))
+                return
+            if operation == MonitoringOperation.STATS.value:
+                self._send_message(client_socket, self._stats_response(message))
+                return
+            if operation == JobOperation.JOB_STATUS.value:
+                self._send_job_status(client_socket, message)
+                return
+            if operation == JobOperation.FETCH_RESULT.value:
+                self._send_job_result(client_socket, message)
+                return
+
             # リクエストを処理
             if not self._can_process_request(client_ip):
+                self._discard_unread_payload(client_socket, message)
                 self._send_error(client_socket, 429, "Too many requests", "Please wait for your current process to complete")
                 return
 
-            self._add_client_process(client_ip)
+            if operation == JobOperation.SUBMIT_JOB.value:
+                self._submit_job(client_socket, message, client_ip)
+                return
+
+            self._hold_client_slot(client_ip)
             try:
-                self._process_request(client_socket, message)
+                if self._is_stream_request(message):
+                    self._process_stream_request(client_socket, message)
+                else:
+                    self._process_request(client_socket, message)
             finally:
-                self._remove_client_process(client_ip)
+                self._release_client_slot()
 
+        except ChecksumError as e:
+            print(f"Corrupt transfer from {address}: {e}")
+            self._send_message(client_socket, self._corrupt_transfer_response(e))
         except Exception as e:
             print(f"Error handling client {address}: {e}")
             self._send_error(client_socket, 500, "Internal server error", str(e))
         finally:
+            # 処理されなかったアップロードも含めて受信済みファイルを削除
+            if message and message.payload_path:
+                self.video_processor.cleanup_temp_file(message.payload_path)
             client_socket.close()
+            self._release_workspace()
+            self.metrics.finish_trace(trace)
+
+    def _serve_multiplexed(self, client_socket: socket.socket, address: tuple):
+        # 接続を閉じるまで、各ストリームを通常の接続と同じく handle_client で処理する。
+        # 1つの IP アドレスから同時に1つの処理のみ受け付ける制限はストリームにも適用される
+        if isinstance(client_socket, MuxStream):
+            self._send_error(client_socket, 400, "Invalid request", "Multiplexing cannot be nested")
+            return
+        self._send_message(client_socket, MMPMessage({
+            "status": "success",
+            "max_streams": self.max_streams_per_connection,
+        }, "json"))
+        connection = MultiplexedConnection(client_socket, self.max_streams_per_connection,
+                                           on_stream=lambda stream: self.handle_client(stream, address))
+        connection.run()
+
+    def _trace_request(self, message: MMPMessage) -> str:
+        if 'operations' in message.json_data:
+            return 'pipeline'
+        return message.json_data.get('operation') or message.json_data.get('process_type')
 
     def _receive_message(self, client_socket: socket.socket, header_bytes: bytes) -> MMPMessage:
+        start = time.perf_counter()
+        message = self._read_message(client_socket, header_bytes)
+        # ストリーミング処理のペイロードは処理しながら受信するため、ここでは数えない
+        if message and not self._is_stream_request(message):
+            self._observe_receive(header_bytes, start)
+        return message
+
+    def _observe_receive(self, header_bytes: bytes, start: float):
+        # 再開したアップロードでは、この接続で受信した分のみ数える
+        payload_size = MMPHeader.from_bytes(header_bytes).payload_size
+        if payload_size > 0:
+            self.metrics.observe('receive', time.perf_counter() - start)
+            self.metrics.add_bytes_received(payload_size)
+
+    def _read_message(self, client_socket: socket.socket, header_bytes: bytes) -> MMPMessage:
         try:
-            message = MMPMessage.decode_from_socket(client_socket, header_bytes)
+            message, _ = MMPMessage.decode_body_from_socket(client_socket, header_bytes)
+            _response_flags.set(message.flags)
+            error = self._reserve_workspace(message)
+            if error:
+                # クライアントはペイロードを送り終えてからレスポンスを読むため、保存せずに読み捨てる
+                for _ in message.iter_payload_from_socket(client_socket, self.chunk_size):
+                    pass
+                self._send_message(client_socket, error)
+                return None
+            if 'upload_offset' in message.json_data:
+                return self._receive_resumable_upload(client_socket, message)
+            if self._is_stream_request(message):
+                # ペイロードは _process_stream_request で受信しながら FFmpeg に渡す
+                return message
+
+            # ペイロードはメモリに保持せず、一時ファイルへ直接書き込む
+            payload_path = self._generate_temp_path(message.media_type) if message.payload_size > 0 else None
+            message.read_payload_from_socket(
+                client_socket, payload_path,
+                chunk_size=self.chunk_size,
+                hash_algorithm='sha256'  # 処理結果キャッシュのキーに使う
+            )
+            # ハッシュ値のみ送られてきた場合は、入力を保持していることを確認できればそのハッシュ値を入力のハッシュとして扱う
+            if message.payload_size == 0 and message.json_data.get('content_hash') and self._verify_content_proof(message):
+                message.payload_hash = message.json_data['content_hash']
             return message
+        except UploadError as e:
+            self._send_error(client_socket, 409, "Upload error", str(e))
+            return None
+        except ChecksumError as e:
+            # 壊れたブロックを受信した時点で中断し、残りのペイロードは受信しない
+            print(f"Corrupt upload: {e}")
+            self._send_message(client_socket, self._corrupt_transfer_response(e))
+            return None
         except Exception as e:
             print(f"Error receiving message: {e}")
             return None
 
+    def _corrupt_transfer_response(self, error: ChecksumError) -> MMPMessage:
+        return MMPMessage.create_error_message(400, "Corrupt transfer", f"{error}. Please send the file again")
+
+    def _reserve_workspace(self, message: MMPMessage) -> MMPMessage:
+        # 処理のリクエストは、ペイロードを受信する前に入力と出力の分の容量を確保する
+        operation = message.json_data.get('operation')
+        if operation is not None and operation != JobOperation.SUBMIT_JOB.value:
+            return None
+        outputs = len(message.json_data.get('operations') or [None])
+        try:
+            self.storage.reserve(self.storage.reservation_size(self._input_size(message), outputs))
+        except StorageQuotaError as e:
+            return self._insufficient_storage_response(str(e))
+        return None
+
+    def _input_size(self, message: MMPMessage) -> int:
+        if 'upload_offset' in message.json_data:
+            # 再開したアップロードでは、この接続で受信する分ではなく入力全体のサイズ
+            meta = self.upload_manager.get(message.json_data.get('upload_id', ''))
+            return meta['payload_size'] if meta else message.payload_size
+        if message.payload_size == 0 and message.json_data.get('content_hash'):
+            return self.result_cache.entry_size(input_key(message.json_data['content_hash'])) or 0
+        return message.payload_size
+
+    def _insufficient_storage_response(self, reason: str) -> MMPMessage:
+        return MMPMessage.create_error_message(507, "Insufficient storage",
+                                               f"{reason}. Please retry later or send a smaller file")
+
+    def _release_workspace(self):
+        workspace = current_workspace()
+        if workspace:
+            workspace.release()
+
+    def _receive_resumable_upload(self, client_socket: socket.socket, message: MMPMessage) -> MMPMessage:
+        # 受信したデータはアップロードIDごとのファイルに追記し、接続が切れても残す
+        upload_id = message.json_data['upload_id']
+        offset = int(message.json_data.get('upload_offset', 0))
+        part_path = self.upload_manager.begin_receive(upload_id, offset, message.payload_size)
+        try:
+            message.read_payload_from_socket(client_socket, part_path, chunk_size=self.chunk_size,
+                                             payload_offset=offset)
+        finally:
+            self.upload_manager.end_receive(upload_id)
+        return self._finalize_resumable_upload(message)
+
+    def _handle_transfer_operation(self, client_socket: socket.socket, message: MMPMessage):
+        self._send_message(client_socket, self._transfer_operation_response(message))
+
+    def _transfer_operation_response(self, message: MMPMessage) -> MMPMessage:
+        operation = message.json_data.get('operation')
+        if operation == TransferOperation.CHECK_CONTENT.value:
+            return self._content_status_response(message)
+        if operation == TransferOperation.UPLOAD_INIT.value:
+            # 容量が足りない場合は、アップロードを始める前に拒否する
+            try:
+                self.storage.check(self.storage.reservation_size(int(message.json_data['payload_size'])))
+            except StorageQuotaError as e:
+                return self._insufficient_storage_response(str(e))
+            meta = self.upload_manager.create(message.json_data['content_hash'],
+                                              int(message.json_data['payload_size']),
+                                              message.json_data.get('media_type', 'mp4'))
+            return self._upload_status_response(meta['upload_id'])
+        upload_id = message.json_data.get('upload_id', '')
+        if not self.upload_manager.get(upload_id):
+            return MMPMessage.create_error_message(404, "Upload not found", "Please start a new upload")
+        return self._upload_status_response(upload_id)
+
+    def _upload_status_response(self, upload_id: str) -> MMPMessage:
+        self.upload_manager.wait_idle(upload_id)
+        return MMPMessage({
+            "status": "success",
+            "upload_id": upload_id,
+            "offset": self.upload_manager.committed_offset(upload_id),
+        }, "json")
+
+    def _finalize_resumable_upload(self, message: MMPMessage) -> MMPMessage:
+        # 全データが揃ったらハッシュ値を検証し、処理用の一時ファイルとして扱う
+        upload_id = message.json_data['upload_id']
+        meta = self.upload_manager.get(upload_id)
+        input_file = self._generate_temp_path(meta['media_type'])
+        self.upload_manager.finalize(upload_id, input_file)
+        message.payload_path = input_file
+        message.payload_size = meta['payload_size']
+        message.payload_hash = meta['content_hash']
+        return message
+
+    def _validate_process_type(self, client_socket: socket.socket, message: MMPMessage) -> str:
+        error = self._process_type_error(message)
+        if error:
+            self._send_message(client_socket, error)
+            return None
+        return message.json_data['process_type']
+
+    def _process_type_error(self, message: MMPMessage) -> MMPMessage:
+        return self._operation_error(message.json_data)
+
+    def _operation_error(self, params: dict) -> MMPMessage:
+        process_type = params.get('process_type')
+        if not process_type:
+            return MMPMessage.create_error_message(400, "Missing process type", "Please specify a process type")
+        if process_type not in [t.value for t in VideoProcessType]:
+            return MMPMessage.create_error_message(400, "Invalid process type", "Please specify a valid process type")
+        profile = params.get('profile')
+        if profile is not None and profile not in ENCODER_PROFILES:
+            return MMPMessage.create_error_message(400, "Invalid profile",
+                                                   f"Please specify one of: {', '.join(ENCODER_PROFILES)}")
+        if process_type == VideoProcessType.EXTRACT_AUDIO.value:
+            # 音声抽出の結果はプロファイルによらないため、キャッシュを共有できるよう取り除く
+            params.pop('profile', None)
+        else:
+            # 上限を適用したプロファイルに置き換え、キャッシュキーと処理の両方で同じ値を使う
+            params['profile'] = self._effective_profile(profile)
+        return None
+
+    def _effective_profile(self, requested: str) -> str:
+        profile = requested or self.default_profile
+        return ENCODER_PROFILES[min(ENCODER_PROFILES.index(profile), ENCODER_PROFILES.index(self.max_profile))]
+
     def _process_request(self, client_socket: socket.socket, message: MMPMessage):
-        process_type = message.json_data.get('process_type')
+        if 'operations' in message.json_data:
+            self._process_pipeline_request(client_socket, message)
+            return
+
+        process_type = self._validate_process_type(client_socket, message)
         if not process_type:
-            self._send_error(client_socket, 400, "Missing process type", "Please specify a process type")
+            return
+
+        # 同じ入力・同じパラメータの処理結果がキャッシュにあれば FFmpeg を実行しない
+        cache_key = self._result_cache_key(process_type, message)
+        output_file = self._get_cached_result(cache_key)
+        if output_file:
+            try:
+                self._send_processed_file(client_socket, output_file)
+            finally:
+                self.video_processor.cleanup_temp_file(output_file)
             return
 
         # 一時ファイルを保存
-        input_file = self._save_temp_file(message.payload, message.media_type)
+        input_file = self._save_temp_file(message)
+        if not input_file:
+            self._send_content_unavailable(client_socket)
+            return
         try:
-            # プロセスタイプに応じた処理を実行
-            if process_type == VideoProcessType.COMPRESS.value:
-                success, msg, output_file = self.video_processor.compress_video(input_file)
-            elif process_type == VideoProcessType.RESIZE_RESOLUTION.value:
-                width = message.json_data.get('width', 1920)
-                height = message.json_data.get('height', 1080)
-                success, msg, output_file = self.video_processor.resize_resolution(input_file, width, height)
-            elif process_type == VideoProcessType.CHANGE_ASPECT_RATIO.value:
-                aspect_ratio = message.json_data.get('aspect_ratio', '16:9')
-                success, msg, output_file = self.video_processor.change_aspect_ratio(input_file, aspect_ratio)
-            elif process_type == VideoProcessType.EXTRACT_AUDIO.value:
-                success, msg, output_file = self.video_processor.extract_audio(input_file)
-            elif process_type in [VideoProcessType.CREATE_GIF.value, VideoProcessType.CREATE_WEBM.value]:
-                start_time = message.json_data.get('start_time', '00:00:00')
-                duration = message.json_data.get('duration', '00:00:10')
-                if process_type == VideoProcessType.CREATE_GIF.value:
-                    success, msg, output_file = self.video_processor.create_gif(input_file, start_time, duration)
-                else:
-                    success, msg, output_file = self.video_processor.create_webm(input_file, start_time, duration)
-            else:
-                self._send_error(client_socket, 400, "Invalid process type", "Please specify a valid process type")
+            error = self._input_error(input_file, [message.json_data])
+            if error:
+                self._send_message(client_socket, error)
                 return
 
+            # クライアントが要求した場合は FFmpeg の進捗をフレームとして送信する
+            progress_callback = None
+            if message.json_data.get('report_progress'):
+                progress_callback = lambda progress: self._send_progress(client_socket, progress)
+
+            # FFmpeg の実行はワーカープールに任せ、同時実行数を制限する
+            try:
+                job = self.scheduler.submit(
+                    lambda threads: self._run_processing(
+                        process_type, input_file, message.json_data, cache_key, threads, progress_callback),
+                    priority=job_priority(process_type, message.json_data)
+                )
+            except QueueFullError:
+                self._send_message(client_socket, self._busy_response())
+                return
+
+            success, msg, output_file = job.wait()
             if success and output_file:
                 self._send_processed_file(client_socket, output_file)
             else:
@@ -109,41 +445,515 @@ class VideoProcessingServer:
             if output_file:
                 self.video_processor.cleanup_temp_file(output_file)
 
-    def _save_temp_file(self, payload: bytes, media_type: str) -> str:
+    def _process_pipeline_request(self, client_socket: socket.socket, message: MMPMessage):
+        # 複数の処理を1回のアップロード・1回の FFmpeg 実行 (デコードは1回) で行い、結果をパートごとに返す
+        error = self._pipeline_error(message)
+        if error:
+            self._send_message(client_socket, error)
+            return
+        operations = message.json_data['operations']
+
+        # キャッシュ済みの結果は再利用し、残りの処理だけを FFmpeg で実行する
+        keys = [self._result_cache_key(operation['process_type'], message, operation) for operation in operations]
+        output_files = [self._get_cached_result(key) for key in keys]
+        pending = [i for i, output_file in enumerate(output_files) if not output_file]
+        input_file = None
+        try:
+            if pending:
+                input_file = self._save_temp_file(message)
+                if not input_file:
+                    self._send_content_unavailable(client_socket)
+                    return
+                error = self._input_error(input_file, [operations[i] for i in pending])
+                if error:
+                    self._send_message(client_socket, error)
+                    return
+
+                progress_callback = None
+                if message.json_data.get('report_progress'):
+                    progress_callback = lambda progress: self._send_progress(client_socket, progress)
+                try:
+                    job = self.scheduler.submit(
+                        lambda threads: self._run_pipeline(
+                            input_file, [operations[i] for i in pending], [keys[i] for i in pending],
+                            threads, progress_callback),
+                        priority=self._pipeline_priority(operations)
+                    )
+                except QueueFullError:
+                    self._send_message(client_socket, self._busy_response())
+                    return
+
+                success, msg, processed_files = job.wait()
+                if not success:
+                    self._send_error(client_socket, 500, "Processing failed", msg)
+                    return
+                for i, output_file in zip(pending, processed_files):
+                    output_files[i] = output_file
+
+            for index, output_file in enumerate(output_files):
+                if not self._send_message(client_socket, self._pipeline_part_message(index, operations[index], output_file)):
+                    return
+            self._send_message(client_socket, self._pipeline_complete_message(operations))
+        finally:
+            if input_file:
+                self.video_processor.cleanup_temp_file(input_file)
+            for output_file in output_files:
+                if output_file:
+                    self.video_processor.cleanup_temp_file(output_file)
+
+    def _input_error(self, input_file: str, operations: list) -> MMPMessage:
+        # 入力の長さを超える開始位置など、入力に対して実行できない処理は待ち行列に入れる前に拒否する
+        for params in operations:
+            error = self.video_processor.check_input(params['process_type'], input_file, params)
+            if error:
+                return MMPMessage.create_error_message(400, "Invalid request for input", error)
+        return None
+
+    def _pipeline_error(self, message: MMPMessage) -> MMPMessage:
+        operations = message.json_data.get('operations')
+        if not isinstance(operations, list) or not operations:
+            return MMPMessage.create_error_message(400, "Missing operations", "Please specify a list of operations")
+        if len(operations) > self.max_pipeline_operations:
+            return MMPMessage.create_error_message(
+                400, "Too many operations", f"Please request at most {self.max_pipeline_operations} operations at once")
+        for operation in operations:
+            if not isinstance(operation, dict):
+                return MMPMessage.create_error_message(400, "Invalid operation", "Each operation must be a JSON object")
+            # リクエスト全体に指定されたプロファイルは、個別に指定のない処理に適用する
+            if message.json_data.get('profile') is not None:
+                operation.setdefault('profile', message.json_data['profile'])
+            error = self._operation_error(operation)
+            if error:
+                return error
+        return None
+
+    def _pipeline_priority(self, operations: list) -> int:
+        # 最も重い処理に合わせる
+        return max(job_priority(operation['process_type'], operation) for operation in operations)
+
+    def _run_pipeline(self, input_file: str, operations: list, keys: list, threads: int, progress_callback=None):
+        success, msg, output_files = self._run_locally(lambda local_threads: self.video_processor.process_pipeline(
+            input_file, operations, local_threads, progress_callback), threads)
+        self._cache_pipeline_results(keys, output_files)
+        return success, msg, output_files
+
+    def _cache_pipeline_results(self, keys: list, output_files: list):
+        for key, output_file in zip(keys, output_files):
+            if key:
+                self.result_cache.put(key, output_file)
+
+    def _pipeline_part_message(self, index: int, operation: dict, output_file: str) -> MMPMessage:
+        return MMPMessage.from_file(
+            json_data={"status": "part", "index": index, "process_type": operation['process_type']},
+            media_type=output_file.split('.')[-1],
+            payload_path=output_file
+        )
+
+    def _pipeline_complete_message(self, operations: list) -> MMPMessage:
+        return MMPMessage({"status": "success", "parts": len(operations)}, "json")
+
+    def _is_stream_request(self, message: MMPMessage) -> bool:
+        # アップロードを一時ファイルに保存せず、FFmpeg の標準入力に直接渡すリクエスト
+        return (bool(message.json_data.get('stream')) and message.payload_size > 0
+                and 'operation' not in message.json_data and 'operations' not in message.json_data
+                and 'upload_offset' not in message.json_data)
+
+    def _discard_unread_payload(self, client_socket: socket.socket, message: MMPMessage):
+        # クライアントはペイロードを送り終えてからレスポンスを読むため、未受信の分を読み捨ててから応答する
+        if self._is_stream_request(message) and not message.payload_path:
+            for _ in message.iter_payload_from_socket(client_socket, self.chunk_size):
+                pass
+
+    def _process_stream_request(self, client_socket: socket.socket, message: MMPMessage):
+        error = self._process_type_error(message)
+        if error:
+            self._discard_unread_payload(client_socket, message)
+            self._send_message(client_socket, error)
+            return
+        process_type = message.json_data['process_type']
+        self.metrics.add_bytes_received(message.payload_size)
+
+        remaining = message.iter_payload_from_socket(client_socket, self.chunk_size)
+        head = bytearray()
+        for chunk in remaining:
+            head.extend(chunk)
+            if len(head) >= min(PIPE_PROBE_SIZE, message.payload_size):
+                break
+        head = bytes(head)
+        if input_requires_seeking(head, message.media_type):
+            # moov アトムが末尾にある MP4 などは、従来どおり一時ファイルに保存してから処理する
+            with PayloadWriter(message, self._generate_temp_path(message.media_type), 'sha256') as writer:
+                writer.write(head)
+                for chunk in remaining:
+                    writer.write(chunk)
+            self._process_request(client_socket, message)
+            return
+
+        input_chunks = itertools.chain([head], remaining)
+
+        def run(threads):
+            command, media_type = self.video_processor.build_pipe_command(process_type, message.json_data, threads)
+            return self.video_processor.run_pipe_command(
+                command, input_chunks, lambda chunk: self._send_stream_chunk(client_socket, media_type, chunk)
+            ) + (media_type,)
+
+        try:
+            job = self.scheduler.submit(lambda threads: self._run_locally(run, threads),
+                                        priority=job_priority(process_type, message.json_data))
+        except QueueFullError:
+            for _ in input_chunks:
+                pass
+            self._send_message(client_socket, self._busy_response())
+            return
+
+        try:
+            success, msg, media_type = job.wait()
+        finally:
+            # FFmpeg が起動できなかった場合なども、残りの入力を読み捨ててから応答する
+            for _ in input_chunks:
+                pass
+        if success:
+            # 処理結果はチャンクとして送信済みのため、終了を知らせるメッセージのみ送る
+            self._send_message(client_socket, MMPMessage({"status": "success", "streamed": True}, media_type))
+        else:
+            self._send_error(client_socket, 500, "Processing failed", msg)
+
+    def _send_stream_chunk(self, client_socket: socket.socket, media_type: str, chunk: bytes):
+        # 送信に失敗した場合は例外を送出して FFmpeg を停止させる
+        message = MMPMessage({"status": "chunk"}, media_type, chunk)
+        message.flags = _response_flags.get()
+        message.encode_to_socket(client_socket, chunk_size=self.chunk_size)
+        self.metrics.add_bytes_sent(len(chunk))
+
+    def _result_cache_key(self, process_type: str, message: MMPMessage, params: dict = None) -> str:
+        # パイプライン処理では各処理のパラメータ (params) ごとにキーを作る
+        if not message.payload_hash:
+            return None
+        return cache_key(message.payload_hash, process_type, message.json_data if params is None else params)
+
+    def _get_cached_result(self, key: str) -> str:
+        if not key:
+            return None
+        return self.result_cache.get(key, workspace_dir(self.video_processor.temp_dir))
+
+    def _run_processing(self, process_type: str, input_file: str, params: dict, key: str,
+                        threads: int, progress_callback=None):
+        processor = self.worker_pool or self.video_processor
+        success, msg, output_file = processor.process(process_type, input_file, params, threads, progress_callback)
+        if success and output_file and key:
+            self.result_cache.put(key, output_file)
+        return success, msg, output_file
+
+    def _run_locally(self, func, threads: int):
+        # コーディネーターでは割り当て待ちのジョブ数で処理枠を決めているため、
+        # 自身で FFmpeg を実行する処理 (複数の処理・ストリーミング処理) は WorkerPool の上限に従う
+        if self.worker_pool:
+            return self.worker_pool.run_locally(func)
+        return func(threads)
+
+    def _worker_operation_response(self, message: MMPMessage, client_ip: str) -> MMPMessage:
+        if message.json_data.get('operation') == WorkerOperation.REGISTER_WORKER.value:
+            if not self.worker_pool:
+                return MMPMessage.create_error_message(400, "Not a coordinator",
+                                                       "Please start the server with --coordinator")
+            if not self._is_trusted_worker(message, client_ip):
+                # 登録されたワーカーにはアップロードされた動画を送るため、任意の接続元からは登録させない
+                print(f"Rejected worker registration from {client_ip}")
+                return MMPMessage.create_error_message(403, "Worker not authorized",
+                                                       "Please start the worker with the coordinator's --worker-secret")
+            # ワーカーがアドレスを指定しない場合は接続元のアドレスを使う
+            host = message.json_data.get('host') or client_ip
+            if host == '0.0.0.0':
+                host = client_ip
+            load = {k: message.json_data[k] for k in ['active_jobs', 'queue_depth'] if k in message.json_data}
+            self.worker_pool.register(host, int(message.json_data['port']), int(message.json_data.get('capacity', 1)), load)
+            return MMPMessage({"status": "success"}, "json")
+
+        status = {
+            "status": "success",
+            "capacity": self.scheduler.max_workers,
+            "active_jobs": self.scheduler.active_jobs(),
+            "queue_depth": self.scheduler.queue_depth(),
+        }
+        if self.worker_pool:
+            status["workers"] = self.worker_pool.workers()
+        return MMPMessage(status, "json")
+
+    def _is_trusted_worker(self, message: MMPMessage, client_ip: str) -> bool:
+        if self.worker_secret:
+            secret = str(message.json_data.get('worker_secret', ''))
+            return hmac.compare_digest(secret.encode('utf-8'), self.worker_secret.encode('utf-8'))
+        try:
+            return ipaddress.ip_address(client_ip).is_loopback
+        except ValueError:
+            return False
+
+    def _stats_response(self, message: MMPMessage) -> MMPMessage:
+        if message.json_data.get('format') == 'prometheus':
+            return MMPMessage({"status": "success", "format": "prometheus"}, "txt",
+                              self._render_metrics().encode('utf-8'))
+        # JSON ではラベル付きの値 (IP アドレスごとの処理数など) をそのまま dict で返す
+        gauges = {name: value['values'] if isinstance(value, dict) else value
+                  for name, value in self._metric_gauges().items()}
+        return MMPMessage({"status": "success", **self.metrics.to_json(), **gauges}, "json")
+
+    def _metric_gauges(self) -> dict:
+        gauges = {
+            "capacity": self.scheduler.max_workers,
+            "queue_depth": self.scheduler.queue_depth(),
+            "active_jobs": self.scheduler.active_jobs(),
+            "active_requests": {"label": "client_ip",
+                                "values": {ip: count for ip, count in dict(self.active_clients).items() if count}},
+            "temp_storage_bytes": directory_size(self.video_processor.temp_dir),
+            "reserved_storage_bytes": self.storage.reserved(),
+            "cache_storage_bytes": self.result_cache.total_size(),
+        }
+        if self.worker_pool:
+            gauges["workers"] = len(self.worker_pool.workers())
+        return gauges
+
+    def _render_metrics(self) -> str:
+        return self.metrics.render_prometheus(self._metric_gauges())
+
+    def _submit_job(self, client_socket: socket.socket, message: MMPMessage, client_ip: str):
+        process_type = self._validate_process_type(client_socket, message)
+        if not process_type:
+            return
+
+        stored_job = self.job_store.create(process_type, client_ip, current_workspace())
+        cache_key = self._result_cache_key(process_type, message)
+        cached_output = self._get_cached_result(cache_key)
+        if cached_output:
+            self.job_store.complete(stored_job.job_id, True, "Success (cached)", cached_output)
+            self._send_message(client_socket, self._accepted_message(stored_job))
+            return
+
+        input_file = self._save_temp_file(message)
+        if not input_file:
+            self.job_store.remove(stored_job.job_id)
+            self._send_content_unavailable(client_socket)
+            return
+        error = self._input_error(input_file, [message.json_data])
+        if error:
+            self.job_store.remove(stored_job.job_id)
+            self.video_processor.cleanup_temp_file(input_file)
+            self._send_message(client_socket, error)
+            return
+
+        def run(threads):
+            self.job_store.mark_running(stored_job.job_id)
+            try:
+                success, msg, output_file = self._run_processing(
+                    process_type, input_file, message.json_data, cache_key, threads,
+                    lambda progress: self.job_store.update_progress(stored_job.job_id, progress))
+                self.job_store.complete(stored_job.job_id, success, msg, output_file)
+            except Exception as e:
+                self.job_store.complete(stored_job.job_id, False, str(e), None)
+            finally:
+                self.video_processor.cleanup_temp_file(input_file)
+                self._remove_client_process(client_ip)
+
+        self._add_client_process(client_ip)
+        try:
+            self.scheduler.submit(run, priority=job_priority(process_type, message.json_data))
+        except QueueFullError:
+            self._remove_client_process(client_ip)
+            self.job_store.remove(stored_job.job_id)
+            self._send_message(client_socket, self._busy_response())
+            return
+
+        # 入力ファイルはジョブ完了時に削除するため、接続終了時には削除しない
+        message.payload_path = None
+        self._send_message(client_socket, self._accepted_message(stored_job))
+
+    def _send_job_status(self, client_socket: socket.socket, message: MMPMessage):
+        self._send_message(client_socket, self._job_status_response(message))
+
+    def _job_status_response(self, message: MMPMessage) -> MMPMessage:
+        job = self.job_store.get(message.json_data.get('job_id', ''))
+        if not job:
+            return self._job_not_found_response()
+        return MMPMessage({"status": "success", **job.to_json()}, "json")
+
+    def _job_not_found_response(self) -> MMPMessage:
+        return MMPMessage.create_error_message(404, "Job not found", "The job ID is unknown or its result has expired")
+
+    def _send_job_result(self, client_socket: socket.socket, message: MMPMessage):
+        response, job = self._job_result_response(message)
+        if self._send_message(client_socket, response) and job:
+            # 取得が完了した結果のみ削除し、失敗した場合は再取得できるよう保持する
+            self.job_store.remove(job.job_id)
+
+    def _job_result_response(self, message: MMPMessage):
+        # (レスポンス, 送信後に削除するジョブ) を返す
+        job = self.job_store.get(message.json_data.get('job_id', ''))
+        if not job:
+            return self._job_not_found_response(), None
+        if job.status == "failed":
+            self.job_store.remove(job.job_id)
+            return MMPMessage.create_error_message(500, "Processing failed", job.message), None
+        if job.status != "done":
+            return MMPMessage.create_error_message(409, "Job not finished",
+                                                  "Please check the job status and retry later"), None
+        return self._processed_file_response(job.output_file), job
+
+    def _generate_temp_path(self, media_type: str) -> str:
+        # 同じ秒に複数のアップロードを受信しても衝突しないようにする
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f'input_{timestamp}.{media_type}'
-        filepath = os.path.join(self.video_processor.temp_dir, filename)
+        filename = f'input_{timestamp}_{uuid.uuid4().hex[:8]}.{media_type}'
+        return os.path.join(workspace_dir(self.video_processor.temp_dir), filename)
+
+    def _save_temp_file(self, message: MMPMessage) -> str:
+        with self.metrics.phase('save_temp_file'):
+            input_file = self._write_input_file(message)
+        if input_file:
+            # 入力の情報 (ffprobe の結果) は SHA-256 ごとにキャッシュし、同じ入力では再取得しない
+            self.video_processor.probe_cache.register_input(input_file, message.payload_hash)
+        return input_file
+
+    def _write_input_file(self, message: MMPMessage) -> str:
+        # 受信時にファイルへ書き込み済みであればそのパスを使う
+        if message.payload_path:
+            if message.payload_hash:
+                self.result_cache.put(input_key(message.payload_hash), message.payload_path)
+            return message.payload_path
+        # アップロードが省略された場合はキャッシュ済みの入力を使う (見つからない・保持を確認できなければ None)
+        if message.payload_size == 0 and message.json_data.get('content_hash'):
+            if not message.payload_hash:
+                return None
+            return self.result_cache.get(input_key(message.payload_hash), workspace_dir(self.video_processor.temp_dir))
+        filepath = self._generate_temp_path(message.media_type)
         with open(filepath, 'wb') as f:
-            f.write(payload)
+            f.write(message.payload)
         return filepath
 
-    def _send_processed_file(self, client_socket: socket.socket, filepath: str):
+    def _send_processed_file(self, client_socket: socket.socket, filepath: str) -> bool:
+        return self._send_message(client_socket, self._processed_file_response(filepath))
+
+    def _processed_file_response(self, filepath: str) -> MMPMessage:
         try:
-            with open(filepath, 'rb') as f:
-                payload = f.read()
-                media_type = filepath.split('.')[-1]
-                message = MMPMessage(
-                    json_data={"status": "success"},
-                    media_type=media_type,
-                    payload=payload
-                )
-                self._send_message(client_socket, message)
+            media_type = filepath.split('.')[-1]
+            return MMPMessage.from_file(
+                json_data={"status": "success"},
+                media_type=media_type,
+                payload_path=filepath
+            )
         except Exception as e:
-            self._send_error(client_socket, 500, "Error sending processed file", str(e))
+            return MMPMessage.create_error_message(500, "Error sending processed file", str(e))
+
+    def _content_status_response(self, message: MMPMessage) -> MMPMessage:
+        content_hash = message.json_data.get('content_hash', '')
+        input_size = self.result_cache.entry_size(input_key(content_hash))
+        output_available = False
+        process_type = message.json_data.get('process_type')
+        params = dict(message.json_data)
+        if process_type and not self._operation_error(params):
+            output_available = self.result_cache.contains(cache_key(content_hash, process_type, params))
+        input_available = input_size is not None and input_size == message.json_data.get('payload_size')
+        response = {"status": "success", "input_available": input_available, "output_available": output_available}
+        if input_available:
+            # アップロードを省略する場合は、この範囲のハッシュ値をリクエストに付ける
+            response["challenge"] = self._content_challenge(content_hash, input_size)
+        return MMPMessage(response, "json")
+
+    def _content_challenge(self, content_hash: str, size: int) -> dict:
+        nonce = secrets.token_hex(16)
+        length = min(size, CONTENT_PROOF_SIZE)
+        offset = secrets.randbelow(size - length + 1)
+        now = time.time()
+        with self._challenge_lock:
+            for expired in [n for n, challenge in self._content_challenges.items() if challenge[3] < now]:
+                del self._content_challenges[expired]
+            self._content_challenges[nonce] = (content_hash, offset, length, now + CONTENT_CHALLENGE_TTL)
+            while len(self._content_challenges) > MAX_CONTENT_CHALLENGES:
+                del self._content_challenges[next(iter(self._content_challenges))]
+        return {"nonce": nonce, "offset": offset, "length": length}
+
+    def _verify_content_proof(self, message: MMPMessage) -> bool:
+        # 確認に使った範囲は1回のみ有効 (同じ証明を再利用させない)
+        proof = message.json_data.get('content_proof')
+        if not isinstance(proof, dict):
+            return False
+        nonce = str(proof.get('nonce'))
+        with self._challenge_lock:
+            challenge = self._content_challenges.pop(nonce, None)
+        if not challenge:
+            return False
+        content_hash, offset, length, expires = challenge
+        if content_hash != message.json_data['content_hash'] or expires < time.time():
+            return False
+        data = self.result_cache.read(input_key(content_hash), offset, length)
+        if data is None or len(data) != length:
+            return False
+        return hmac.compare_digest(content_proof(nonce, data), str(proof.get('digest', '')))
+
+    def _send_content_unavailable(self, client_socket: socket.socket):
+        self._send_message(client_socket, self._content_unavailable_response())
+
+    def _content_unavailable_response(self) -> MMPMessage:
+        return MMPMessage.create_error_message(410, "Content not available", "Please upload the file again")
+
+    def _send_progress(self, client_socket: socket.socket, progress: dict):
+        self._send_message(client_socket, self._progress_message(progress))
+
+    def _progress_message(self, progress: dict) -> MMPMessage:
+        return MMPMessage({"status": "progress", **progress}, "json")
+
+    def _accepted_message(self, stored_job) -> MMPMessage:
+        return MMPMessage({"status": "accepted", **stored_job.to_json()}, "json")
+
+    def _busy_response(self) -> MMPMessage:
+        return MMPMessage.create_error_message(429, "Server is busy", "Too many jobs are queued. Please retry later")
 
     def _send_error(self, client_socket: socket.socket, code: int, description: str, solution: str):
         message = MMPMessage.create_error_message(code, description, solution)
         self._send_message(client_socket, message)
 
-    def _send_message(self, client_socket: socket.socket, message: MMPMessage):
+    def _send_message(self, client_socket: socket.socket, message: MMPMessage) -> bool:
+        start = time.perf_counter()
+        message.flags |= _response_flags.get()
+        if message.json_data.get('status') not in INTERMEDIATE_STATUSES:
+            # クライアントは最終的なレスポンスを受け取るとすぐに次のリクエストを送れるため、先に処理枠を解放する
+            self._release_client_slot()
         try:
-            header_bytes, body_bytes, payload = message.encode()
-            client_socket.sendall(header_bytes)
-            client_socket.sendall(body_bytes)
-            if payload:
-                client_socket.sendall(payload)
+            message.encode_to_socket(client_socket, chunk_size=self.chunk_size)
         except Exception as e:
             print(f"Error sending message: {e}")
+            self._observe_send(message, None)
+            return False
+        self._observe_send(message, start)
+        return True
+
+    def _observe_send(self, message: MMPMessage, start: float):
+        # start が None の場合は送信に失敗した
+        trace = current_trace()
+        if trace and message.json_data.get('status') not in INTERMEDIATE_STATUSES:
+            trace.status = str(message.json_data.get('error_code', 'ok')) if start else 'send_failed'
+        if start and message.payload_size > 0:
+            self.metrics.observe('send', time.perf_counter() - start)
+            self.metrics.add_bytes_sent(message.payload_size)
+
+    def _expire_jobs_loop(self):
+        while self.running:
+            time.sleep(self.expire_interval)
+            for job_id in self.job_store.expire():
+                print(f"Expired unfetched result of job {job_id}")
+            for upload_id in self.upload_manager.expire():
+                print(f"Expired incomplete upload {upload_id}")
+            if self.worker_pool:
+                for worker_id in self.worker_pool.expire():
+                    print(f"Removed unresponsive worker {worker_id}")
+            for path in self.storage.collect_orphans():
+                print(f"Removed orphaned temp file {path}")
+
+    def _start_background_tasks(self):
+        threading.Thread(target=self._expire_jobs_loop, daemon=True).start()
+        self._start_metrics_endpoint()
+
+    def _start_metrics_endpoint(self):
+        if self.metrics_port:
+            start_http_endpoint(self.host, self.metrics_port, self._render_metrics)
+            print(f"Metrics available at http://{self.host}:{self.metrics_port}/metrics")
 
     def start(self):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -151,6 +961,7 @@ class VideoProcessingServer:
         self.server_socket.listen(5)
         self.running = True
         print(f"Server started on {self.host}:{self.port}")
+        self._start_background_tasks()
 
         while self.running:
             try:
@@ -168,14 +979,45 @@ class VideoProcessingServer:
         self.running = False
         if self.server_socket:
             self.server_socket.close()
+        self.scheduler.shutdown()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Start the video processing server')
     parser.add_argument('--host', default='localhost', help='Server host')
     parser.add_argument('--port', type=int, default=8000, help='Server port')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Socket I/O chunk size in bytes')
+    parser.add_argument('--workers', type=int, help='Number of concurrent FFmpeg jobs (default: 60%% of CPUs)')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_MAX_QUEUE_SIZE, help='Maximum number of queued jobs')
+    parser.add_argument('--result-ttl', type=int, default=DEFAULT_RESULT_TTL, help='Seconds to keep unfetched job results')
+    parser.add_argument('--cache-dir', default='cache', help='Directory for cached processing results')
+    parser.add_argument('--cache-size', type=float, help='Maximum result cache size in GB, taken out of --max-storage (default: 1/4, at most 1/2)')
+    parser.add_argument('--max-storage', type=float, help='Maximum storage for temp files and the result cache in GB (default: 4096)')
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded',
+                        help='Connection handling: one thread per client or a single asyncio event loop')
+    parser.add_argument('--coordinator', action='store_true',
+                        help='Dispatch processing to registered worker nodes (see worker_node.py)')
+    parser.add_argument('--worker-secret',
+                        help='Shared secret worker nodes must send to register (default: only local workers may register)')
+    parser.add_argument('--profile', choices=ENCODER_PROFILES, default=DEFAULT_PROFILE,
+                        help='Encoder profile used when a request does not specify one')
+    parser.add_argument('--max-profile', choices=ENCODER_PROFILES, default=DEFAULT_MAX_PROFILE,
+                        help='Slowest encoder profile a request may use (slower requests are downgraded)')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics over HTTP on this port')
+    parser.add_argument('--trace-log', help='Append a JSON trace line per request to this file ("-" for stdout)')
 
     args = parser.parse_args()
-    server = VideoProcessingServer(host=args.host, port=args.port)
+    server_class = VideoProcessingServer
+    if args.mode == 'async':
+        from async_server import AsyncVideoProcessingServer
+        server_class = AsyncVideoProcessingServer
+    server = server_class(host=args.host, port=args.port, chunk_size=args.chunk_size,
+                          max_workers=args.workers, max_queue_size=args.queue_size,
+                          result_ttl=args.result_ttl, cache_dir=args.cache_dir,
+                          cache_size=int(args.cache_size * 1024 ** 3) if args.cache_size is not None else None,
+                          coordinator=args.coordinator, default_profile=args.profile,
+                          max_profile=args.max_profile, metrics_port=args.metrics_port,
+                          trace_log=args.trace_log, worker_secret=args.worker_secret,
+                          max_storage=int(args.max_storage * 1024 ** 3) if args.max_storage is not None else DEFAULT_MAX_STORAGE)
 
     try:
         server.start()
@@ -0,0 +1,139 @@
+import contextvars
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from metrics import directory_size
+
+DEFAULT_MIN_FREE_SPACE = 1024 * 1024 * 1024  # ディスクの空き容量をこれ以上残す (1GB)
+DEFAULT_ORPHAN_AGE = 10 * 60  # 処理中のリクエストに属さず、これより古い一時ファイルは削除する (秒)
+OUTPUT_RESERVE_RATIO = 1.0  # 出力1つあたり、入力のこの倍数の容量を確保する
+WORKSPACE_DIR = 'jobs'
+# 再開可能なアップロードは接続をまたいで残すため、UploadManager が期限を管理する。
+# ワークスペースはサーバーごとのディレクトリに分かれている
+PRESERVED_DIRS = ['uploads', WORKSPACE_DIR]
+
+class StorageQuotaError(Exception):
+    pass
+
+class Workspace:
+    # 1つのリクエストの一時ファイル (入力・出力・分割エンコードの区間) を置くディレクトリと確保した容量
+    def __init__(self, manager: 'StorageManager', path: str, size: int):
+        self.manager = manager
+        self.path = path
+        self.size = size
+        self._holders = 1
+
+    def hold(self):
+        # 非同期ジョブのように、接続の終了後も結果を保持する場合は解放を1回分遅らせる
+        with self.manager._lock:
+            self._holders += 1
+
+    def release(self):
+        self.manager._release(self)
+
+# 処理中のリクエストのワークスペース。ジョブの実行時にも引き継がれる
+_current_workspace: contextvars.ContextVar = contextvars.ContextVar('current_workspace', default=None)
+
+def current_workspace() -> Optional[Workspace]:
+    return _current_workspace.get()
+
+def workspace_dir(default: str) -> str:
+    # ワークスペースの外 (ワーカーの登録など) で作られる一時ファイルは default に置く
+    workspace = current_workspace()
+    return workspace.path if workspace else default
+
+class StorageManager:
+    def __init__(self, temp_dir: str, max_storage: int, instance: str = 'default',
+                 min_free_space: int = DEFAULT_MIN_FREE_SPACE, orphan_age: float = DEFAULT_ORPHAN_AGE):
+        self.temp_dir = temp_dir
+        self.max_storage = max_storage  # 確保できる容量の合計の上限
+        self.min_free_space = min_free_space
+        self.orphan_age = orphan_age
+        # 同じ一時ディレクトリを使う他のサーバー (同じマシンのワーカーノードなど) の作業領域は削除しない
+        self.workspace_root = os.path.join(temp_dir, WORKSPACE_DIR, instance)
+        self._workspaces: Dict[str, Workspace] = {}  # パス -> 処理中のワークスペース
+        self._reserved = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(self.workspace_root):
+            os.makedirs(self.workspace_root)
+
+    @staticmethod
+    def reservation_size(input_size: int, outputs: int = 1) -> int:
+        # 入力に加えて、各出力が入力と同程度の大きさになると見込んで確保する
+        return int(input_size * (1 + outputs * OUTPUT_RESERVE_RATIO))
+
+    def reserved(self) -> int:
+        with self._lock:
+            return self._reserved
+
+    def _free_space(self) -> int:
+        # 確保済みでまだ書き込まれていない分は、ディスクの空き容量から差し引く
+        written = directory_size(self.workspace_root)
+        free = shutil.disk_usage(self.temp_dir).free - self.min_free_space
+        with self._lock:
+            return free - max(0, self._reserved - written)
+
+    def _check(self, size: int, free: int):
+        # self._lock を取得した状態で呼ぶ
+        if self._reserved + size > self.max_storage:
+            raise StorageQuotaError(f"Storage quota exceeded ({self._reserved + size} of {self.max_storage} bytes)")
+        if size > free:
+            raise StorageQuotaError(f"Not enough disk space ({size} bytes requested, {max(0, free)} available)")
+
+    def check(self, size: int):
+        # 確保はせずに、size バイトを受け入れられるかだけを確認する (アップロード開始前の確認用)
+        free = self._free_space()
+        with self._lock:
+            self._check(size, free)
+
+    def reserve(self, size: int) -> Workspace:
+        # 容量を確保して新しいワークスペースを作り、現在のコンテキストのワークスペースにする
+        free = self._free_space()
+        path = os.path.join(self.workspace_root, uuid.uuid4().hex)
+        with self._lock:
+            self._check(size, free)
+            self._reserved += size
+            workspace = Workspace(self, path, size)
+            self._workspaces[path] = workspace
+        os.makedirs(path)
+        _current_workspace.set(workspace)
+        return workspace
+
+    def _release(self, workspace: Workspace):
+        with self._lock:
+            workspace._holders -= 1
+            if workspace._holders > 0:
+                return
+            self._workspaces.pop(workspace.path, None)
+            self._reserved -= workspace.size
+        shutil.rmtree(workspace.path, ignore_errors=True)
+
+    def collect_orphans(self, startup: bool = False) -> List[str]:
+        # 処理中のリクエストに属さない一時ファイルを削除する。
+        # 起動時はこのサーバーの作業領域を全て削除し、それ以外は orphan_age より古いものだけを削除する
+        with self._lock:
+            active = set(self._workspaces)
+        now = time.time()
+        candidates = [(os.path.join(self.workspace_root, name), startup) for name in os.listdir(self.workspace_root)]
+        candidates += [(os.path.join(self.temp_dir, name), False) for name in os.listdir(self.temp_dir)
+                       if name not in PRESERVED_DIRS]
+        removed = []
+        for path, remove_any_age in candidates:
+            if path in active:
+                continue
+            try:
+                if not remove_any_age and now - os.path.getmtime(path) < self.orphan_age:
+                    continue
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError as e:
+                print(f"Error removing orphaned temp file {path}: {e}")
+                continue
+            removed.append(path)
+        return removed
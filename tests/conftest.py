@@ -0,0 +1,113 @@
+import asyncio
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+
+import pytest
+
+# リポジトリ直下のモジュール (mmp_protocol.py など) をインポートできるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# FFmpeg の代わりに使うスクリプト。最初の入力の内容に "processed:" を付けて各出力に書き出し、
+# -progress pipe:1 が指定されていれば進捗も出力する。実行したコマンドは FAKE_FFMPEG_LOG に記録する
+FAKE_FFMPEG = '''#!{python}
+import json
+import os
+import sys
+
+FLAGS = {{'-nostats', '-vn', '-sn', '-dn'}}
+args = sys.argv[1:]
+with open(os.environ['FAKE_FFMPEG_LOG'], 'a') as log:
+    log.write(json.dumps(args) + '\\n')
+if os.environ.get('FAKE_FFMPEG_FAIL'):
+    sys.stderr.write('Invalid data found when processing input\\n')
+    sys.exit(1)
+
+inputs, outputs, options = [], [], {{}}
+index = 0
+while index < len(args):
+    if args[index] in FLAGS:
+        index += 1
+    elif args[index].startswith('-'):
+        (inputs if args[index] == '-i' else []).append(args[index + 1])
+        options[args[index]] = args[index + 1]
+        index += 2
+    else:
+        outputs.append(args[index])
+        index += 1
+
+data = sys.stdin.buffer.read() if inputs[0] == 'pipe:0' else open(inputs[0], 'rb').read()
+if options.get('-progress') == 'pipe:1':
+    for frame, state in [(12, 'continue'), (24, 'end')]:
+        print(f'frame={{frame}}\\nfps=24.0\\nout_time_us={{frame * 1000000 // 24}}\\nout_time=00:00:00.5\\n'
+              f'speed=2.0x\\nprogress={{state}}', flush=True)
+for output in outputs:
+    if output == 'pipe:1':
+        sys.stdout.buffer.write(b'processed:' + data)
+    elif options.get('-f') == 'segment':
+        # 区切りの数 + 1 個の区間に分ける
+        for segment in range(len(options['-segment_times'].split(',')) + 1):
+            with open(output % segment, 'wb') as f:
+                f.write(b'segment %d' % segment)
+    else:
+        with open(output, 'wb') as f:
+            f.write(b'processed:' + data)
+'''
+
+class FakeFFmpeg:
+    def __init__(self, log_path: str):
+        self.log_path = log_path
+
+    def commands(self) -> list:
+        if not os.path.exists(self.log_path):
+            return []
+        with open(self.log_path) as f:
+            return [json.loads(line) for line in f]
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch) -> FakeFFmpeg:
+    # PATH の先頭に置き、サーバーや VideoProcessor から実行される ffmpeg を置き換える
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "ffmpeg"
+    script.write_text(FAKE_FFMPEG.format(python=sys.executable))
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("FAKE_FFMPEG_LOG", str(tmp_path / "ffmpeg.log"))
+    return FakeFFmpeg(str(tmp_path / "ffmpeg.log"))
+
+def _serve(server):
+    try:
+        server.start()
+    except asyncio.CancelledError:
+        # asyncio サーバーは stop() で serve_forever が取り消されて終了する
+        pass
+
+@pytest.fixture
+def start_server():
+    # サーバーを空いているポートで起動し、ポート番号を返す
+    started = []
+
+    def start(server) -> int:
+        server.port = 0
+        threading.Thread(target=_serve, args=(server,), daemon=True).start()
+        deadline = time.time() + 5
+        while not (server.running and server.server_socket):
+            assert time.time() < deadline, "server did not start"
+            time.sleep(0.01)
+        started.append(server)
+        if isinstance(server.server_socket, socket.socket):
+            return server.server_socket.getsockname()[1]
+        # asyncio サーバー (asyncio.Server)
+        return server.server_socket.sockets[0].getsockname()[1]
+    yield start
+    for server in started:
+        if isinstance(server.server_socket, socket.socket):
+            server.stop()
+        else:
+            # asyncio サーバーはイベントループ上で停止する
+            server.loop.call_soon_threadsafe(server.stop)
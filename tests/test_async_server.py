@@ -0,0 +1,79 @@
+import contextvars
+import os
+import socket
+import threading
+
+import pytest
+
+from async_server import AsyncVideoProcessingServer
+from client import VideoProcessingClient
+from mmp_protocol import MMPMessage, MMPHeader, HEADER_SIZE, FLAG_CHECKSUM, FLAG_COMPRESSED
+from server import _response_flags
+
+INPUT = os.urandom(200 * 1024)
+
+class FakeWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data: bytes):
+        self.data.extend(data)
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # 一時ファイルはカレントディレクトリの tmp/ に作られる
+    monkeypatch.chdir(tmp_path)
+    return AsyncVideoProcessingServer(cache_dir=str(tmp_path / "cache"))
+
+def test_progress_frames_use_the_request_transfer_flags(server):
+    writer = FakeWriter()
+
+    def send_progress():
+        # リクエストを --checksum --compress で受信した場合と同じ状態
+        _response_flags.set(FLAG_CHECKSUM | FLAG_COMPRESSED)
+        server._write_message_nowait(writer, server._progress_message({"frame": 10}))
+    contextvars.copy_context().run(send_progress)
+
+    header = MMPHeader.from_bytes(bytes(writer.data[:HEADER_SIZE]))
+    assert header.flags & (FLAG_CHECKSUM | FLAG_COMPRESSED) == FLAG_CHECKSUM | FLAG_COMPRESSED
+    message = MMPMessage.decode(bytes(writer.data[:HEADER_SIZE]), bytes(writer.data[HEADER_SIZE:]), b"")
+    assert message.json_data == {"status": "progress", "frame": 10}
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(INPUT)
+    return str(path)
+
+def test_request_is_processed_with_an_ffmpeg_subprocess(server, start_server, fake_ffmpeg, video):
+    client = VideoProcessingClient(port=start_server(server))
+    progress = []
+    client._print_processing_progress = progress.append
+    assert client.compress_video(video)
+    with open(video.replace(".mp4", "_processed.mp4"), 'rb') as f:
+        assert f.read() == b"processed:" + INPUT
+    assert [frame["frame"] for frame in progress] == [12, 24]
+    command = fake_ffmpeg.commands()[0]
+    assert command[command.index('-threads') + 1] == str(server.scheduler.threads_per_job)
+
+def test_slow_uploaders_do_not_hold_up_other_clients(server, start_server, fake_ffmpeg, video):
+    port = start_server(server)
+    threads = threading.active_count()
+    # ヘッダーの途中で止まっている接続
+    idle = [socket.create_connection(("localhost", port)) for _ in range(20)]
+    try:
+        for sock in idle:
+            sock.sendall(b"\x00\x00\x00")
+        assert VideoProcessingClient(port=port).compress_video(video)
+        # 接続ごとのスレッドは作らない
+        assert threading.active_count() - threads < len(idle)
+    finally:
+        for sock in idle:
+            sock.close()
+
+def test_submitted_job_is_fetched_from_the_async_server(server, start_server, fake_ffmpeg, video):
+    client = VideoProcessingClient(port=start_server(server), async_jobs=True)
+    client.status_check_interval = 0.05
+    assert client.extract_audio(video)
+    with open(video.replace(".mp4", "_processed.mp3"), 'rb') as f:
+        assert f.read() == b"processed:" + INPUT
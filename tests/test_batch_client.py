@@ -0,0 +1,128 @@
+import json
+import os
+import time
+from types import SimpleNamespace
+
+from batch_client import BatchItem, BatchRunner, items_from_directory, items_from_manifest
+from client import VideoProcessingClient
+from mmp_protocol import MMPMessage, VideoProcessType
+from server import VideoProcessingServer
+
+def defaults(**overrides) -> SimpleNamespace:
+    # client.py のコマンドライン引数の既定値
+    values = {"action": None, "width": None, "height": None, "aspect_ratio": None,
+              "start_time": None, "duration": None}
+    return SimpleNamespace(**{**values, **overrides})
+
+def write_manifest(path, entries) -> str:
+    path.write_text("\n".join(entry if isinstance(entry, str) else json.dumps(entry) for entry in entries))
+    return str(path)
+
+def test_manifest_lines_for_an_already_listed_file_are_rejected(tmp_path):
+    manifest = write_manifest(tmp_path / "batch.jsonl", [
+        {"file": "clip.mp4", "action": "resize", "width": 640, "height": 360},
+        {"file": "./clip.mp4", "action": "compress"},
+        {"file": "other.mp4", "action": "compress"},
+    ])
+    items = items_from_manifest(manifest, defaults())
+    # 2行目は1行目と同じ出力のパスになるため処理しない
+    assert [(item.file_path, item.operations) for item in items] == [
+        (str(tmp_path / "clip.mp4"), [(VideoProcessType.RESIZE_RESOLUTION, {"width": 640, "height": 360})]),
+        (str(tmp_path / "other.mp4"), [(VideoProcessType.COMPRESS, {})]),
+    ]
+
+def test_manifest_entries_fall_back_to_the_command_line_defaults(tmp_path):
+    manifest = write_manifest(tmp_path / "batch.jsonl", [
+        {"file": "a.mp4"},
+        "",
+        {"file": "b.mp4", "action": ["audio", "gif"], "duration": "00:00:02"},
+        {"file": "c.mp4", "action": "resize", "width": 320},
+    ])
+    items = items_from_manifest(manifest, defaults(action=["compress"], start_time="00:00:01",
+                                                    duration="00:00:05", height=180))
+    assert [item.operations for item in items] == [
+        [(VideoProcessType.COMPRESS, {})],
+        [(VideoProcessType.EXTRACT_AUDIO, {}),
+         (VideoProcessType.CREATE_GIF, {"start_time": "00:00:01", "duration": "00:00:02"})],
+        [(VideoProcessType.RESIZE_RESOLUTION, {"width": 320, "height": 180})],
+    ]
+
+def test_invalid_manifest_lines_are_skipped(tmp_path, capsys):
+    manifest = write_manifest(tmp_path / "batch.jsonl", [
+        "not json",
+        {"action": "compress"},
+        {"file": "no_action.mp4"},
+        {"file": "no_size.mp4", "action": "resize"},
+        {"file": "ok.mp4", "action": "compress"},
+    ])
+    items = items_from_manifest(manifest, defaults())
+    assert [os.path.basename(item.file_path) for item in items] == ["ok.mp4"]
+    output = capsys.readouterr().out
+    assert "Invalid manifest entry on line 1" in output and "Invalid manifest entry on line 2" in output
+    assert "missing action on line 3" in output and "missing action on line 4" in output
+
+def test_directory_items_skip_outputs_and_other_files(tmp_path):
+    for name in ["b.mp4", "a.MOV", "a_processed.mp4", "a_processed_2.mp3", "notes.txt",
+                 "sub/c.mkv", "out/d.mp4"]:
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_bytes(b"video")
+    operations = [(VideoProcessType.COMPRESS, {})]
+    items = items_from_directory(str(tmp_path), operations, output_dir=str(tmp_path / "out"))
+    # 以前の実行の出力と出力先のディレクトリは入力として扱わない
+    assert [os.path.relpath(item.file_path, tmp_path) for item in items] == ["a.MOV", "b.mp4", os.path.join("sub", "c.mkv")]
+
+def test_items_with_newer_outputs_are_up_to_date(tmp_path):
+    runner = BatchRunner([VideoProcessingClient()])
+    video = tmp_path / "clip.mp4"
+    video.write_bytes(b"video")
+    single = BatchItem(str(video), [(VideoProcessType.COMPRESS, {})])
+    pipeline = BatchItem(str(video), [(VideoProcessType.COMPRESS, {}), (VideoProcessType.EXTRACT_AUDIO, {})])
+    assert runner.output_paths(single) == [str(tmp_path / "clip_processed.mp4")]
+    assert runner.output_paths(pipeline) == [str(tmp_path / "clip_processed_1.mp4"), str(tmp_path / "clip_processed_2.mp3")]
+
+    for path in runner.output_paths(single) + runner.output_paths(pipeline)[:1]:
+        open(path, 'wb').close()
+    assert runner.is_up_to_date(single) and not runner.is_up_to_date(pipeline)
+    # 入力が出力より後に更新された場合は処理し直す
+    later = time.time() + 10
+    os.utime(video, (later, later))
+    assert not runner.is_up_to_date(single)
+
+def test_concurrency_is_capped_by_the_server_capacity(capsys):
+    clients = [VideoProcessingClient(port=port) for port in (8000, 8001)]
+    assert BatchRunner(clients).concurrency == 2
+    assert BatchRunner(clients, requests_per_server=2).concurrency == 4
+    assert BatchRunner(clients, concurrency=10, requests_per_server=2).concurrency == 4
+    assert "Concurrency limited to 4" in capsys.readouterr().out
+    assert BatchRunner(clients, concurrency=1).concurrency == 1
+
+def test_batch_processes_a_directory_and_skips_it_the_second_time(tmp_path, monkeypatch, start_server, fake_ffmpeg):
+    monkeypatch.chdir(tmp_path)
+    server = VideoProcessingServer(cache_dir=str(tmp_path / "cache"))
+    port = start_server(server)
+    videos = tmp_path / "videos"
+    videos.mkdir()
+    for name in ["a.mp4", "b.mp4", "c.mp4"]:
+        (videos / name).write_bytes(name.encode())
+    items = items_from_directory(str(videos), [(VideoProcessType.COMPRESS, {})])
+
+    stats = BatchRunner([VideoProcessingClient(port=port)]).run(items)
+    assert (stats.processed, stats.skipped, stats.failures) == (3, 0, [])
+    assert (videos / "b_processed.mp4").read_bytes() == b"processed:b.mp4"
+
+    stats = BatchRunner([VideoProcessingClient(port=port)]).run(items_from_directory(str(videos), items[0].operations))
+    assert (stats.processed, stats.skipped) == (0, 3)
+    assert len(fake_ffmpeg.commands()) == 3
+
+def test_busy_server_responses_are_retried(tmp_path, monkeypatch):
+    video = tmp_path / "clip.mp4"
+    video.write_bytes(b"video")
+    runner = BatchRunner([VideoProcessingClient()], retry_interval=0.01)
+    responses = [MMPMessage.create_error_message(429, "Server is busy", "Please retry later"),
+                 MMPMessage({"status": "success"}, "json")]
+    output = tmp_path / "received.mp4"
+    output.write_bytes(b"output")
+    monkeypatch.setattr(runner, "_request", lambda client, item: (
+        responses.pop(0), [] if responses else [str(output)]))
+    stats = runner.run([BatchItem(str(video), [(VideoProcessType.COMPRESS, {})])])
+    assert (stats.processed, stats.retries, stats.failures) == (1, 1, [])
@@ -0,0 +1,57 @@
+import os
+import socket
+import threading
+
+from client import VideoProcessingClient
+from mmp_protocol import MMPMessage, VideoProcessType, HEADER_SIZE, recv_exact
+
+INPUT_SIZE = 8 * 1024 * 1024  # ソケットのバッファより十分大きい入力
+OUTPUT_CHUNK_SIZE = 64 * 1024
+
+def stream_server(sock: socket.socket, received: dict):
+    # ストリーミング処理のサーバーと同じく、入力の受信中に処理結果のチャンクを送る
+    request, _ = MMPMessage.decode_body_from_socket(sock, recv_exact(sock, HEADER_SIZE))
+    received['media_type'] = request.media_type
+    received['size'] = 0
+    pending = 0
+    for chunk in request.iter_payload_from_socket(sock, OUTPUT_CHUNK_SIZE):
+        received['size'] += len(chunk)
+        pending += len(chunk)
+        while pending >= OUTPUT_CHUNK_SIZE:
+            MMPMessage({"status": "chunk"}, "mp4", b"o" * OUTPUT_CHUNK_SIZE).encode_to_socket(sock)
+            pending -= OUTPUT_CHUNK_SIZE
+    MMPMessage({"status": "success", "streamed": True}, "mp4").encode_to_socket(sock)
+
+def test_stream_request_uploads_while_receiving_output(tmp_path):
+    input_path = tmp_path / "input.mkv"
+    input_path.write_bytes(os.urandom(INPUT_SIZE))
+    client = VideoProcessingClient(stream=True, output_dir=str(tmp_path))
+    client.quiet = True
+    message = client._create_request(str(input_path), VideoProcessType.COMPRESS)
+
+    client_socket, server_socket = socket.socketpair()
+    received, result = {}, {}
+    server = threading.Thread(target=stream_server, args=(server_socket, received), daemon=True)
+    server.start()
+    # アップロードを終えてからレスポンスを読むと、双方の送信バッファが埋まって止まる
+    request = threading.Thread(daemon=True, target=lambda: result.update(
+        response=client._send_and_receive(client_socket, message, str(input_path))))
+    request.start()
+    request.join(30)
+    client_socket.close()
+    server_socket.close()
+
+    assert not request.is_alive(), "stream request deadlocked"
+    assert received == {"media_type": "mkv", "size": INPUT_SIZE}
+    response = result['response']
+    assert response.json_data.get('streamed')
+    assert os.path.getsize(response.payload_path) == INPUT_SIZE
+
+def test_requests_use_the_file_extension_as_media_type(tmp_path):
+    client = VideoProcessingClient()
+    for name, media_type in [("a.MOV", "mov"), ("b.mkv", "mkv"), ("c.mp4", "mp4")]:
+        path = tmp_path / name
+        path.write_bytes(b"data")
+        assert client._create_request(str(path), VideoProcessType.EXTRACT_AUDIO).media_type == media_type
+        pipeline = client._create_pipeline_request(str(path), [(VideoProcessType.COMPRESS, None)])
+        assert pipeline.media_type == media_type
@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+
+from job_scheduler import (JobScheduler, QueueFullError, job_priority, worker_pool_size,
+                           PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+@pytest.fixture
+def scheduler():
+    scheduler = JobScheduler(max_workers=1, max_queue_size=3)
+    yield scheduler
+    scheduler.shutdown()
+
+def block_worker(scheduler: JobScheduler) -> threading.Event:
+    # 唯一のワーカーを止めておき、以降のジョブを待ち行列に溜める
+    started, release = threading.Event(), threading.Event()
+
+    def wait(threads):
+        started.set()
+        release.wait(5)
+    scheduler.submit(wait)
+    assert started.wait(5)
+    return release
+
+def test_jobs_run_by_priority_then_submission_order(scheduler):
+    release = block_worker(scheduler)
+    order = []
+    jobs = [scheduler.submit(lambda threads, name=name: order.append(name), priority=priority)
+            for name, priority in [("low", PRIORITY_LOW), ("normal", PRIORITY_NORMAL), ("high", PRIORITY_HIGH)]]
+    release.set()
+    for job in jobs:
+        job.wait(5)
+    assert order == ["high", "normal", "low"]
+
+def test_full_queue_raises_queue_full_error(scheduler):
+    release = block_worker(scheduler)
+    jobs = [scheduler.submit(lambda threads: threads) for _ in range(scheduler.max_queue_size)]
+    assert scheduler.queue_depth() == 3
+    assert scheduler.active_jobs() == 1
+    with pytest.raises(QueueFullError):
+        scheduler.submit(lambda threads: threads)
+    release.set()
+    assert [job.wait(5) for job in jobs] == [scheduler.threads_per_job] * 3
+
+def test_job_errors_are_raised_from_wait(scheduler):
+    def fail(threads):
+        raise RuntimeError("ffmpeg failed")
+    job = scheduler.submit(fail)
+    with pytest.raises(RuntimeError, match="ffmpeg failed"):
+        job.wait(5)
+    assert job.status == "failed"
+
+def test_shutdown_fails_queued_jobs():
+    scheduler = JobScheduler(max_workers=1)
+    release = block_worker(scheduler)
+    job = scheduler.submit(lambda threads: threads)
+    scheduler.shutdown()
+    release.set()
+    with pytest.raises(RuntimeError):
+        job.wait(5)
+    with pytest.raises(RuntimeError):
+        scheduler.submit(lambda threads: threads)
+
+def test_light_jobs_get_higher_priority():
+    assert job_priority("extract_audio", {}) == PRIORITY_HIGH
+    assert job_priority("create_gif", {"duration": "00:00:05"}) == PRIORITY_HIGH
+    assert job_priority("create_webm", {"duration": "00:05:00"}) == PRIORITY_NORMAL
+    assert job_priority("compress", {}) == PRIORITY_LOW
+
+def test_worker_pool_size_stays_within_cpu_budget(monkeypatch):
+    monkeypatch.setattr("os.cpu_count", lambda: 10)
+    # 10コアの60% = 6スレッドを、ジョブあたり2スレッドで分ける
+    assert worker_pool_size() == (3, 2)
+    assert worker_pool_size(6) == (6, 1)
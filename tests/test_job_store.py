@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from job_store import JobStore
+
+class FakeWorkspace:
+    def __init__(self):
+        self.holds = 0
+
+    def hold(self):
+        self.holds += 1
+
+    def release(self):
+        self.holds -= 1
+
+@pytest.fixture
+def removed():
+    return []
+
+@pytest.fixture
+def store(removed):
+    return JobStore(removed.append, result_ttl=60)
+
+def test_job_status_follows_the_job(store):
+    job = store.create("compress", "127.0.0.1")
+    assert store.get(job.job_id).to_json()["job_status"] == "queued"
+    store.mark_running(job.job_id)
+    store.update_progress(job.job_id, {"frame": 12, "out_time": "00:00:00.5"})
+    assert store.get(job.job_id).to_json()["progress"]["frame"] == 12
+    store.complete(job.job_id, True, "Success", "output.mp4")
+    status = store.get(job.job_id).to_json()
+    assert status["job_status"] == "done" and status["message"] == "Success"
+    assert store.get("unknown") is None
+
+def test_removed_jobs_discard_their_output_and_workspace(store, removed):
+    workspace = FakeWorkspace()
+    job = store.create("compress", "127.0.0.1", workspace)
+    # 接続が終了しても、結果を取得するまでワークスペースを保持する
+    assert workspace.holds == 1
+    store.complete(job.job_id, True, "Success", "output.mp4")
+    store.remove(job.job_id)
+    assert removed == ["output.mp4"] and workspace.holds == 0
+    assert store.get(job.job_id) is None
+
+def test_output_of_an_already_removed_job_is_not_kept(store, removed):
+    job = store.create("compress", "127.0.0.1")
+    store.remove(job.job_id)
+    store.complete(job.job_id, True, "Success", "late.mp4")
+    assert removed == ["late.mp4"]
+
+def test_expire_removes_only_finished_results_past_the_ttl(store, removed):
+    running = store.create("compress", "127.0.0.1")
+    finished = store.create("extract_audio", "127.0.0.1")
+    fresh = store.create("create_gif", "127.0.0.1")
+    store.complete(finished.job_id, True, "Success", "old.mp3")
+    store.complete(fresh.job_id, True, "Success", "new.gif")
+    store.get(finished.job_id).finished_at = time.time() - 120
+    assert store.expire() == [finished.job_id]
+    assert removed == ["old.mp3"]
+    assert store.get(running.job_id) and store.get(fresh.job_id)
@@ -0,0 +1,63 @@
+import subprocess
+
+import pytest
+
+import media_probe
+from media_probe import MediaInfo, MediaProbeCache, input_error
+
+@pytest.fixture
+def probes(monkeypatch):
+    calls = []
+
+    def probe_media(input_file):
+        calls.append(input_file)
+        if input_file.endswith('.bad'):
+            raise subprocess.CalledProcessError(1, 'ffprobe')
+        if input_file.endswith('.busy'):
+            raise OSError(24, "Too many open files")
+        return MediaInfo({"format": {"duration": "12.5"},
+                          "streams": [{"codec_type": "video", "codec_name": "h264", "width": 640, "height": 360}]})
+    monkeypatch.setattr(media_probe, "probe_media", probe_media)
+    return calls
+
+def test_probe_results_are_cached_by_content_hash(tmp_path, probes):
+    cache = MediaProbeCache()
+    first, second = tmp_path / "first.mp4", tmp_path / "second.mp4"
+    for path in [first, second]:
+        path.write_bytes(b"video")
+        cache.register_input(str(path), "same-hash")
+    assert cache.get(str(first)).duration == 12.5
+    assert cache.get(str(second)) is cache.get(str(first))
+    assert len(probes) == 1
+
+def test_unparseable_inputs_are_cached_too(tmp_path, probes):
+    cache = MediaProbeCache()
+    path = tmp_path / "input.bad"
+    path.write_bytes(b"not a video")
+    assert cache.get(str(path)) is None
+    assert cache.get(str(path)) is None
+    assert len(probes) == 1
+
+def test_transient_probe_failures_are_not_cached(tmp_path, probes):
+    cache = MediaProbeCache()
+    path = tmp_path / "input.busy"
+    path.write_bytes(b"video")
+    assert cache.get(str(path)) is None
+    assert cache.get(str(path)) is None
+    assert len(probes) == 2
+
+def test_cache_keeps_at_most_max_entries(tmp_path, probes):
+    cache = MediaProbeCache(max_entries=2)
+    paths = []
+    for index in range(3):
+        paths.append(tmp_path / f"{index}.mp4")
+        paths[-1].write_bytes(b"video")
+        cache.get(str(paths[-1]))
+    cache.get(str(paths[0]))
+    assert len(probes) == 4
+
+def test_input_error_rejects_missing_streams_and_late_clips():
+    info = MediaInfo({"format": {"duration": "10"}, "streams": [{"codec_type": "video", "codec_name": "h264"}]})
+    assert input_error("compress", {}, info) is None
+    assert input_error("extract_audio", {}, info) == "Input has no audio stream"
+    assert "beyond the end" in input_error("create_gif", {"start_time": "00:00:20"}, info)
@@ -0,0 +1,71 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+from metrics import Histogram, Metrics, PROMETHEUS_CONTENT_TYPE, current_trace, start_http_endpoint
+
+def test_histogram_counts_values_up_to_each_bound():
+    histogram = Histogram(buckets=(0.1, 1))
+    for value in [0.05, 0.1, 0.5, 5]:
+        histogram.observe(value)
+    # 上限と等しい値はその区切りに含める (Prometheus の le)
+    assert histogram.cumulative() == [(0.1, 2), (1, 3), ('+Inf', 4)]
+    assert histogram.count == 4 and histogram.sum == pytest.approx(5.65)
+
+def test_phases_and_bytes_are_added_to_the_current_trace(tmp_path):
+    log = tmp_path / "trace.jsonl"
+    metrics = Metrics(str(log))
+    trace = metrics.start_trace("127.0.0.1")
+    trace.request = "compress"
+    assert current_trace() is trace
+    metrics.observe("ffmpeg", 1.5)
+    metrics.observe("ffmpeg", 0.5)
+    metrics.add_bytes_received(100)
+    metrics.add_bytes_sent(40)
+    trace.status = "ok"
+    metrics.finish_trace(trace)
+    assert current_trace() is None
+
+    line = json.loads(log.read_text())
+    assert line["request"] == "compress" and line["status"] == "ok"
+    assert line["phases"] == {"ffmpeg": 2.0}
+    assert (line["bytes_received"], line["bytes_sent"]) == (100, 40)
+    assert metrics.to_json()["requests"] == {"ok": 1}
+
+def test_connections_without_a_response_are_not_counted(tmp_path):
+    metrics = Metrics(str(tmp_path / "trace.jsonl"))
+    metrics.finish_trace(metrics.start_trace("127.0.0.1"))
+    assert metrics.to_json()["requests"] == {}
+    assert not (tmp_path / "trace.jsonl").exists()
+
+def test_prometheus_text_includes_histograms_counters_and_gauges():
+    metrics = Metrics()
+    metrics.observe("receive", 0.02)
+    text = metrics.render_prometheus({
+        "queue_depth": 3,
+        "active_requests": {"label": "client_ip", "values": {"10.0.0.2": 1, "10.0.0.1": 2}},
+    })
+    lines = text.splitlines()
+    assert '# TYPE mmp_phase_seconds histogram' in lines
+    assert 'mmp_phase_seconds_bucket{phase="receive",le="0.01"} 0' in lines
+    assert 'mmp_phase_seconds_bucket{phase="receive",le="0.025"} 1' in lines
+    assert 'mmp_phase_seconds_bucket{phase="receive",le="+Inf"} 1' in lines
+    assert 'mmp_phase_seconds_count{phase="receive"} 1' in lines
+    assert 'mmp_queue_depth 3' in lines
+    assert lines[-2:] == ['mmp_active_requests{client_ip="10.0.0.1"} 2', 'mmp_active_requests{client_ip="10.0.0.2"} 1']
+    assert text.endswith('\n')
+
+def test_http_endpoint_serves_only_metrics():
+    http_server = start_http_endpoint("localhost", 0, lambda: "mmp_queue_depth 0\n")
+    try:
+        url = f"http://localhost:{http_server.server_address[1]}"
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            assert response.headers["Content-Type"] == PROMETHEUS_CONTENT_TYPE
+            assert response.read() == b"mmp_queue_depth 0\n"
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(f"{url}/")
+        assert error.value.code == 404
+    finally:
+        http_server.shutdown()
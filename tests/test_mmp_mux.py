@@ -0,0 +1,144 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from mmp_mux import MultiplexedConnection, MUX_FRAME_SIZE, MUX_WINDOW_SIZE
+from mmp_protocol import MMPHeader, MMPMessage, HEADER_SIZE, recv_exact
+
+def read_frame(sock: socket.socket) -> MMPMessage:
+    frame, _ = MMPMessage.decode_body_from_socket(sock, recv_exact(sock, HEADER_SIZE))
+    if frame.payload_size:
+        frame.payload = recv_exact(sock, frame.payload_size)
+    return frame
+
+def send_frame(sock: socket.socket, json_data: dict, data: bytes = b""):
+    header_bytes, body_bytes = MMPMessage(json_data, "", data)._encode_header_and_body()
+    sock.sendall(header_bytes + body_bytes + data)
+
+@pytest.fixture
+def socket_pair():
+    client_socket, server_socket = socket.socketpair()
+    client_socket.settimeout(10)
+    yield client_socket, server_socket
+    client_socket.close()
+    server_socket.close()
+
+def serve(server_socket: socket.socket, handler) -> MultiplexedConnection:
+    connection = MultiplexedConnection(server_socket, on_stream=handler)
+    threading.Thread(target=connection.run, daemon=True).start()
+    return connection
+
+def test_streams_transfer_more_than_one_window_in_both_directions(socket_pair):
+    client_socket, server_socket = socket_pair
+    size = MUX_WINDOW_SIZE * 2 + 1000
+
+    def echo(stream):
+        stream.sendall(recv_exact(stream, size))
+    serve(server_socket, echo)
+    client = MultiplexedConnection(client_socket)
+    client.start()
+
+    payloads = [os.urandom(size) for _ in range(3)]
+    results = {}
+
+    def request(index):
+        stream = client.open_stream()
+        stream.settimeout(10)
+        # 相手も読み出しながら送り返すため、送信と受信を並行して行う
+        sender = threading.Thread(target=stream.sendall, args=(payloads[index],))
+        sender.start()
+        results[index] = recv_exact(stream, size)
+        sender.join()
+        stream.close()
+    threads = [threading.Thread(target=request, args=(index,)) for index in range(len(payloads))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    assert results == dict(enumerate(payloads))
+    client.close()
+
+def test_sender_stops_when_the_window_is_used_up(socket_pair):
+    client_socket, server_socket = socket_pair
+    payload = os.urandom(MUX_WINDOW_SIZE + MUX_FRAME_SIZE)
+    release, done = threading.Event(), threading.Event()
+    received = {}
+
+    def slow_reader(stream):
+        release.wait(10)
+        received['data'] = recv_exact(stream, len(payload))
+        done.set()
+    serve(server_socket, slow_reader)
+    client = MultiplexedConnection(client_socket)
+    client.start()
+
+    stream = client.open_stream()
+    stream.settimeout(0.5)
+    # 相手が読み出すまでは、ウィンドウの分しか送信できない
+    with pytest.raises(socket.timeout):
+        stream.sendall(payload)
+    assert stream._send_window == 0
+
+    release.set()
+    stream.settimeout(10)
+    stream.sendall(payload[MUX_WINDOW_SIZE:])
+    assert done.wait(10)
+    assert received['data'] == payload
+    stream.close()
+    client.close()
+
+def test_data_beyond_the_granted_window_resets_the_stream(socket_pair):
+    client_socket, server_socket = socket_pair
+    release = threading.Event()
+    # 読み出さないため、ウィンドウは通知されない
+    serve(server_socket, lambda stream: release.wait(10))
+
+    block = b"x" * MUX_FRAME_SIZE
+    for _ in range(MUX_WINDOW_SIZE // MUX_FRAME_SIZE + 1):
+        send_frame(client_socket, {"stream_id": 1}, block)
+    frame = read_frame(client_socket)
+    assert frame.json_data == {"stream_id": 1, "reset": "Flow control window exceeded"}
+    release.set()
+
+def test_oversized_frame_closes_the_connection_without_reading_it(socket_pair):
+    client_socket, server_socket = socket_pair
+    connection = MultiplexedConnection(server_socket)
+    stream = connection.open_stream()
+    thread = threading.Thread(target=connection.run, daemon=True)
+    thread.start()
+
+    # ヘッダーのみ送る (上限を超えるペイロードは読み込まずに接続を閉じる)
+    header_bytes, body_bytes = MMPMessage({"stream_id": stream.stream_id}, "")._encode_header_and_body()
+    header = MMPHeader.from_bytes(header_bytes)
+    header.payload_size = MUX_FRAME_SIZE + 1
+    client_socket.sendall(header.to_bytes() + body_bytes)
+    thread.join(5)
+    assert not thread.is_alive()
+    assert connection.closed
+    with pytest.raises(ConnectionResetError, match="exceeds"):
+        stream.recv(1)
+
+def test_streams_can_send_their_first_data_out_of_order(socket_pair):
+    client_socket, server_socket = socket_pair
+    received = {}
+    done = threading.Event()
+
+    def record(stream):
+        received[stream.stream_id] = recv_exact(stream, 4)
+        if len(received) == 2:
+            done.set()
+    serve(server_socket, record)
+    client = MultiplexedConnection(client_socket)
+    client.start()
+
+    # 後に開いたストリームが先に送信しても、先に開いたストリームのデータは捨てられない
+    first, second = client.open_stream(), client.open_stream()
+    second.sendall(b"2222")
+    first.sendall(b"1111")
+    assert done.wait(10)
+    assert received == {first.stream_id: b"1111", second.stream_id: b"2222"}
+    first.close()
+    second.close()
+    client.close()
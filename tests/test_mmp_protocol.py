@@ -0,0 +1,132 @@
+import os
+import socket
+import struct
+import threading
+import zlib
+
+import pytest
+
+from mmp_protocol import (MMPHeader, MMPMessage, PayloadDecoder, PayloadEncoder, ChecksumError, iter_framed_payload,
+                          recv_exact, HEADER_SIZE, FLAG_CHECKSUM, FLAG_COMPRESSED, FLAG_COMPRESSED_JSON,
+                          BLOCK_COMPRESSED, BLOCK_HEADER_SIZE, CHECKSUM_SIZE, PAYLOAD_BLOCK_SIZE)
+
+# 圧縮できるデータと、圧縮しても小さくならないデータ (圧縮済みの動画に相当)
+TEXT_PAYLOAD = b"multiple media protocol " * 20000
+RANDOM_PAYLOAD = os.urandom(3 * PAYLOAD_BLOCK_SIZE + 123)
+
+def framed(payload: bytes, flags: int) -> bytes:
+    message = MMPMessage({"process_type": "compress"}, "mp4", payload)
+    message.flags = flags
+    return message.encode()[2]
+
+def read_framed(data: bytes, flags: int, payload_size: int) -> bytes:
+    offset = 0
+
+    def read_exact(size: int) -> bytes:
+        nonlocal offset
+        chunk = data[offset:offset + size]
+        if len(chunk) < size:
+            raise ValueError("Truncated payload block")
+        offset += size
+        return chunk
+    return b"".join(iter_framed_payload(read_exact, flags, payload_size))
+
+def test_header_round_trip_keeps_flags_and_sizes():
+    flags = FLAG_CHECKSUM | FLAG_COMPRESSED | FLAG_COMPRESSED_JSON
+    header = MMPHeader.from_bytes(MMPHeader(1234, 31, (1 << 40) - 1, flags).to_bytes())
+    assert (header.json_size, header.media_type_size, header.payload_size, header.flags) == \
+        (1234, 31, (1 << 40) - 1, flags)
+
+def test_header_rejects_media_types_that_overlap_the_flag_bits():
+    with pytest.raises(ValueError):
+        MMPHeader(10, 32, 0)
+    with pytest.raises(ValueError):
+        MMPMessage({}, "x" * 32).encode()
+
+def test_from_file_rejects_long_media_types(tmp_path):
+    path = tmp_path / "input.mp4"
+    path.write_bytes(b"data")
+    with pytest.raises(ValueError):
+        MMPMessage.from_file({}, "video/" + "x" * 30, str(path))
+
+@pytest.mark.parametrize("flags", [0, FLAG_CHECKSUM, FLAG_COMPRESSED, FLAG_CHECKSUM | FLAG_COMPRESSED])
+@pytest.mark.parametrize("payload", [TEXT_PAYLOAD, RANDOM_PAYLOAD, b""])
+def test_message_round_trip(flags, payload):
+    message = MMPMessage({"process_type": "compress", "note": "x" * 2000}, "mp4", payload)
+    message.flags = flags
+    decoded = MMPMessage.decode(*message.encode())
+    assert decoded.json_data == message.json_data
+    assert decoded.media_type == "mp4"
+    assert decoded.payload == payload
+    assert decoded.flags == flags
+
+def test_large_json_is_compressed_only_when_requested():
+    json_data = {"note": "x" * 5000}
+    plain = MMPMessage(json_data, "json")
+    assert not MMPHeader.from_bytes(plain.encode()[0]).flags & FLAG_COMPRESSED_JSON
+    compressed = MMPMessage(json_data, "json")
+    compressed.flags = FLAG_COMPRESSED
+    header_bytes, body_bytes, _ = compressed.encode()
+    assert MMPHeader.from_bytes(header_bytes).flags & FLAG_COMPRESSED_JSON
+    assert len(body_bytes) < 5000
+    assert MMPMessage.decode(header_bytes, body_bytes, b"").json_data == json_data
+
+def test_encoder_stops_compressing_incompressible_data():
+    encoder = PayloadEncoder(FLAG_COMPRESSED)
+    block = encoder.encode(os.urandom(PAYLOAD_BLOCK_SIZE))
+    assert not struct.unpack('!I', block[:BLOCK_HEADER_SIZE])[0] & BLOCK_COMPRESSED
+    # 一度小さくならなかったら、以降は圧縮できるブロックも圧縮しない
+    block = encoder.encode(b"a" * PAYLOAD_BLOCK_SIZE)
+    assert not struct.unpack('!I', block[:BLOCK_HEADER_SIZE])[0] & BLOCK_COMPRESSED
+    assert len(block) == BLOCK_HEADER_SIZE + PAYLOAD_BLOCK_SIZE
+
+def test_corrupt_block_is_detected_before_it_is_returned():
+    data = bytearray(framed(RANDOM_PAYLOAD, FLAG_CHECKSUM))
+    # 2番目のブロックのデータを1バイト壊す
+    data[2 * BLOCK_HEADER_SIZE + PAYLOAD_BLOCK_SIZE + CHECKSUM_SIZE + 10] ^= 0xFF
+    received = []
+    offset = 0
+
+    def read_exact(size):
+        nonlocal offset
+        offset += size
+        return bytes(data[offset - size:offset])
+    with pytest.raises(ChecksumError, match=f"at byte {PAYLOAD_BLOCK_SIZE}"):
+        for block in iter_framed_payload(read_exact, FLAG_CHECKSUM, len(RANDOM_PAYLOAD)):
+            received.append(block)
+    assert b"".join(received) == RANDOM_PAYLOAD[:PAYLOAD_BLOCK_SIZE]
+
+def test_corrupt_compressed_block_raises_checksum_error():
+    data = bytearray(framed(TEXT_PAYLOAD, FLAG_COMPRESSED))
+    data[BLOCK_HEADER_SIZE + 5] ^= 0xFF
+    with pytest.raises(ChecksumError):
+        read_framed(bytes(data), FLAG_COMPRESSED, len(TEXT_PAYLOAD))
+
+def test_decoder_rejects_oversized_and_excess_blocks():
+    decoder = PayloadDecoder(FLAG_CHECKSUM, 10)
+    with pytest.raises(ValueError):
+        decoder.block_size(struct.pack('!I', 0))
+    with pytest.raises(ValueError):
+        decoder.block_size(struct.pack('!I', 2 * PAYLOAD_BLOCK_SIZE))
+    block = b"x" * 20
+    with pytest.raises(ValueError):
+        decoder.decode(block + struct.pack('!I', zlib.crc32(block)), False)
+
+def test_socket_round_trip_with_flags(tmp_path):
+    source = tmp_path / "input.mp4"
+    source.write_bytes(TEXT_PAYLOAD)
+    message = MMPMessage.from_file({"process_type": "compress"}, "mp4", str(source))
+    message.flags = FLAG_CHECKSUM | FLAG_COMPRESSED
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        thread = threading.Thread(target=message.encode_to_socket, args=(sender,))
+        thread.start()
+        destination = str(tmp_path / "output.mp4")
+        received = MMPMessage.decode_from_socket(receiver, recv_exact(receiver, HEADER_SIZE),
+                                                 payload_path_factory=lambda json_data, media_type: destination,
+                                                 hash_algorithm='sha256')
+        thread.join()
+    assert received.flags == FLAG_CHECKSUM | FLAG_COMPRESSED
+    assert received.payload_size == len(TEXT_PAYLOAD)
+    with open(destination, 'rb') as f:
+        assert f.read() == TEXT_PAYLOAD
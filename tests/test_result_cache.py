@@ -0,0 +1,57 @@
+import os
+
+from result_cache import ResultCache, cache_key, input_key, normalize_params
+
+def write(path, size: int) -> str:
+    with open(path, 'wb') as f:
+        f.write(b"x" * size)
+    return str(path)
+
+def test_cache_key_ignores_key_order_and_request_only_params():
+    params = {"process_type": "resize", "width": 1280, "height": 720}
+    same = {"height": 720, "width": 1280, "report_progress": True, "stream": True, "upload_id": "abc"}
+    assert normalize_params(params) == normalize_params(same)
+    assert cache_key("hash", "resize", params) == cache_key("hash", "resize", same)
+
+def test_cache_key_depends_on_input_operation_and_params():
+    key = cache_key("hash", "resize", {"width": 1280})
+    assert key != cache_key("other", "resize", {"width": 1280})
+    assert key != cache_key("hash", "change_aspect_ratio", {"width": 1280})
+    assert key != cache_key("hash", "resize", {"width": 640})
+    assert input_key("hash") == "input_hash"
+
+def test_get_links_the_entry_into_the_destination(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), 1000)
+    cache.put("key", write(tmp_path / "output.mp4", 100))
+    destination = cache.get("key", str(tmp_path))
+    assert destination.endswith(".mp4") and os.path.getsize(destination) == 100
+    assert cache.get("missing", str(tmp_path)) is None
+    assert cache.entry_size("key") == 100
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), 250)
+    for name in ["a", "b"]:
+        cache.put(name, write(tmp_path / f"{name}.mp4", 100))
+    # a を使うと、次に追加した時には b が最も長く使われていないエントリになる
+    assert cache.get("a", str(tmp_path))
+    cache.put("c", write(tmp_path / "c.mp4", 100))
+    assert cache.contains("a") and cache.contains("c")
+    assert not cache.contains("b")
+    assert cache.total_size() == 200
+    assert len(os.listdir(tmp_path / "cache")) == 2
+
+def test_entries_larger_than_the_cache_are_not_stored(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), 50)
+    cache.put("big", write(tmp_path / "big.mp4", 100))
+    assert not cache.contains("big")
+    assert cache.total_size() == 0
+
+def test_entries_are_restored_after_restart(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    cache = ResultCache(cache_dir, 1000)
+    cache.put("key", write(tmp_path / "output.mp3", 100))
+    restored = ResultCache(cache_dir, 1000)
+    assert restored.contains("key")
+    assert restored.total_size() == 100
+    # 上限を下げて再起動した場合は、超えた分を削除する
+    assert not ResultCache(cache_dir, 10).contains("key")
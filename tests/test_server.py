@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from client import VideoProcessingClient
+from mmp_protocol import JobOperation, MMPMessage, TransferOperation, VideoProcessType, content_proof
+from result_cache import input_key, normalize_params
+from server import VideoProcessingServer
+
+INPUT = os.urandom(200 * 1024)
+CONTENT_HASH = hashlib.sha256(INPUT).hexdigest()
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    # 一時ファイルはカレントディレクトリの tmp/ に作られる
+    monkeypatch.chdir(tmp_path)
+    return VideoProcessingServer(cache_dir=str(tmp_path / "cache"))
+
+@pytest.fixture
+def cached_input(server, tmp_path):
+    path = tmp_path / "input.mp4"
+    path.write_bytes(INPUT)
+    server.result_cache.put(input_key(CONTENT_HASH), str(path))
+    return str(path)
+
+def check_content(server, content_hash=CONTENT_HASH, payload_size=len(INPUT)) -> dict:
+    return server._content_status_response(MMPMessage({
+        "operation": TransferOperation.CHECK_CONTENT.value, "content_hash": content_hash,
+        "payload_size": payload_size, "process_type": "compress"}, "json")).json_data
+
+def skipped_upload(challenge: dict, data: bytes = INPUT) -> MMPMessage:
+    # クライアントがアップロードを省略して送るリクエスト
+    data = data[challenge['offset']:challenge['offset'] + challenge['length']]
+    return MMPMessage({"process_type": "compress", "content_hash": CONTENT_HASH,
+                       "content_proof": {"nonce": challenge['nonce'],
+                                         "digest": content_proof(challenge['nonce'], data)}}, "mp4")
+
+def test_only_held_inputs_get_a_challenge(server, cached_input):
+    assert "challenge" not in check_content(server, content_hash="0" * 64)
+    assert "challenge" not in check_content(server, payload_size=len(INPUT) + 1)
+    status = check_content(server)
+    assert status["input_available"]
+    assert 0 < status["challenge"]["length"] <= len(INPUT)
+
+def test_skipped_upload_needs_the_data_in_the_challenged_range(server, cached_input):
+    assert server._verify_content_proof(skipped_upload(check_content(server)["challenge"]))
+    # ハッシュ値を知っているだけのクライアントは範囲のデータを持っていない
+    assert not server._verify_content_proof(skipped_upload(check_content(server)["challenge"], data=bytes(len(INPUT))))
+    assert not server._verify_content_proof(
+        MMPMessage({"process_type": "compress", "content_hash": CONTENT_HASH}, "mp4"))
+
+def test_challenges_are_single_use(server, cached_input):
+    message = skipped_upload(check_content(server)["challenge"])
+    assert server._verify_content_proof(message)
+    assert not server._verify_content_proof(message)
+
+def test_unverified_hash_does_not_give_access_to_the_cached_input(server, cached_input):
+    message = MMPMessage({"process_type": "compress", "content_hash": CONTENT_HASH,
+                          "content_proof": {"nonce": "guess", "digest": "guess"}}, "mp4")
+    # ハッシュ値を入力のハッシュとして扱わないため、キャッシュの入力・処理結果を使わない
+    assert server._result_cache_key("compress", message) is None
+    assert server._write_input_file(message) is None
+
+    message = skipped_upload(check_content(server)["challenge"])
+    message.payload_hash = CONTENT_HASH  # 受信時に確認できた場合
+    with open(server._write_input_file(message), 'rb') as f:
+        assert f.read() == INPUT
+
+def test_the_proof_is_not_part_of_the_cache_key():
+    params = {"width": 640, "height": 360}
+    assert normalize_params({**params, "content_proof": {"nonce": "a", "digest": "b"}}) == normalize_params(params)
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(INPUT)
+    return str(path)
+
+def test_ffmpeg_runs_with_the_job_thread_count(server, start_server, fake_ffmpeg, video):
+    client = VideoProcessingClient(port=start_server(server))
+    assert client.compress_video(video)
+    with open(video.replace(".mp4", "_processed.mp4"), 'rb') as f:
+        assert f.read() == b"processed:" + INPUT
+    command = fake_ffmpeg.commands()[0]
+    assert command[command.index('-threads') + 1] == str(server.scheduler.threads_per_job)
+
+def test_full_queue_is_answered_with_429(tmp_path, monkeypatch, start_server, fake_ffmpeg, video):
+    monkeypatch.chdir(tmp_path)
+    server = VideoProcessingServer(cache_dir=str(tmp_path / "cache"), max_workers=1, max_queue_size=1)
+    port = start_server(server)
+    # 唯一のワーカーを止め、待ち行列も埋める
+    started, release = threading.Event(), threading.Event()
+    server.scheduler.submit(lambda threads: started.set() or release.wait(5))
+    assert started.wait(5)
+    server.scheduler.submit(lambda threads: None)
+    try:
+        client = VideoProcessingClient(port=port)
+        response = client._exchange(client._create_request(video, VideoProcessType.COMPRESS), video)
+        assert response.json_data["error_code"] == 429
+        assert fake_ffmpeg.commands() == []
+    finally:
+        release.set()
+    # 空きができれば同じリクエストを処理する
+    assert client.compress_video(video)
+
+def wait_until_finished(client: VideoProcessingClient, job_id: str) -> dict:
+    deadline = time.time() + 10
+    while True:
+        status = client.get_job_status(job_id)
+        if status["job_status"] in ("done", "failed") or time.time() > deadline:
+            return status
+        time.sleep(0.05)
+
+def test_submitted_job_result_is_fetched_on_a_later_connection(server, start_server, fake_ffmpeg, video):
+    client = VideoProcessingClient(port=start_server(server), async_jobs=True)
+    job_id = client.submit_job(video, VideoProcessType.COMPRESS)
+    status = wait_until_finished(client, job_id)
+    assert status["job_status"] == "done"
+    # 進捗は FFmpeg の -progress 出力から更新される
+    assert status["progress"]["progress"] == "end"
+
+    assert client.fetch_result(job_id, video)
+    with open(video.replace(".mp4", "_processed.mp4"), 'rb') as f:
+        assert f.read() == b"processed:" + INPUT
+    # 取得が完了した結果はサーバーから削除される
+    assert client.get_job_status(job_id) is None
+
+def test_unfinished_and_failed_jobs_are_not_fetched(server, start_server, fake_ffmpeg, video, monkeypatch):
+    client = VideoProcessingClient(port=start_server(server), async_jobs=True)
+    started, release = threading.Event(), threading.Event()
+    for _ in range(server.scheduler.max_workers):
+        server.scheduler.submit(lambda threads: started.set() or release.wait(5))
+    assert started.wait(5)
+    try:
+        job_id = client.submit_job(video, VideoProcessType.COMPRESS)
+        assert client.get_job_status(job_id)["job_status"] == "queued"
+        response = client._exchange(MMPMessage({"operation": JobOperation.FETCH_RESULT.value, "job_id": job_id},
+                                               "json"))
+        assert response.json_data["error_code"] == 409
+    finally:
+        release.set()
+    assert wait_until_finished(client, job_id)["job_status"] == "done"
+
+    monkeypatch.setenv("FAKE_FFMPEG_FAIL", "1")
+    job_id = client.submit_job(video, VideoProcessType.CREATE_GIF, {"start_time": "00:00:00", "duration": "00:00:01"})
+    assert wait_until_finished(client, job_id)["job_status"] == "failed"
+    assert not client.fetch_result(job_id, video)
+    # 失敗したジョブは結果を返した時点で削除される
+    assert client.get_job_status(job_id) is None
+
+def test_progress_frames_reach_the_client(server, start_server, fake_ffmpeg, video):
+    client = VideoProcessingClient(port=start_server(server))
+    progress = []
+    client._print_processing_progress = progress.append
+    assert client.compress_video(video)
+    assert [(frame["frame"], frame["progress"]) for frame in progress] == [(12, "continue"), (24, "end")]
+    assert progress[0]["status"] == "progress"
+
+def test_second_request_for_the_same_file_skips_the_upload(server, start_server, fake_ffmpeg, video):
+    client = VideoProcessingClient(port=start_server(server))
+    uploads = []
+    client._print_upload_progress = lambda sent, total: uploads.append(sent)
+    assert client.compress_video(video)
+    assert uploads[-1] == len(INPUT)
+
+    uploads.clear()
+    assert client.extract_audio(video)
+    # サーバーが保持している入力で処理する
+    assert uploads == []
+    with open(video.replace(".mp4", "_processed.mp3"), 'rb') as f:
+        assert f.read() == b"processed:" + INPUT
+
+def test_pipeline_request_returns_every_output(server, start_server, fake_ffmpeg, video):
+    client = VideoProcessingClient(port=start_server(server))
+    assert client.process_pipeline(video, [(VideoProcessType.COMPRESS, None), (VideoProcessType.EXTRACT_AUDIO, None)])
+    for output in ["_processed_1.mp4", "_processed_2.mp3"]:
+        with open(video.replace(".mp4", output), 'rb') as f:
+            assert f.read() == b"processed:" + INPUT
+    # 1回の FFmpeg の実行で全ての出力を作る
+    assert len(fake_ffmpeg.commands()) == 1
+
+def test_requested_profile_is_capped_by_the_server(tmp_path, monkeypatch, start_server, fake_ffmpeg, video):
+    monkeypatch.chdir(tmp_path)
+    server = VideoProcessingServer(cache_dir=str(tmp_path / "cache"), default_profile="fast", max_profile="balanced")
+    client = VideoProcessingClient(port=start_server(server), profile="archive")
+    assert client.compress_video(video)
+    client.profile = None
+    assert client.resize_resolution(video, 640, 360)
+    archive, default = fake_ffmpeg.commands()
+    assert archive[archive.index('-preset') + 1] == "medium"
+    assert default[default.index('-preset') + 1] == "veryfast"
+
+def test_unknown_profile_is_answered_with_400(server):
+    error = server._operation_error({"process_type": "compress", "profile": "placebo"})
+    assert error.json_data["error_code"] == 400
+    # 音声抽出はプロファイルによらず同じ結果になる
+    params = {"process_type": "extract_audio", "profile": "fast"}
+    assert server._operation_error(params) is None and "profile" not in params
+
+def test_requests_are_traced_and_counted(tmp_path, monkeypatch, start_server, fake_ffmpeg, video):
+    monkeypatch.chdir(tmp_path)
+    server = VideoProcessingServer(cache_dir=str(tmp_path / "cache"), trace_log=str(tmp_path / "trace.jsonl"))
+    client = VideoProcessingClient(port=start_server(server), dedup=False, resumable=False)
+    assert client.compress_video(video)
+    # トレースはレスポンスを送った後、接続を閉じる時に書き出される
+    deadline = time.time() + 5
+    while not (tmp_path / "trace.jsonl").exists() and time.time() < deadline:
+        time.sleep(0.01)
+
+    trace = json.loads((tmp_path / "trace.jsonl").read_text().splitlines()[-1])
+    assert trace["request"] == "compress" and trace["status"] == "ok"
+    assert {"receive", "save_temp_file", "ffmpeg", "send"} <= set(trace["phases"])
+    assert (trace["bytes_received"], trace["bytes_sent"]) == (len(INPUT), len(b"processed:" + INPUT))
+
+    stats = server._stats_response(MMPMessage({"operation": "stats"}, "json")).json_data
+    assert stats["requests"] == {"ok": 1} and stats["queue_depth"] == 0
+    text = server._stats_response(MMPMessage({"operation": "stats", "format": "prometheus"}, "json")).payload
+    assert b'mmp_requests_total{status="ok"} 1\n' in text
+
+@pytest.mark.parametrize("resumable", [True, False])
+def test_inputs_over_the_storage_limit_are_answered_with_507(tmp_path, monkeypatch, start_server, fake_ffmpeg,
+                                                             video, resumable):
+    monkeypatch.chdir(tmp_path)
+    # 一時ファイルに使えるのは 1.5 倍 (キャッシュの分を除く) で、入力と出力の 2 倍に足りない
+    server = VideoProcessingServer(cache_dir=str(tmp_path / "cache"), max_storage=2 * len(INPUT))
+    client = VideoProcessingClient(port=start_server(server), dedup=False, resumable=resumable)
+    response = client._exchange(client._create_request(video, VideoProcessType.COMPRESS), video)
+    assert response.json_data["error_code"] == 507
+    assert fake_ffmpeg.commands() == []
+    assert server.storage.reserved() == 0
+
+def test_workspace_is_released_after_the_request(server, start_server, fake_ffmpeg, video):
+    client = VideoProcessingClient(port=start_server(server))
+    assert client.compress_video(video)
+    deadline = time.time() + 5
+    # ワークスペースは接続を閉じた後に解放される
+    while os.listdir(server.storage.workspace_root) and time.time() < deadline:
+        time.sleep(0.01)
+    assert server.storage.reserved() == 0
+    assert os.listdir(server.storage.workspace_root) == []
@@ -0,0 +1,38 @@
+import pytest
+
+from benchmarks import server_suite
+from benchmarks.server_suite import (LocalServer, OPERATION_PARAMS, bench_concurrency, bench_mmp_codec,
+                                     bench_mmp_socket, bench_operations, bench_upload, summarize)
+
+def test_summarize_reports_percentiles():
+    stats = summarize([float(value) for value in range(100, 0, -1)])
+    assert stats == {"runs": 100, "min": 1.0, "median": 50.5, "p95": 96.0, "max": 100.0}
+    assert summarize([0.5]) == {"runs": 1, "min": 0.5, "median": 0.5, "p95": 0.5, "max": 0.5}
+
+def test_mmp_benchmarks_report_throughput():
+    assert bench_mmp_codec(100)["packets_per_second"] > 0
+    result = bench_mmp_socket(100, 1, 64 * 1024)
+    assert result["target_packets_per_second"] == server_suite.TARGET_PACKETS_PER_SECOND
+    assert result["meets_target"] == (result["packets_per_second"] >= server_suite.TARGET_PACKETS_PER_SECOND)
+    assert result["large_payload_mb_per_second"] > 0
+
+@pytest.mark.parametrize("mode", ["threaded", "async"])
+def test_server_sections_run_against_a_local_server(tmp_path, fake_ffmpeg, mode):
+    # サーバーは別プロセスで起動し、PATH の FFmpeg (fake_ffmpeg) を使う
+    server = LocalServer(str(tmp_path), mode, workers=2)
+    try:
+        server.wait_ready()
+        upload = bench_upload(server.port, str(tmp_path), 1, 2, 64 * 1024)
+        assert upload["seconds"]["runs"] == 2 and upload["mb_per_second"] > 0
+
+        input_file = tmp_path / "input.mp4"
+        input_file.write_bytes(b"video")
+        operations = bench_operations(server.port, str(input_file), str(tmp_path), 1, 64 * 1024)
+        assert set(operations) == set(OPERATION_PARAMS)
+
+        levels = bench_concurrency(server.port, str(input_file), str(tmp_path), [1, 2], 2, "compress", 64 * 1024)
+        assert [(level["clients"], level["completed"], level["errors"]) for level in levels] == [(1, 2, {}), (2, 4, {})]
+    finally:
+        server.stop()
+    # 受信したレスポンスのファイルは削除される
+    assert sorted(path.name for path in tmp_path.iterdir() if path.is_file()) == ["ffmpeg.log", "input.mp4", "server.log"]
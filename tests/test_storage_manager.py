@@ -0,0 +1,68 @@
+import contextvars
+import os
+import time
+
+import pytest
+
+from storage_manager import StorageManager, StorageQuotaError, workspace_dir
+
+@pytest.fixture
+def manager(tmp_path):
+    return StorageManager(str(tmp_path / "tmp"), max_storage=1000, instance="test", min_free_space=0)
+
+def reserve(manager: StorageManager, size: int):
+    # reserve は現在のコンテキストのワークスペースを設定するため、テストごとのコンテキストで呼ぶ
+    return contextvars.copy_context().run(manager.reserve, size)
+
+def test_reservations_are_limited_by_the_quota(manager):
+    first = reserve(manager, 600)
+    assert manager.reserved() == 600
+    with pytest.raises(StorageQuotaError, match="quota"):
+        reserve(manager, 500)
+    with pytest.raises(StorageQuotaError):
+        manager.check(500)
+    first.release()
+    assert manager.reserved() == 0
+    manager.check(1000)
+
+def test_reservation_fails_without_free_disk_space(tmp_path):
+    manager = StorageManager(str(tmp_path / "tmp"), max_storage=1000, min_free_space=10 ** 18)
+    with pytest.raises(StorageQuotaError, match="disk space"):
+        manager.check(1)
+
+def test_reservation_covers_the_input_and_each_output():
+    assert StorageManager.reservation_size(100) == 200
+    assert StorageManager.reservation_size(100, outputs=3) == 400
+
+def test_workspace_becomes_the_temp_directory_of_the_request(manager, tmp_path):
+    def run():
+        workspace = manager.reserve(10)
+        return workspace, workspace_dir("default")
+    workspace, directory = contextvars.copy_context().run(run)
+    assert directory == workspace.path and os.path.isdir(workspace.path)
+    assert workspace_dir("default") == "default"
+
+def test_held_workspace_is_removed_by_the_last_release(manager):
+    workspace = reserve(manager, 100)
+    workspace.hold()
+    workspace.release()
+    assert os.path.isdir(workspace.path) and manager.reserved() == 100
+    workspace.release()
+    assert not os.path.exists(workspace.path) and manager.reserved() == 0
+
+def test_collect_orphans_keeps_active_workspaces_and_uploads(manager, tmp_path):
+    active = reserve(manager, 100)
+    orphan = os.path.join(manager.workspace_root, "crashed")
+    os.makedirs(orphan)
+    temp_dir = tmp_path / "tmp"
+    (temp_dir / "uploads").mkdir()
+    old_file, new_file = temp_dir / "temp_old.mp4", temp_dir / "temp_new.mp4"
+    old_file.write_bytes(b"old")
+    new_file.write_bytes(b"new")
+    old = time.time() - 3600
+    os.utime(old_file, (old, old))
+
+    assert manager.collect_orphans() == [str(old_file)]
+    # 起動時は前回の実行のワークスペースを古さによらず削除する
+    assert manager.collect_orphans(startup=True) == [orphan]
+    assert os.path.isdir(active.path) and (temp_dir / "uploads").is_dir() and new_file.exists()
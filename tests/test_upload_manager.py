@@ -0,0 +1,135 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import upload_manager
+from mmp_protocol import MMPMessage, ChecksumError, recv_exact, HEADER_SIZE, FLAG_CHECKSUM, PAYLOAD_BLOCK_SIZE
+from upload_manager import UploadManager, UploadError
+
+PAYLOAD = os.urandom(4 * PAYLOAD_BLOCK_SIZE + 1000)
+CONTENT_HASH = hashlib.sha256(PAYLOAD).hexdigest()
+
+@pytest.fixture
+def manager(tmp_path):
+    return UploadManager(str(tmp_path / "uploads"))
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "input.mp4"
+    path.write_bytes(PAYLOAD)
+    return str(path)
+
+def send(sock: socket.socket, message: MMPMessage, wire: bytes = None):
+    # wire を指定した場合は、メッセージの代わりにそのバイト列 (途中で切れた・壊れたデータ) を送る
+    try:
+        if wire is None:
+            message.encode_to_socket(sock)
+        else:
+            sock.sendall(wire)
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        # 受信側が壊れたブロックで受信をやめた
+        pass
+
+def receive(manager: UploadManager, upload_id: str, message: MMPMessage, wire: bytes = None):
+    # クライアントが送る MMP メッセージを、サーバーと同じ手順で途中のアップロードに追記する
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        thread = threading.Thread(target=send, args=(sender, message, wire))
+        thread.start()
+        try:
+            received, _ = MMPMessage.decode_body_from_socket(receiver, recv_exact(receiver, HEADER_SIZE))
+            offset = received.json_data['upload_offset']
+            part_path = manager.begin_receive(upload_id, offset, received.payload_size)
+            try:
+                received.read_payload_from_socket(receiver, part_path, payload_offset=offset)
+            finally:
+                manager.end_receive(upload_id)
+        finally:
+            receiver.shutdown(socket.SHUT_RDWR)
+            thread.join()
+
+def upload_message(source: str, upload_id: str, offset: int, flags: int = 0) -> MMPMessage:
+    message = MMPMessage.from_file({"upload_id": upload_id, "upload_offset": offset}, "mp4", source,
+                                   payload_offset=offset)
+    message.flags = flags
+    return message
+
+def test_create_returns_the_pending_upload_for_the_same_content(manager):
+    meta = manager.create(CONTENT_HASH, len(PAYLOAD), "mp4")
+    assert manager.create(CONTENT_HASH, len(PAYLOAD), "mp4")['upload_id'] == meta['upload_id']
+    assert manager.create("other", len(PAYLOAD), "mp4")['upload_id'] != meta['upload_id']
+    assert manager.committed_offset(meta['upload_id']) == 0
+
+def test_interrupted_upload_resumes_from_the_committed_offset(manager, source, tmp_path):
+    upload_id = manager.create(CONTENT_HASH, len(PAYLOAD), "mp4")['upload_id']
+    # 1回目の接続は途中で切れる
+    message = upload_message(source, upload_id, 0)
+    header_bytes, body_bytes, payload = message.encode()
+    with pytest.raises(ConnectionError):
+        receive(manager, upload_id, message, header_bytes + body_bytes + payload[:100000])
+    assert manager.committed_offset(upload_id) == 100000
+
+    receive(manager, upload_id, upload_message(source, upload_id, manager.committed_offset(upload_id)))
+    destination = str(tmp_path / "complete.mp4")
+    assert manager.finalize(upload_id, destination)['media_type'] == "mp4"
+    with open(destination, 'rb') as f:
+        assert f.read() == PAYLOAD
+    assert manager.get(upload_id) is None
+
+def test_corrupt_block_keeps_the_verified_blocks(manager, source, tmp_path):
+    upload_id = manager.create(CONTENT_HASH, len(PAYLOAD), "mp4")['upload_id']
+    message = upload_message(source, upload_id, 0, FLAG_CHECKSUM)
+    header_bytes, body_bytes, payload = message.encode()
+    payload = bytearray(payload)
+    # 3番目のブロックを壊すと、その手前の2ブロックまでが受信済みになる
+    payload[2 * (PAYLOAD_BLOCK_SIZE + 8) + 100] ^= 0xFF
+    with pytest.raises(ChecksumError):
+        receive(manager, upload_id, message, header_bytes + body_bytes + bytes(payload))
+    offset = manager.committed_offset(upload_id)
+    assert offset == 2 * PAYLOAD_BLOCK_SIZE
+
+    receive(manager, upload_id, upload_message(source, upload_id, offset, FLAG_CHECKSUM))
+    manager.finalize(upload_id, str(tmp_path / "complete.mp4"))
+
+def test_finalize_rejects_incomplete_and_mismatched_uploads(manager, tmp_path):
+    payload = b"not the announced content"
+    upload_id = manager.create(CONTENT_HASH, len(payload), "mp4")['upload_id']
+    with pytest.raises(UploadError, match="incomplete"):
+        manager.finalize(upload_id, str(tmp_path / "out.mp4"))
+    with open(manager._part_path(upload_id), 'wb') as f:
+        f.write(payload)
+    with pytest.raises(UploadError, match="does not match"):
+        manager.finalize(upload_id, str(tmp_path / "out.mp4"))
+    # 一致しなかったデータは削除し、最初からアップロードし直させる
+    assert manager.get(upload_id) is None
+    assert not os.path.exists(tmp_path / "out.mp4")
+
+def test_begin_receive_validates_the_upload_and_offset(manager, monkeypatch):
+    with pytest.raises(UploadError):
+        manager.begin_receive("../../etc/passwd", 0, 0)
+    upload_id = manager.create(CONTENT_HASH, len(PAYLOAD), "mp4")['upload_id']
+    with pytest.raises(UploadError, match="beyond"):
+        manager.begin_receive(upload_id, 10, 0)
+    # 宣言したサイズを超える送信は、ペイロードを受信する前に拒否する
+    with pytest.raises(UploadError, match="exceed"):
+        manager.begin_receive(upload_id, 0, len(PAYLOAD) + 1)
+    # 同じアップロードを2つの接続で同時に受信しない
+    monkeypatch.setattr(upload_manager, "ACTIVE_UPLOAD_WAIT", 0.1)
+    manager.begin_receive(upload_id, 0, len(PAYLOAD))
+    with pytest.raises(UploadError, match="another connection"):
+        manager.begin_receive(upload_id, 0, len(PAYLOAD))
+    manager.end_receive(upload_id)
+
+def test_expire_removes_stale_uploads(tmp_path):
+    manager = UploadManager(str(tmp_path / "uploads"), upload_ttl=60)
+    upload_id = manager.create(CONTENT_HASH, len(PAYLOAD), "mp4")['upload_id']
+    assert manager.expire() == []
+    old = time.time() - 120
+    os.utime(manager._part_path(upload_id), (old, old))
+    assert manager.expire() == [upload_id]
+    assert os.listdir(tmp_path / "uploads") == []
@@ -0,0 +1,161 @@
+import os
+
+import pytest
+
+from media_probe import MediaInfo
+from video_processor import (ENCODER_PROFILES, FFmpegProgressParser, VideoProcessor, _parse_progress_block,
+                             segment_boundaries)
+
+@pytest.fixture
+def processor(tmp_path):
+    return VideoProcessor(temp_dir=str(tmp_path / "tmp"))
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(b"video")
+    return str(path)
+
+def test_progress_parser_reports_one_block_per_progress_line():
+    blocks = []
+    parser = FFmpegProgressParser(blocks.append)
+    for line in ["frame=48\n", "fps=23.5\n", "out_time_us=2000000\n", "out_time=00:00:02.000000\n",
+                 "speed= 1.5x\n", "progress=continue\n", "frame=96\n", "progress=end\n"]:
+        parser.feed(line)
+    assert blocks[0] == {"frame": 48, "fps": 23.5, "out_time": "00:00:02.000000", "speed": "1.5x",
+                         "progress": "continue", "out_time_seconds": 2.0}
+    # 各ブロックは前のブロックの値を引き継がない
+    assert blocks[1]["frame"] == 96 and "out_time_seconds" not in blocks[1]
+    assert blocks[1]["progress"] == "end"
+
+def test_progress_block_tolerates_missing_values():
+    # 出力の先頭では時刻が N/A、frame や fps が空のことがある
+    progress = _parse_progress_block({"frame": "", "fps": "", "out_time_us": "N/A", "progress": "continue"})
+    assert progress == {"frame": 0, "fps": 0.0, "out_time": "00:00:00", "speed": "N/A", "progress": "continue"}
+    assert _parse_progress_block({"out_time_ms": "1500000"})["out_time_seconds"] == 1.5
+
+def test_progress_parser_ignores_lines_without_a_value():
+    blocks = []
+    parser = FFmpegProgressParser(blocks.append)
+    parser.feed("\n")
+    parser.feed("Press [q] to stop\n")
+    assert blocks == []
+
+def test_ffmpeg_runs_with_progress_output(processor, fake_ffmpeg, video):
+    blocks = []
+    success, message, output_file = processor.process("compress", video, {}, 2, blocks.append)
+    assert (success, message) == (True, "Success")
+    assert [block["frame"] for block in blocks] == [12, 24]
+    assert fake_ffmpeg.commands()[0][:4] == ['-nostats', '-progress', 'pipe:1', '-i']
+    with open(output_file, 'rb') as f:
+        assert f.read() == b"processed:video"
+
+def test_ffmpeg_failure_returns_the_end_of_stderr(processor, fake_ffmpeg, video, monkeypatch):
+    monkeypatch.setenv("FAKE_FFMPEG_FAIL", "1")
+    success, message, output_file = processor.process("compress", video, {})
+    assert not success and output_file is None
+    assert "Invalid data found when processing input" in message
+
+def probed(processor, monkeypatch, **video):
+    # ffprobe の代わりに、640x360 の H.264 で音声のない入力として扱う
+    info = MediaInfo({"format": {"duration": "30"},
+                      "streams": [{"codec_type": "video", "codec_name": "h264", "width": 640, "height": 360, **video}]})
+    monkeypatch.setattr(processor.probe_cache, "get", lambda input_file: info)
+
+def test_pipeline_decodes_the_input_once_for_all_outputs(processor, video):
+    command, output_files = processor.build_pipeline_command(video, [
+        {"process_type": "compress"},
+        {"process_type": "extract_audio"},
+        {"process_type": "create_gif", "start_time": "00:00:05", "duration": "00:00:02"},
+    ], threads=2)
+    assert command[:3] == ['ffmpeg', '-i', video] and command.count('-i') == 1
+    assert [output_file.split('.')[-1] for output_file in output_files] == ["mp4", "mp3", "gif"]
+    # 出力は各処理のオプションの後に順に並ぶ
+    positions = [command.index(output_file) for output_file in output_files]
+    assert positions == sorted(positions) and positions[-1] == len(command) - 1
+    # 入力を共有するため、GIF の開始位置は -i の後に指定する
+    assert command.index('-ss') > positions[1]
+
+def test_pipeline_uses_stream_copy_and_rejects_invalid_operations(processor, video, monkeypatch):
+    probed(processor, monkeypatch)
+    command, _ = processor.build_pipeline_command(video, [
+        {"process_type": "resize_resolution", "width": 640, "height": 360},
+        {"process_type": "compress"},
+    ])
+    assert command[3:5] == ['-c:v', 'copy']
+    with pytest.raises(ValueError, match="no audio"):
+        processor.build_pipeline_command(video, [{"process_type": "compress"}, {"process_type": "extract_audio"}])
+
+def test_pipeline_runs_one_ffmpeg_process(processor, fake_ffmpeg, video):
+    success, _, output_files = processor.process_pipeline(video, [{"process_type": "compress"},
+                                                                  {"process_type": "extract_audio"}])
+    assert success and len(fake_ffmpeg.commands()) == 1
+    for output_file in output_files:
+        with open(output_file, 'rb') as f:
+            assert f.read() == b"processed:video"
+
+def test_pipeline_failure_removes_partial_outputs(processor, video, monkeypatch):
+    def fail_midway(command, progress_callback=None):
+        # 最初の出力だけ書き込んだ後に失敗する
+        with open(command[-1], 'wb') as f:
+            f.write(b"partial")
+        return False, "FFmpeg error: disk full"
+    monkeypatch.setattr(processor, "_run_ffmpeg_command", fail_midway)
+    success, message, output_files = processor.process_pipeline(
+        video, [{"process_type": "compress"}, {"process_type": "extract_audio"}])
+    assert (success, message, output_files) == (False, "FFmpeg error: disk full", [])
+    assert os.listdir(processor.temp_dir) == []
+
+def test_segment_boundaries_snap_to_keyframes():
+    keyframes = [0.0, 4.0, 9.5, 14.0, 21.0, 28.0]
+    assert segment_boundaries(keyframes, 30.0, 3) == [9.5, 21.0]
+    # 前の区切りや動画の末尾から MIN_SEGMENT_SECONDS 未満の区切りは使わない
+    assert segment_boundaries([0.0, 1.0, 29.0], 30.0, 4) == []
+    assert segment_boundaries([0.0, 10.0], 30.0, 4) == [10.0]
+
+def test_segments_are_encoded_in_parallel_and_concatenated_in_order(processor, fake_ffmpeg, video, monkeypatch):
+    probed(processor, monkeypatch)
+    monkeypatch.setattr(processor.probe_cache, "keyframes", lambda input_file: [0.0, 10.0, 20.0])
+    progress = []
+    success, _, output_file = processor.process("compress", video, {"parallel_segments": 3}, 3, progress.append)
+    assert success
+
+    split, *encodes, concat = fake_ffmpeg.commands()
+    assert split[split.index('-segment_times') + 1] == "9.999000,19.999000"
+    assert len(encodes) == 3
+    # 各区間は割り当てられたスレッドを分け合う
+    assert all(command[command.index('-threads') + 1] == "1" for command in encodes)
+    encoded = {os.path.basename(command[command.index('-i') + 1]): command[-1] for command in encodes}
+    # 結合の入力リストは区間の順に並び、音声は元の入力から1回だけエンコードする
+    with open(output_file) as f:
+        assert f.read() == "processed:" + "".join(
+            f"file '{os.path.abspath(encoded[name])}'\n" for name in sorted(encoded))
+    assert concat[concat.index('-i', concat.index('-i') + 1) + 1] == video
+    assert concat[concat.index('-c:a') + 1] == "aac"
+
+    assert progress[-1]["segments"] == progress[-1]["segments_done"] == 3
+    assert progress[-1]["frame"] == 72 and progress[-1]["progress"] == "end"
+    # 区間のファイルとエンコード済みの区間は削除する
+    assert os.listdir(processor.temp_dir) == [os.path.basename(output_file)]
+
+def test_short_inputs_are_encoded_without_segments(processor, fake_ffmpeg, video, monkeypatch):
+    probed(processor, monkeypatch)
+    monkeypatch.setattr(processor.probe_cache, "keyframes", lambda input_file: [0.0])
+    success, _, _ = processor.process("compress", video, {"parallel_segments": 3}, 3)
+    assert success and len(fake_ffmpeg.commands()) == 1
+
+@pytest.mark.parametrize("process_type, params", [
+    ("compress", {}),
+    ("create_webm", {"start_time": "00:00:00", "duration": "00:00:05"}),
+    ("create_gif", {"start_time": "00:00:00", "duration": "00:00:05"}),
+])
+def test_every_profile_builds_a_different_command(processor, video, process_type, params):
+    commands = [processor.build_command(process_type, video, {**params, "profile": profile})[0][:-1]
+                for profile in ENCODER_PROFILES]
+    assert len({tuple(command) for command in commands}) == len(ENCODER_PROFILES)
+    # 既定は balanced
+    assert processor.build_command(process_type, video, params)[0][:-1] == commands[ENCODER_PROFILES.index("balanced")]
+
+def test_unknown_profile_is_rejected(processor, video):
+    with pytest.raises(ValueError, match="Invalid profile"):
+        processor.build_command("compress", video, {"profile": "placebo"})
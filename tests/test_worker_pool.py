@@ -0,0 +1,123 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from mmp_protocol import MMPMessage, HEADER_SIZE, recv_exact
+from worker_pool import WorkerPool, WorkerError, WorkerBusyError, MMPWorkerTransport
+
+class FakeProcessor:
+    # VideoProcessor の代わりに、同時に実行された処理の数を記録する
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def _generate_temp_filename(self, media_type):
+        return f"output.{media_type}"
+
+    def process(self, process_type, input_file, params, threads=None, progress_callback=None):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            self.threads.append(threads)
+        time.sleep(0.05)
+        with self._lock:
+            self.active -= 1
+        return True, "Success", "local.mp4"
+
+class FakeTransport:
+    def __init__(self, errors):
+        self.errors = errors  # ワーカーID -> 送出する例外
+        self.calls = []
+
+    def run(self, worker, process_type, input_file, params, threads=None, progress_callback=None):
+        self.calls.append(worker.worker_id)
+        if worker.worker_id in self.errors:
+            raise self.errors[worker.worker_id]
+        return True, "Success", f"{worker.worker_id}.mp4"
+
+def test_local_fallback_is_limited_to_the_local_workers():
+    processor = FakeProcessor()
+    pool = WorkerPool(processor, transport=FakeTransport({}), local_workers=2)
+    threads = [threading.Thread(target=pool.process, args=("compress", "input.mp4", {}, 1)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert processor.peak == 2
+    # コーディネーターの処理枠のスレッド数ではなく、ローカルの CPU 予算のスレッド数を使う
+    assert set(processor.threads) == {pool.local_threads}
+
+def test_failed_workers_are_skipped_and_marked_unhealthy():
+    transport = FakeTransport({"a:1": OSError("connection refused"), "b:1": WorkerBusyError("queue full")})
+    pool = WorkerPool(FakeProcessor(), transport=transport, local_fallback=False)
+    for host in ["a", "b", "c"]:
+        pool.register(host, 1, capacity=1)
+    results = [pool.process("compress", "input.mp4", {"report_progress": True}) for _ in range(2)]
+    assert results[1] == (True, "Success", "c:1.mp4")
+    workers = {worker["worker_id"]: worker for worker in pool.workers()}
+    assert not workers["a:1"]["healthy"] and workers["a:1"]["failures"] == 1
+    # 待ち行列が満杯のワーカーは正常なまま
+    assert workers["b:1"]["healthy"]
+    assert all(worker["active_jobs"] == 0 for worker in workers.values())
+
+def test_no_worker_without_local_fallback_reports_the_last_error():
+    pool = WorkerPool(FakeProcessor(), transport=FakeTransport({"a:1": WorkerError("500 Internal")}),
+                      local_fallback=False)
+    assert pool.process("compress", "input.mp4", {}) == (False, "No worker is available", None)
+    pool.register("a", 1, capacity=1)
+    success, msg, _ = pool.process("compress", "input.mp4", {})
+    assert not success and "500 Internal" in msg
+
+@pytest.mark.parametrize("local_workers", [1, 3])
+def test_local_workers_can_be_configured(local_workers):
+    assert WorkerPool(FakeProcessor(), local_workers=local_workers).local_workers == local_workers
+
+def fake_worker(listener: socket.socket, progress_frames: int, interval: float, respond: bool = True):
+    # リクエストを受信した後、interval 秒ごとに進捗を送り、最後に処理結果を返すワーカーノード
+    conn, _ = listener.accept()
+    with conn:
+        request = MMPMessage.decode_from_socket(conn, recv_exact(conn, HEADER_SIZE))
+        assert request.json_data['report_progress']
+        for frame in range(progress_frames):
+            time.sleep(interval)
+            MMPMessage({"status": "progress", "frame": frame}, "json").encode_to_socket(conn)
+        if respond:
+            MMPMessage({"status": "success"}, "mp4", b"output").encode_to_socket(conn)
+        # 応答しないワーカーは、コーディネーターが接続を閉じるまで何も送らない
+        conn.recv(1)
+
+@pytest.fixture
+def worker_listener():
+    listener = socket.create_server(("127.0.0.1", 0))
+    yield listener
+    listener.close()
+
+def register_fake_worker(tmp_path, listener, **behaviour) -> WorkerPool:
+    transport = MMPWorkerTransport(lambda media_type: str(tmp_path / f"output.{media_type}"), idle_timeout=0.5)
+    pool = WorkerPool(FakeProcessor(), transport=transport)
+    host, port = listener.getsockname()
+    pool.register(host, port, capacity=1)
+    threading.Thread(target=fake_worker, args=(listener,), kwargs=behaviour, daemon=True).start()
+    (tmp_path / "input.mp4").write_bytes(b"video")
+    return pool
+
+def test_progress_frames_keep_a_long_job_on_the_worker(tmp_path, worker_listener):
+    # 処理全体はアイドルタイムアウトより長いが、進捗が届いている間は待つ
+    pool = register_fake_worker(tmp_path, worker_listener, progress_frames=5, interval=0.2)
+    result = pool.process("compress", str(tmp_path / "input.mp4"), {})
+    assert result == (True, "Success", str(tmp_path / "output.mp4"))
+    assert pool.workers()[0]["healthy"]
+
+def test_worker_that_stops_responding_fails_over(tmp_path, worker_listener):
+    pool = register_fake_worker(tmp_path, worker_listener, progress_frames=1, interval=0.1, respond=False)
+    started = time.time()
+    result = pool.process("compress", str(tmp_path / "input.mp4"), {})
+    # アイドルタイムアウトで失敗したワーカーとして扱い、コーディネーター自身で処理し直す
+    assert result == (True, "Success", "local.mp4")
+    assert time.time() - started < 5
+    worker = pool.workers()[0]
+    assert not worker["healthy"] and worker["failures"] == 1 and worker["active_jobs"] == 0
@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from mmp_protocol import hash_file
+
+DEFAULT_UPLOAD_TTL = 24 * 60 * 60  # 再開されない途中のアップロードは1日で削除
+# 再接続時、切断された前の接続の受信処理が終わるまで待つ時間 (秒)
+ACTIVE_UPLOAD_WAIT = 30
+
+class UploadError(Exception):
+    pass
+
+class UploadManager:
+    def __init__(self, upload_dir: str, upload_ttl: float = DEFAULT_UPLOAD_TTL):
+        self.upload_dir = upload_dir
+        self.upload_ttl = upload_ttl
+        self._lock = threading.Condition()
+        self._active: set = set()  # 現在受信中のアップロードID
+        if not os.path.exists(upload_dir):
+            os.makedirs(upload_dir)
+
+    def _part_path(self, upload_id: str) -> str:
+        return os.path.join(self.upload_dir, f'{upload_id}.part')
+
+    def _meta_path(self, upload_id: str) -> str:
+        return os.path.join(self.upload_dir, f'{upload_id}.json')
+
+    def _load_meta(self, upload_id: str) -> Optional[Dict]:
+        # アップロードIDはファイル名に使うため、16進数以外は受け付けない
+        if not upload_id or not all(c in '0123456789abcdef' for c in upload_id):
+            return None
+        try:
+            with open(self._meta_path(upload_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def create(self, content_hash: str, payload_size: int, media_type: str) -> Dict:
+        with self._lock:
+            # 同じ内容の途中のアップロードがあれば、クライアントが再起動していても再開できるようにする
+            for name in os.listdir(self.upload_dir):
+                if name.endswith('.json'):
+                    meta = self._load_meta(name[:-len('.json')])
+                    if meta and meta['content_hash'] == content_hash and meta['payload_size'] == payload_size:
+                        return meta
+
+            meta = {
+                "upload_id": uuid.uuid4().hex,
+                "content_hash": content_hash,
+                "payload_size": payload_size,
+                "media_type": media_type,
+            }
+            open(self._part_path(meta['upload_id']), 'wb').close()
+            with open(self._meta_path(meta['upload_id']), 'w') as f:
+                json.dump(meta, f)
+            return meta
+
+    def get(self, upload_id: str) -> Optional[Dict]:
+        return self._load_meta(upload_id)
+
+    def wait_idle(self, upload_id: str, timeout: float = ACTIVE_UPLOAD_WAIT) -> bool:
+        # 前の接続がまだ受信中であれば、切断が検出されて書き込みが終わるまで待つ
+        with self._lock:
+            return self._lock.wait_for(lambda: upload_id not in self._active, timeout)
+
+    def committed_offset(self, upload_id: str) -> int:
+        # 途中で接続が切れても、ファイルに書き込まれた分までは受信済みとして扱う
+        try:
+            return os.path.getsize(self._part_path(upload_id))
+        except OSError:
+            return 0
+
+    def begin_receive(self, upload_id: str, offset: int, size: int) -> str:
+        meta = self._load_meta(upload_id)
+        if not meta:
+            raise UploadError(f"Unknown upload: {upload_id}")
+        with self._lock:
+            if not self._lock.wait_for(lambda: upload_id not in self._active, ACTIVE_UPLOAD_WAIT):
+                raise UploadError("This upload is already being received on another connection")
+            committed = self.committed_offset(upload_id)
+            if offset > committed:
+                raise UploadError(f"Offset {offset} is beyond the committed offset {committed}")
+            if offset + size > meta['payload_size']:
+                # 宣言したサイズを超えて書き込むと、二度と完了・再開できなくなる
+                raise UploadError(f"{size} bytes from offset {offset} exceed the upload size {meta['payload_size']}")
+            self._active.add(upload_id)
+        return self._part_path(upload_id)
+
+    def end_receive(self, upload_id: str):
+        with self._lock:
+            self._active.discard(upload_id)
+            self._lock.notify_all()
+
+    def finalize(self, upload_id: str, dest_path: str) -> Dict:
+        # 全データが揃ったらハッシュ値を検証し、処理用のパスへ移動する
+        meta = self._load_meta(upload_id)
+        if not meta:
+            raise UploadError(f"Unknown upload: {upload_id}")
+        part_path = self._part_path(upload_id)
+        committed = self.committed_offset(upload_id)
+        if committed != meta['payload_size']:
+            raise UploadError(f"Upload incomplete: {committed} of {meta['payload_size']} bytes")
+        if hash_file(part_path) != meta['content_hash']:
+            self.remove(upload_id)
+            raise UploadError("Uploaded data does not match the content hash")
+        os.replace(part_path, dest_path)
+        self.remove(upload_id)
+        return meta
+
+    def remove(self, upload_id: str):
+        for path in [self._part_path(upload_id), self._meta_path(upload_id)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def expire(self) -> List[str]:
+        # 最後の書き込みから upload_ttl を過ぎた途中のアップロードを削除する
+        now = time.time()
+        expired = []
+        with self._lock:
+            for name in os.listdir(self.upload_dir):
+                if not name.endswith('.json'):
+                    continue
+                upload_id = name[:-len('.json')]
+                if upload_id in self._active:
+                    continue
+                part_path = self._part_path(upload_id)
+                path = part_path if os.path.exists(part_path) else self._meta_path(upload_id)
+                if now - os.path.getmtime(path) > self.upload_ttl:
+                    self.remove(upload_id)
+                    expired.append(upload_id)
+        return expired
@@ -1,103 +1,707 @@
+import asyncio
+import contextvars
 import os
+import shutil
+import struct
 import subprocess
-from typing import Tuple, Optional
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Tuple, Optional, Dict, Any, List, Callable, Iterable
 import json
+import uuid
 from datetime import datetime
+from mmp_protocol import VideoProcessType
+from media_probe import MediaInfo, MediaProbeCache, input_error, probe_duration
+from storage_manager import workspace_dir
+
+# FFmpeg の -progress 出力を解析した進捗情報を受け取るコールバック
+FFmpegProgressCallback = Callable[[Dict[str, Any]], None]
+
+STDERR_TAIL_LINES = 50  # エラー表示用に保持する FFmpeg の標準エラー出力の行数
+
+PIPE_CHUNK_SIZE = 64 * 1024  # パイプ処理で FFmpeg の標準出力から一度に読み取るサイズ
+PIPE_PROBE_SIZE = 64 * 1024  # パイプ処理できる入力かを判定するために先読みするサイズ
+
+# 分割エンコード (parallel_segments) の設定
+MAX_PARALLEL_SEGMENTS = 16
+MIN_SEGMENT_SECONDS = 2.0  # これより短い区間には分割しない
+SEGMENTED_PROCESS_TYPES = [VideoProcessType.COMPRESS.value, VideoProcessType.RESIZE_RESOLUTION.value]
+
+# 音声のエンコード設定 (分割エンコードでは結合時に元の音声に対して1回だけ適用する)
+COMPRESS_AUDIO_OPTIONS = ['-c:a', 'aac', '-b:a', '128k']
+COPY_AUDIO_OPTIONS = ['-c:a', 'copy']
+
+# 音声抽出の出力形式
+EXTRACT_AUDIO_SAMPLE_RATE = 44100
+EXTRACT_AUDIO_CHANNELS = 2
+EXTRACT_AUDIO_BIT_RATE = 192000
+
+# エンコードのプロファイル (速い順)。リクエストの "profile" で指定する
+ENCODER_PROFILES = ['fast', 'balanced', 'archive']
+DEFAULT_PROFILE = 'balanced'
+DEFAULT_MAX_PROFILE = 'balanced'  # サーバーが許可する最も遅いプロファイルの既定値
+
+# libx264: 画質 (CRF) は同じまま、プリセットで速度と圧縮率のバランスを変える
+X264_PROFILE_OPTIONS = {
+    'fast': ['-preset', 'veryfast', '-crf', '23'],
+    'balanced': ['-preset', 'medium', '-crf', '23'],
+    'archive': ['-preset', 'slower', '-crf', '23'],
+}
+# libvpx-vp9: -deadline/-cpu-used を指定しないと非常に遅い設定でエンコードされる。
+# -row-mt 1 で行単位のマルチスレッドを有効にし、割り当てたスレッドを使い切れるようにする
+VP9_PROFILE_OPTIONS = {
+    'fast': ['-deadline', 'realtime', '-cpu-used', '8', '-row-mt', '1', '-tile-columns', '2'],
+    'balanced': ['-deadline', 'good', '-cpu-used', '4', '-row-mt', '1', '-tile-columns', '2'],
+    'archive': ['-deadline', 'good', '-cpu-used', '1', '-row-mt', '1'],
+}
+# GIF: archive では動画ごとに最適化したパレットを作る
+GIF_PROFILE_FILTERS = {
+    'fast': 'fps=10,scale=320:-1:flags=bilinear',
+    'balanced': 'fps=10,scale=320:-1:flags=lanczos',
+    'archive': 'fps=10,scale=320:-1:flags=lanczos,split[a][b];[a]palettegen[p];[b][p]paletteuse',
+}
+
+# 再エンコードせずに MP4 にコピーできる映像コーデック
+MP4_COPY_VIDEO_CODECS = ['h264', 'hevc', 'mpeg4', 'av1']
+
+# パイプに出力する場合の形式。MP4 は出力先をシークできないため fragmented MP4 として書き出す
+PIPE_OUTPUT_FORMATS = {
+    'mp4': ['-f', 'mp4', '-movflags', 'frag_keyframe+empty_moov+default_base_moof'],
+    'mp3': ['-f', 'mp3'],
+    'gif': ['-f', 'gif'],
+    'webm': ['-f', 'webm'],
+}
+
+def _parse_progress_block(values: Dict[str, str]) -> Dict[str, Any]:
+    # -progress の key=value 出力 (progress=continue/end で区切られる1ブロック) を整形する
+    progress = {
+        "frame": int(values.get('frame', 0) or 0),
+        "fps": float(values.get('fps', 0) or 0),
+        "out_time": values.get('out_time', '00:00:00'),
+        "speed": values.get('speed', 'N/A').strip(),
+        "progress": values.get('progress', 'continue'),
+    }
+    out_time_us = values.get('out_time_us', values.get('out_time_ms'))
+    if out_time_us and out_time_us != 'N/A':
+        progress["out_time_seconds"] = int(out_time_us) / 1_000_000
+    return progress
+
+def segment_boundaries(keyframes: List[float], duration: float, segments: int) -> List[float]:
+    # 均等に分割した位置に最も近いキーフレームを区切りにする (GOP 単位で分割する)
+    boundaries: List[float] = []
+    for i in range(1, segments):
+        target = duration * i / segments
+        nearest = min(keyframes, key=lambda t: abs(t - target))
+        previous = boundaries[-1] if boundaries else 0.0
+        if nearest - previous >= MIN_SEGMENT_SECONDS and duration - nearest >= MIN_SEGMENT_SECONDS:
+            boundaries.append(nearest)
+    return boundaries
+
+def input_requires_seeking(head: bytes, media_type: str) -> bool:
+    # MP4/MOV は moov アトムが mdat より後ろにあると、先頭から順に読むだけではデコードできない
+    if media_type.lower() not in ['mp4', 'mov', 'm4v']:
+        return False
+    offset = 0
+    while offset + 8 <= len(head):
+        size, atom = struct.unpack('!I4s', head[offset:offset + 8])
+        if atom == b'moov':
+            return False
+        if atom == b'mdat':
+            return True
+        if size == 1 and offset + 16 <= len(head):
+            size = struct.unpack('!Q', head[offset + 8:offset + 16])[0]
+        if size < 8:
+            break
+        offset += size
+    # 先読みした範囲で moov が見つからなければ一時ファイルに保存して処理する
+    return True
+
+class FFmpegProgressParser:
+    def __init__(self, callback: Optional[FFmpegProgressCallback]):
+        self.callback = callback
+        self._values: Dict[str, str] = {}
+
+    def feed(self, line: str):
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            return
+        self._values[key] = value
+        if key == 'progress':
+            if self.callback:
+                self.callback(_parse_progress_block(self._values))
+            self._values = {}
+
+class _SegmentProgress:
+    # 並列にエンコードしている各区間の進捗をまとめ、動画全体の進捗として通知する
+    def __init__(self, segments: int, callback: Optional[FFmpegProgressCallback]):
+        self.callback = callback
+        self._progress: List[Dict[str, Any]] = [{} for _ in range(segments)]
+        self._lock = threading.Lock()
+
+    def callback_for(self, index: int) -> Optional[FFmpegProgressCallback]:
+        if not self.callback:
+            return None
+        return lambda progress: self._update(index, progress)
+
+    def _update(self, index: int, progress: Dict[str, Any]):
+        with self._lock:
+            self._progress[index] = progress
+            out_time_seconds = sum(p.get('out_time_seconds', 0) for p in self._progress)
+            combined = {
+                "frame": sum(p.get('frame', 0) for p in self._progress),
+                "fps": round(sum(p.get('fps', 0) for p in self._progress), 2),
+                "out_time": f"{int(out_time_seconds // 3600):02d}:{int(out_time_seconds % 3600 // 60):02d}:{out_time_seconds % 60:09.6f}",
+                "out_time_seconds": out_time_seconds,
+                "speed": "N/A",
+                "progress": "end" if all(p.get('progress') == 'end' for p in self._progress) else "continue",
+                "segments": len(self._progress),
+                "segments_done": sum(1 for p in self._progress if p.get('progress') == 'end'),
+            }
+            self.callback(combined)
 
 class VideoProcessor:
-    def __init__(self, temp_dir: str = "tmp"):
+    def __init__(self, temp_dir: str = "tmp", metrics=None):
         self.temp_dir = temp_dir
+        self.probe_cache = MediaProbeCache()
+        self.metrics = metrics  # FFmpeg の実行時間を記録する (metrics.Metrics)
         if not os.path.exists(temp_dir):
             os.makedirs(temp_dir)
 
     def _generate_temp_filename(self, extension: str) -> str:
+        # 同じ秒に複数の出力を作る場合 (パイプライン処理など) も衝突しないようにする。
+        # 処理中のリクエストのワークスペースがあればその中に作る
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        return os.path.join(self.temp_dir, f'temp_{timestamp}.{extension}')
+        return os.path.join(workspace_dir(self.temp_dir), f'temp_{timestamp}_{uuid.uuid4().hex[:8]}.{extension}')
+
+    def _thread_options(self, threads: Optional[int]) -> List[str]:
+        # ワーカープールから割り当てられたスレッド数に FFmpeg を制限する
+        return ['-threads', str(threads)] if threads else []
+
+    def build_command(self, process_type: str, input_file: str, params: Dict[str, Any],
+                      threads: Optional[int] = None, input_seek: bool = True) -> Tuple[List[str], str]:
+        # 処理タイプに応じた FFmpeg コマンドと出力ファイルのパスを返す。
+        # input_seek が False の場合、GIF/WEBM の開始位置は -i の後に指定する (入力を共有するパイプライン処理用)
+        profile = params.get('profile') or DEFAULT_PROFILE
+        if profile not in ENCODER_PROFILES:
+            raise ValueError(f"Invalid profile: {profile}")
+        if process_type == VideoProcessType.COMPRESS.value:
+            return self._compress_command(input_file, threads, profile)
+        elif process_type == VideoProcessType.RESIZE_RESOLUTION.value:
+            width = params.get('width', 1920)
+            height = params.get('height', 1080)
+            return self._resize_command(input_file, width, height, threads, profile)
+        elif process_type == VideoProcessType.CHANGE_ASPECT_RATIO.value:
+            aspect_ratio = params.get('aspect_ratio', '16:9')
+            return self._aspect_ratio_command(input_file, aspect_ratio, threads, profile)
+        elif process_type == VideoProcessType.EXTRACT_AUDIO.value:
+            return self._extract_audio_command(input_file, threads)
+        elif process_type in [VideoProcessType.CREATE_GIF.value, VideoProcessType.CREATE_WEBM.value]:
+            start_time = params.get('start_time', '00:00:00')
+            duration = params.get('duration', '00:00:10')
+            if process_type == VideoProcessType.CREATE_GIF.value:
+                return self._gif_command(input_file, start_time, duration, threads, input_seek, profile)
+            return self._webm_command(input_file, start_time, duration, threads, input_seek, profile)
+        raise ValueError(f"Invalid process type: {process_type}")
+
+    def build_pipeline_command(self, input_file: str, operations: List[Dict[str, Any]],
+                               threads: Optional[int] = None) -> Tuple[List[str], List[str]]:
+        # 複数の処理を出力が複数ある1つの FFmpeg コマンドにまとめる。
+        # FFmpeg は入力ストリームを1回だけデコードし、各出力のフィルタ・エンコーダに分配する
+        command = ['ffmpeg', '-i', input_file]
+        output_files = []
+        info = self.probe_cache.get(input_file)
+        for operation in operations:
+            process_type = operation['process_type']
+            fast_path = None
+            if info:
+                self._check_input(process_type, operation, info)
+                fast_path = self._stream_copy_command(process_type, input_file, operation, info)
+            operation_command, output_file = fast_path or self.build_command(
+                process_type, input_file, operation, threads, input_seek=False)
+            # 各処理のコマンドは ['ffmpeg', '-i', input_file, ...出力オプション, output_file] の形
+            command.extend(operation_command[3:])
+            output_files.append(output_file)
+        return command, output_files
+
+    def build_pipe_command(self, process_type: str, params: Dict[str, Any],
+                           threads: Optional[int] = None) -> Tuple[List[str], str]:
+        # 標準入力から読み、標準出力に書き出すコマンドと出力のメディアタイプを返す
+        command, output_file = self.build_command(process_type, 'pipe:0', params, threads)
+        media_type = output_file.split('.')[-1]
+        # -flush_packets 0 で出力をバッファし、細かすぎるチャンクの送信を避ける
+        return ([command[0], '-nostats', *command[1:-1], '-flush_packets', '0', *PIPE_OUTPUT_FORMATS[media_type], 'pipe:1'],
+                media_type)
+
+    def process(self, process_type: str, input_file: str, params: Dict[str, Any],
+                threads: Optional[int] = None,
+                progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        try:
+            prepared = self._prepare_command(process_type, input_file, params, threads)
+        except ValueError as e:
+            return False, str(e), None
+        if not prepared:
+            return self.process_segmented(process_type, input_file, params, threads, progress_callback)
+        return self._execute(*prepared, progress_callback)
+
+    async def process_async(self, process_type: str, input_file: str, params: Dict[str, Any],
+                            threads: Optional[int] = None,
+                            progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        # asyncio サーバー用。FFmpeg は asyncio.create_subprocess_exec で起動する
+        loop = asyncio.get_event_loop()
+        try:
+            # ffprobe の実行はスレッドプールで行う。一時ファイルの置き場所などはリクエストのコンテキストから引き継ぐ
+            prepared = await loop.run_in_executor(None, partial(
+                contextvars.copy_context().run, self._prepare_command, process_type, input_file, params, threads))
+        except ValueError as e:
+            return False, str(e), None
+        if not prepared:
+            # 分割エンコードは複数の FFmpeg を管理するため、スレッドプールで実行する
+            callback = None
+            if progress_callback:
+                callback = lambda progress: loop.call_soon_threadsafe(progress_callback, progress)
+            return await loop.run_in_executor(None, partial(
+                contextvars.copy_context().run, self.process_segmented, process_type, input_file, params, threads,
+                callback))
+        command, output_file = prepared
+        success, message = await self._run_ffmpeg_command_async(command, progress_callback)
+        return success, message, output_file if success else None
+
+    def _prepare_command(self, process_type: str, input_file: str, params: Dict[str, Any],
+                         threads: Optional[int] = None) -> Optional[Tuple[List[str], str]]:
+        # 入力の情報からコマンドを選ぶ。分割エンコードする場合は None を返す。
+        # 入力に対して実行できない処理は FFmpeg を起動せずに ValueError にする
+        info = self.probe_cache.get(input_file)
+        if info:
+            self._check_input(process_type, params, info)
+            fast_path = self._stream_copy_command(process_type, input_file, params, info)
+            if fast_path:
+                return fast_path
+        if self._use_segments(process_type, params):
+            return None
+        return self.build_command(process_type, input_file, params, threads)
+
+    def _check_input(self, process_type: str, params: Dict[str, Any], info: MediaInfo):
+        error = input_error(process_type, params, info)
+        if error:
+            raise ValueError(error)
+
+    def check_input(self, process_type: str, input_file: str, params: Dict[str, Any]) -> Optional[str]:
+        # サーバーがジョブを待ち行列に入れる前に確認する。問題がなければ None
+        info = self.probe_cache.get(input_file)
+        return input_error(process_type, params, info) if info else None
+
+    def _stream_copy_command(self, process_type: str, input_file: str, params: Dict[str, Any],
+                             info: MediaInfo) -> Optional[Tuple[List[str], str]]:
+        # 再エンコードしても入力と同じ内容にしかならない処理はストリームコピーで済ませる
+        if process_type == VideoProcessType.RESIZE_RESOLUTION.value:
+            try:
+                size = (int(params.get('width', 1920)), int(params.get('height', 1080)))
+            except (TypeError, ValueError):
+                return None
+            # 回転情報のある動画はスケール後の向きが変わるため対象外
+            if size != (info.width, info.height) or info.rotation or info.video_codec not in MP4_COPY_VIDEO_CODECS:
+                return None
+            output_file = self._generate_temp_filename('mp4')
+            return ['ffmpeg', '-i', input_file, '-c:v', 'copy', *COPY_AUDIO_OPTIONS, '-sn', '-dn', output_file], output_file
+        if process_type == VideoProcessType.EXTRACT_AUDIO.value:
+            # 既に出力形式と同じ MP3 で、ビットレートも指定以下であればそのまま取り出す
+            if (info.audio_codec != 'mp3' or info.sample_rate != EXTRACT_AUDIO_SAMPLE_RATE
+                    or info.channels != EXTRACT_AUDIO_CHANNELS
+                    or not info.audio_bit_rate or info.audio_bit_rate > EXTRACT_AUDIO_BIT_RATE):
+                return None
+            output_file = self._generate_temp_filename('mp3')
+            return ['ffmpeg', '-i', input_file, '-vn', *COPY_AUDIO_OPTIONS, output_file], output_file
+        return None
+
+    def _use_segments(self, process_type: str, params: Dict[str, Any]) -> bool:
+        return process_type in SEGMENTED_PROCESS_TYPES and int(params.get('parallel_segments') or 0) > 1
+
+    def process_segmented(self, process_type: str, input_file: str, params: Dict[str, Any],
+                          threads: Optional[int] = None,
+                          progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        # 入力をキーフレーム位置でストリームコピーにより分割し、各区間を並列にエンコードしてから結合する。
+        # 音声は区間の境界でずれないよう、結合時に元の入力から1回だけ処理する
+        segments = min(int(params['parallel_segments']), MAX_PARALLEL_SEGMENTS)
+        info = self.probe_cache.get(input_file)
+        try:
+            duration = info.duration if info and info.duration else probe_duration(input_file)
+            boundaries = segment_boundaries(self.probe_cache.keyframes(input_file), duration, segments)
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            boundaries = []
+            print(f"Could not probe {input_file}, encoding without segments: {e}")
+        if not boundaries:
+            # 短い動画やキーフレームが少ない動画は通常どおり1つのプロセスでエンコードする
+            params = {k: v for k, v in params.items() if k != 'parallel_segments'}
+            return self.process(process_type, input_file, params, threads, progress_callback)
+
+        work_dir = os.path.join(workspace_dir(self.temp_dir), f'segments_{uuid.uuid4().hex}')
+        os.makedirs(work_dir)
+        encoded_files: List[str] = []
+        try:
+            split_command = [
+                'ffmpeg', '-i', input_file,
+                '-map', '0:v:0', '-c', 'copy',
+                '-f', 'segment', '-reset_timestamps', '1',
+                # 指定時刻以降の最初のキーフレームで区切られるため、わずかに手前を指定する
+                '-segment_times', ','.join(f'{max(0.0, t - 0.001):.6f}' for t in boundaries),
+                os.path.join(work_dir, 'segment_%03d.mkv')
+            ]
+            success, message = self._run_ffmpeg_command(split_command)
+            if not success:
+                return False, message, None
+            segment_files = sorted(os.path.join(work_dir, name) for name in os.listdir(work_dir))
+
+            # ジョブに割り当てられたスレッド数の範囲で区間を同時にエンコードする
+            concurrency = max(1, min(len(segment_files), threads or os.cpu_count() or 1))
+            segment_threads = max(1, (threads or os.cpu_count() or 1) // concurrency)
+            commands = []
+            for segment_file in segment_files:
+                command, output_file = self.build_command(process_type, segment_file, params, segment_threads)
+                commands.append(command)
+                encoded_files.append(output_file)
+
+            progress = _SegmentProgress(len(commands), progress_callback)
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                results = list(executor.map(
+                    lambda item: self._run_ffmpeg_command(item[1], progress.callback_for(item[0])),
+                    enumerate(commands)))
+            for success, message in results:
+                if not success:
+                    return False, message, None
+
+            list_file = os.path.join(work_dir, 'segments.txt')
+            with open(list_file, 'w') as f:
+                for encoded_file in encoded_files:
+                    f.write(f"file '{os.path.abspath(encoded_file)}'\n")
+            output_file = self._generate_temp_filename('mp4')
+            audio_options = COMPRESS_AUDIO_OPTIONS if process_type == VideoProcessType.COMPRESS.value else COPY_AUDIO_OPTIONS
+            concat_command = [
+                'ffmpeg', '-f', 'concat', '-safe', '0', '-i', list_file,
+                '-i', input_file,
+                '-map', '0:v:0', '-map', '1:a?',
+                '-c:v', 'copy', *audio_options,
+                *self._thread_options(threads),
+                output_file
+            ]
+            success, message = self._run_ffmpeg_command(concat_command)
+            if not success:
+                self.cleanup_temp_file(output_file)
+                return False, message, None
+            return True, "Success", output_file
+        finally:
+            for encoded_file in encoded_files:
+                self.cleanup_temp_file(encoded_file)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def process_pipeline(self, input_file: str, operations: List[Dict[str, Any]], threads: Optional[int] = None,
+                         progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, List[str]]:
+        try:
+            command, output_files = self.build_pipeline_command(input_file, operations, threads)
+        except ValueError as e:
+            return False, str(e), []
+        success, message = self._run_ffmpeg_command(command, progress_callback)
+        return self._pipeline_result(success, message, output_files)
+
+    async def process_pipeline_async(self, input_file: str, operations: List[Dict[str, Any]],
+                                     threads: Optional[int] = None,
+                                     progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, List[str]]:
+        try:
+            command, output_files = self.build_pipeline_command(input_file, operations, threads)
+        except ValueError as e:
+            return False, str(e), []
+        success, message = await self._run_ffmpeg_command_async(command, progress_callback)
+        return self._pipeline_result(success, message, output_files)
+
+    def _pipeline_result(self, success: bool, message: str, output_files: List[str]) -> Tuple[bool, str, List[str]]:
+        if success:
+            return success, message, output_files
+        # 失敗した場合は途中まで書き込まれた出力を残さない
+        for output_file in output_files:
+            self.cleanup_temp_file(output_file)
+        return success, message, []
+
+    def _execute(self, command: List[str], output_file: str,
+                 progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        success, message = self._run_ffmpeg_command(command, progress_callback)
+        return success, message, output_file if success else None
+
+    def _progress_command(self, command: List[str]) -> List[str]:
+        # -progress pipe:1 で進捗を key=value 形式で標準出力に書き出させる
+        return [command[0], '-nostats', '-progress', 'pipe:1', *command[1:]]
+
+    def _observe_ffmpeg(self, start: float):
+        if self.metrics:
+            self.metrics.observe('ffmpeg', time.perf_counter() - start)
+
+    def _run_ffmpeg_command(self, command: list,
+                            progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str]:
+        start = time.perf_counter()
+        try:
+            return self._run_ffmpeg_process(command, progress_callback)
+        finally:
+            self._observe_ffmpeg(start)
+
+    def _run_ffmpeg_process(self, command: list,
+                            progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str]:
+        # -progress pipe:1 の出力を逐次読み取り、標準エラー出力は末尾のみ保持する
+        try:
+            process = subprocess.Popen(self._progress_command(command), stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, text=True)
+        except Exception as e:
+            return False, str(e)
+
+        stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        stderr_thread = threading.Thread(target=lambda: stderr_tail.extend(process.stderr), daemon=True)
+        stderr_thread.start()
+
+        try:
+            parser = FFmpegProgressParser(progress_callback)
+            for line in process.stdout:
+                parser.feed(line)
+            process.wait()
+        except Exception as e:
+            process.kill()
+            process.wait()
+            return False, str(e)
+        finally:
+            stderr_thread.join()
+
+        if process.returncode != 0:
+            return False, f"FFmpeg error: {''.join(stderr_tail)}"
+        return True, "Success"
+
+    def run_pipe_command(self, command: List[str], input_chunks: Iterable[bytes],
+                         output_callback: Callable[[bytes], None]) -> Tuple[bool, str]:
+        # 入力の受信と出力の送信を並行して行うため、その時間も FFmpeg の実行時間に含まれる
+        start = time.perf_counter()
+        try:
+            return self._run_pipe_process(command, input_chunks, output_callback)
+        finally:
+            self._observe_ffmpeg(start)
 
-    def _run_ffmpeg_command(self, command: list) -> Tuple[bool, str]:
+    def _run_pipe_process(self, command: List[str], input_chunks: Iterable[bytes],
+                          output_callback: Callable[[bytes], None]) -> Tuple[bool, str]:
+        # 入力を FFmpeg の標準入力に書き込みながら、標準出力を生成された順に output_callback に渡す
         try:
-            result = subprocess.run(command, capture_output=True, text=True)
-            if result.returncode != 0:
-                return False, f"FFmpeg error: {result.stderr}"
-            return True, "Success"
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
         except Exception as e:
             return False, str(e)
 
-    def compress_video(self, input_file: str) -> Tuple[bool, str, Optional[str]]:
+        stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+        stderr_thread = threading.Thread(
+            target=lambda: stderr_tail.extend(line.decode('utf-8', errors='replace') for line in process.stderr),
+            daemon=True)
+        stderr_thread.start()
+
+        input_errors = []
+
+        def feed_input():
+            writable = True
+            try:
+                for chunk in input_chunks:
+                    if not writable:
+                        continue
+                    try:
+                        process.stdin.write(chunk)
+                    except (BrokenPipeError, ValueError):
+                        # FFmpeg が入力を最後まで読まずに終了した場合 (-t 指定など) も、残りの入力は読み捨てる
+                        writable = False
+            except Exception as e:
+                input_errors.append(e)
+                process.kill()
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        input_thread = threading.Thread(target=feed_input, daemon=True)
+        input_thread.start()
+
+        try:
+            while True:
+                chunk = process.stdout.read1(PIPE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                output_callback(chunk)
+            process.wait()
+        except Exception as e:
+            process.kill()
+            process.wait()
+            return False, str(e)
+        finally:
+            input_thread.join()
+            stderr_thread.join()
+
+        if input_errors:
+            return False, f"Error receiving input: {input_errors[0]}"
+        if process.returncode != 0:
+            return False, f"FFmpeg error: {''.join(stderr_tail)}"
+        return True, "Success"
+
+    async def _run_ffmpeg_command_async(self, command: list,
+                                        progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str]:
+        start = time.perf_counter()
+        try:
+            return await self._run_ffmpeg_process_async(command, progress_callback)
+        finally:
+            self._observe_ffmpeg(start)
+
+    async def _run_ffmpeg_process_async(self, command: list,
+                                        progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str]:
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *self._progress_command(command), stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE, stdin=asyncio.subprocess.DEVNULL)
+        except Exception as e:
+            return False, str(e)
+
+        stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+
+        async def read_stderr():
+            async for line in process.stderr:
+                stderr_tail.append(line.decode('utf-8', errors='replace'))
+
+        stderr_task = asyncio.ensure_future(read_stderr())
+        try:
+            parser = FFmpegProgressParser(progress_callback)
+            async for line in process.stdout:
+                parser.feed(line.decode('utf-8', errors='replace'))
+            await process.wait()
+            await stderr_task
+        except BaseException:
+            # キャンセルされた場合も FFmpeg プロセスを残さない
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            stderr_task.cancel()
+            raise
+
+        if process.returncode != 0:
+            return False, f"FFmpeg error: {''.join(stderr_tail)}"
+        return True, "Success"
+
+    def compress_video(self, input_file: str, threads: Optional[int] = None,
+                       progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        return self._execute(*self._compress_command(input_file, threads), progress_callback)
+
+    def _compress_command(self, input_file: str, threads: Optional[int] = None,
+                          profile: str = DEFAULT_PROFILE) -> Tuple[List[str], str]:
         output_file = self._generate_temp_filename('mp4')
         command = [
             'ffmpeg', '-i', input_file,
-            '-c:v', 'libx264', '-crf', '23',  # 画質と圧縮率のバランス
-            '-c:a', 'aac', '-b:a', '128k',    # 音声圧縮
+            '-c:v', 'libx264', *X264_PROFILE_OPTIONS[profile],  # 画質と圧縮率のバランス
+            *COMPRESS_AUDIO_OPTIONS,                            # 音声圧縮
+            *self._thread_options(threads),
             output_file
         ]
-        success, message = self._run_ffmpeg_command(command)
-        return success, message, output_file if success else None
+        return command, output_file
+
+    def resize_resolution(self, input_file: str, width: int, height: int, threads: Optional[int] = None,
+                          progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        return self._execute(*self._resize_command(input_file, width, height, threads), progress_callback)
 
-    def resize_resolution(self, input_file: str, width: int, height: int) -> Tuple[bool, str, Optional[str]]:
+    def _resize_command(self, input_file: str, width: int, height: int, threads: Optional[int] = None,
+                        profile: str = DEFAULT_PROFILE) -> Tuple[List[str], str]:
         output_file = self._generate_temp_filename('mp4')
         command = [
             'ffmpeg', '-i', input_file,
             '-vf', f'scale={width}:{height}',
-            '-c:a', 'copy',
+            '-c:v', 'libx264', *X264_PROFILE_OPTIONS[profile],
+            *COPY_AUDIO_OPTIONS,
+            *self._thread_options(threads),
             output_file
         ]
-        success, message = self._run_ffmpeg_command(command)
-        return success, message, output_file if success else None
+        return command, output_file
+
+    def change_aspect_ratio(self, input_file: str, aspect_ratio: str, threads: Optional[int] = None,
+                            progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        return self._execute(*self._aspect_ratio_command(input_file, aspect_ratio, threads), progress_callback)
 
-    def change_aspect_ratio(self, input_file: str, aspect_ratio: str) -> Tuple[bool, str, Optional[str]]:
+    def _aspect_ratio_command(self, input_file: str, aspect_ratio: str, threads: Optional[int] = None,
+                              profile: str = DEFAULT_PROFILE) -> Tuple[List[str], str]:
         output_file = self._generate_temp_filename('mp4')
         # アスペクト比を幅と高さに分解（例：16:9）
         width, height = map(int, aspect_ratio.split(':'))
         command = [
             'ffmpeg', '-i', input_file,
             '-vf', f'scale=iw*min({width}/iw\\,{height}/ih):ih*min({width}/iw\\,{height}/ih)',
+            '-c:v', 'libx264', *X264_PROFILE_OPTIONS[profile],
             '-c:a', 'copy',
+            *self._thread_options(threads),
             output_file
         ]
-        success, message = self._run_ffmpeg_command(command)
-        return success, message, output_file if success else None
+        return command, output_file
 
-    def extract_audio(self, input_file: str) -> Tuple[bool, str, Optional[str]]:
+    def extract_audio(self, input_file: str, threads: Optional[int] = None,
+                      progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        return self._execute(*self._extract_audio_command(input_file, threads), progress_callback)
+
+    def _extract_audio_command(self, input_file: str, threads: Optional[int] = None) -> Tuple[List[str], str]:
         output_file = self._generate_temp_filename('mp3')
         command = [
             'ffmpeg', '-i', input_file,
             '-vn',  # 映像を無効化
-            '-ar', '44100',  # サンプリングレート
-            '-ac', '2',      # ステレオ
-            '-b:a', '192k',  # ビットレート
+            '-ar', str(EXTRACT_AUDIO_SAMPLE_RATE),  # サンプリングレート
+            '-ac', str(EXTRACT_AUDIO_CHANNELS),     # ステレオ
+            '-b:a', f'{EXTRACT_AUDIO_BIT_RATE // 1000}k',  # ビットレート
+            *self._thread_options(threads),
             output_file
         ]
-        success, message = self._run_ffmpeg_command(command)
-        return success, message, output_file if success else None
+        return command, output_file
+
+    def _seek_options(self, start_time: str, input_seek: bool) -> Tuple[List[str], List[str]]:
+        # (入力オプション, 出力オプション) を返す。-i の前の -ss は開始位置の直前のキーフレームまでシークするため、
+        # 開始位置より前のフレームを全てデコードせずに済む
+        if input_seek:
+            return ['-ss', start_time], []
+        return [], ['-ss', start_time]
 
-    def create_gif(self, input_file: str, start_time: str, duration: str) -> Tuple[bool, str, Optional[str]]:
+    def create_gif(self, input_file: str, start_time: str, duration: str, threads: Optional[int] = None,
+                   progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        return self._execute(*self._gif_command(input_file, start_time, duration, threads), progress_callback)
+
+    def _gif_command(self, input_file: str, start_time: str, duration: str, threads: Optional[int] = None,
+                     input_seek: bool = True, profile: str = DEFAULT_PROFILE) -> Tuple[List[str], str]:
         output_file = self._generate_temp_filename('gif')
+        input_options, output_options = self._seek_options(start_time, input_seek)
         command = [
-            'ffmpeg', '-i', input_file,
-            '-ss', start_time,
+            'ffmpeg', *input_options, '-i', input_file,
+            *output_options,
             '-t', duration,
-            '-vf', 'fps=10,scale=320:-1:flags=lanczos',
+            '-vf', GIF_PROFILE_FILTERS[profile],
+            *self._thread_options(threads),
             output_file
         ]
-        success, message = self._run_ffmpeg_command(command)
-        return success, message, output_file if success else None
+        return command, output_file
 
-    def create_webm(self, input_file: str, start_time: str, duration: str) -> Tuple[bool, str, Optional[str]]:
+    def create_webm(self, input_file: str, start_time: str, duration: str, threads: Optional[int] = None,
+                    progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        return self._execute(*self._webm_command(input_file, start_time, duration, threads), progress_callback)
+
+    def _webm_command(self, input_file: str, start_time: str, duration: str, threads: Optional[int] = None,
+                      input_seek: bool = True, profile: str = DEFAULT_PROFILE) -> Tuple[List[str], str]:
         output_file = self._generate_temp_filename('webm')
+        input_options, output_options = self._seek_options(start_time, input_seek)
         command = [
-            'ffmpeg', '-i', input_file,
-            '-ss', start_time,
+            'ffmpeg', *input_options, '-i', input_file,
+            *output_options,
             '-t', duration,
             '-c:v', 'libvpx-vp9',
             '-crf', '30',
             '-b:v', '0',
+            *VP9_PROFILE_OPTIONS[profile],
+            *self._thread_options(threads),
             output_file
         ]
-        success, message = self._run_ffmpeg_command(command)
-        return success, message, output_file if success else None
+        return command, output_file
 
     def cleanup_temp_file(self, filepath: str):
+        self.probe_cache.forget_input(filepath)
         try:
             if os.path.exists(filepath):
                 os.remove(filepath)
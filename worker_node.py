@@ -0,0 +1,91 @@
+import argparse
+import socket
+import threading
+import time
+from mmp_protocol import MMPMessage, WorkerOperation, HEADER_SIZE, DEFAULT_CHUNK_SIZE, recv_exact
+from job_scheduler import DEFAULT_MAX_QUEUE_SIZE
+from server import VideoProcessingServer
+from video_processor import ENCODER_PROFILES
+
+DEFAULT_HEARTBEAT_INTERVAL = 10  # コーディネーターに負荷を報告する間隔 (秒)
+
+class WorkerNode(VideoProcessingServer):
+    # コーディネーター (server.py --coordinator) から割り当てられたジョブを処理するノード。
+    # 処理のリクエストは通常のサーバーと同じ MMP メッセージで受け取る
+    def __init__(self, coordinator_host: str, coordinator_port: int, advertise_host: str = None,
+                 heartbeat_interval: float = DEFAULT_HEARTBEAT_INTERVAL, **kwargs):
+        super().__init__(**kwargs)
+        self.coordinator_host = coordinator_host
+        self.coordinator_port = coordinator_port
+        # コーディネーターから接続するアドレス (未指定の場合はコーディネーターが接続元のアドレスを使う)
+        self.advertise_host = advertise_host
+        self.heartbeat_interval = heartbeat_interval
+
+    def _can_process_request(self, client_ip: str) -> bool:
+        # 接続元は全てコーディネーターのため IP ごとの制限は行わない。
+        # 同時実行数はコーディネーターが処理能力 (capacity) に合わせて制御する
+        return True
+
+    def _send_heartbeat(self):
+        message = MMPMessage({
+            "operation": WorkerOperation.REGISTER_WORKER.value,
+            "host": self.advertise_host,
+            "port": self.port,
+            "capacity": self.scheduler.max_workers,
+            "active_jobs": self.scheduler.active_jobs(),
+            "queue_depth": self.scheduler.queue_depth(),
+            **({"worker_secret": self.worker_secret} if self.worker_secret else {}),
+        }, "json")
+        with socket.create_connection((self.coordinator_host, self.coordinator_port), timeout=10) as sock:
+            message.encode_to_socket(sock, chunk_size=self.chunk_size)
+            response = MMPMessage.decode_from_socket(sock, recv_exact(sock, HEADER_SIZE))
+        if "error_code" in response.json_data:
+            print(f"Coordinator rejected registration: {response.json_data.get('description')}")
+
+    def _heartbeat_loop(self):
+        while self.running:
+            try:
+                self._send_heartbeat()
+            except OSError as e:
+                print(f"Could not reach coordinator {self.coordinator_host}:{self.coordinator_port}: {e}")
+            time.sleep(self.heartbeat_interval)
+
+    def _start_background_tasks(self):
+        super()._start_background_tasks()
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Start a video processing worker node')
+    parser.add_argument('--coordinator', required=True, help='Coordinator address (host:port)')
+    parser.add_argument('--host', default='localhost', help='Worker host')
+    parser.add_argument('--port', type=int, default=8001, help='Worker port')
+    parser.add_argument('--advertise-host', help='Address the coordinator should connect to (default: --host)')
+    parser.add_argument('--worker-secret', help="Shared secret matching the coordinator's --worker-secret")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Socket I/O chunk size in bytes')
+    parser.add_argument('--workers', type=int, help='Number of concurrent FFmpeg jobs (default: 60%% of CPUs)')
+    parser.add_argument('--queue-size', type=int, default=DEFAULT_MAX_QUEUE_SIZE, help='Maximum number of queued jobs')
+    parser.add_argument('--cache-dir', help='Directory for cached processing results (default: cache_<port>)')
+    parser.add_argument('--heartbeat-interval', type=float, default=DEFAULT_HEARTBEAT_INTERVAL,
+                        help='Seconds between load reports to the coordinator')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics over HTTP on this port')
+    parser.add_argument('--trace-log', help='Append a JSON trace line per request to this file ("-" for stdout)')
+
+    args = parser.parse_args()
+    coordinator_host, _, coordinator_port = args.coordinator.rpartition(':')
+    # 同じマシンで複数のワーカーを起動できるよう、キャッシュはポートごとに分ける
+    worker = WorkerNode(coordinator_host, int(coordinator_port),
+                        advertise_host=args.advertise_host or args.host,
+                        heartbeat_interval=args.heartbeat_interval,
+                        host=args.host, port=args.port, chunk_size=args.chunk_size,
+                        max_workers=args.workers, max_queue_size=args.queue_size,
+                        cache_dir=args.cache_dir or f'cache_{args.port}',
+                        # プロファイルの上限はコーディネーターで適用済み
+                        max_profile=ENCODER_PROFILES[-1],
+                        metrics_port=args.metrics_port, trace_log=args.trace_log,
+                        worker_secret=args.worker_secret)
+
+    try:
+        worker.start()
+    except KeyboardInterrupt:
+        print("\nShutting down worker...")
+        worker.stop()
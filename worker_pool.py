@@ -0,0 +1,219 @@
+import socket
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from job_scheduler import worker_pool_size
+from mmp_protocol import MMPMessage, HEADER_SIZE, DEFAULT_CHUNK_SIZE, recv_exact
+from result_cache import NON_CACHE_KEY_PARAMS
+from video_processor import VideoProcessor, FFmpegProgressCallback
+
+DEFAULT_WORKER_TIMEOUT = 30  # この時間ハートビートが届かないワーカーにはジョブを割り当てない (秒)
+DEFAULT_MAX_ATTEMPTS = 3  # 1つのジョブを割り当てるワーカーの数 (失敗した場合は別のワーカーで再実行する)
+DISPATCH_WAIT = 60  # 全ワーカーが処理中の場合に空きを待つ時間 (秒)
+CONNECT_TIMEOUT = 10
+# ワーカーから進捗も処理結果も届かない状態がこの時間続いた場合は、応答しなくなったワーカーとして扱う (秒)
+WORKER_IDLE_TIMEOUT = 300
+DEFAULT_DISPATCH_SLOTS = 16  # コーディネーターで同時に割り当て処理を行うジョブ数
+
+class WorkerError(Exception):
+    pass
+
+class WorkerBusyError(WorkerError):
+    # ワーカーの待ち行列が満杯 (ワーカー自体は正常)
+    pass
+
+class RemoteWorker:
+    def __init__(self, host: str, port: int, capacity: int):
+        self.host = host
+        self.port = port
+        self.capacity = capacity  # 同時に処理できるジョブ数
+        self.active_jobs = 0  # このコーディネーターから割り当てて処理中のジョブ数
+        self.reported_load: Dict[str, Any] = {}  # ハートビートで報告された負荷
+        self.last_seen = time.time()
+        self.healthy = True
+        self.failures = 0
+
+    @property
+    def worker_id(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "worker_id": self.worker_id,
+            "capacity": self.capacity,
+            "active_jobs": self.active_jobs,
+            "healthy": self.healthy,
+            "failures": self.failures,
+            "last_seen": round(time.time() - self.last_seen, 1),
+            "load": self.reported_load,
+        }
+
+class MMPWorkerTransport:
+    # 入力ファイルを MMP でワーカーノードに送り、処理結果を受け取る
+    def __init__(self, output_path_factory: Callable[[str], str], chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 idle_timeout: float = WORKER_IDLE_TIMEOUT):
+        self.output_path_factory = output_path_factory  # メディアタイプから出力先のパスを作る
+        self.chunk_size = chunk_size
+        self.idle_timeout = idle_timeout
+
+    def run(self, worker: RemoteWorker, process_type: str, input_file: str, params: Dict[str, Any],
+            threads: Optional[int] = None,
+            progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        # スレッド数はワーカー側のワーカープールが決める。
+        # 進捗は呼び出し元が不要な場合も送らせ、FFmpeg の実行中もワーカーが応答していることを確認する
+        request = MMPMessage.from_file(
+            json_data={"process_type": process_type, **params, "report_progress": True},
+            media_type=input_file.split('.')[-1],
+            payload_path=input_file
+        )
+        with socket.create_connection((worker.host, worker.port), timeout=CONNECT_TIMEOUT) as sock:
+            # タイムアウト (socket.timeout は OSError) の場合は、失敗したワーカーとして別のワーカーで再実行する
+            sock.settimeout(self.idle_timeout)
+            request.encode_to_socket(sock, chunk_size=self.chunk_size)
+            while True:
+                response = MMPMessage.decode_from_socket(
+                    sock, recv_exact(sock, HEADER_SIZE),
+                    payload_path_factory=lambda json_data, media_type: self.output_path_factory(media_type),
+                    chunk_size=self.chunk_size
+                )
+                if response.json_data.get('status') != 'progress':
+                    break
+                if progress_callback:
+                    progress_callback({k: v for k, v in response.json_data.items() if k != 'status'})
+
+        error_code = response.json_data.get('error_code')
+        if error_code == 429:
+            raise WorkerBusyError(response.json_data.get('solution', ''))
+        if error_code == 500 and response.json_data.get('description') == "Processing failed":
+            # FFmpeg の処理自体の失敗は、別のワーカーで再実行しても結果が変わらない
+            return False, response.json_data.get('solution', ''), None
+        if error_code:
+            raise WorkerError(f"{error_code} {response.json_data.get('description')}: {response.json_data.get('solution')}")
+        if not response.payload_path:
+            raise WorkerError("Worker returned no output")
+        return True, "Success", response.payload_path
+
+class LocalWorkerTransport:
+    # リモートのワーカーの代わりに同じプロセス内で処理する。
+    # ワーカーが登録されていない場合の処理や、ネットワークなしでの割り当て・再実行の確認に使う
+    def __init__(self, video_processor: VideoProcessor):
+        self.video_processor = video_processor
+
+    def run(self, worker: Optional[RemoteWorker], process_type: str, input_file: str, params: Dict[str, Any],
+            threads: Optional[int] = None,
+            progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        return self.video_processor.process(process_type, input_file, params, threads, progress_callback)
+
+class WorkerPool:
+    # 登録されたワーカーノードの負荷と状態を管理し、ジョブを割り当てる
+    def __init__(self, video_processor: VideoProcessor, transport=None, local_fallback: bool = True,
+                 worker_timeout: float = DEFAULT_WORKER_TIMEOUT, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 local_workers: Optional[int] = None):
+        self.transport = transport or MMPWorkerTransport(video_processor._generate_temp_filename)
+        # 利用できるワーカーがない場合はコーディネーター自身で処理する
+        self.local_transport = LocalWorkerTransport(video_processor) if local_fallback else None
+        # 割り当て待ちのジョブ数 (DEFAULT_DISPATCH_SLOTS) ではなく、通常のサーバーと同じ CPU 予算の範囲で FFmpeg を実行する
+        self.local_workers, self.local_threads = worker_pool_size(local_workers)
+        self._local_slots = threading.BoundedSemaphore(self.local_workers)
+        self.worker_timeout = worker_timeout
+        self.max_attempts = max_attempts
+        self._workers: Dict[str, RemoteWorker] = {}
+        self._condition = threading.Condition()
+
+    def register(self, host: str, port: int, capacity: int, load: Optional[Dict[str, Any]] = None) -> RemoteWorker:
+        with self._condition:
+            worker = self._workers.get(f"{host}:{port}")
+            if not worker:
+                worker = RemoteWorker(host, port, capacity)
+                self._workers[worker.worker_id] = worker
+                print(f"Worker {worker.worker_id} registered (capacity {capacity})")
+            worker.capacity = max(1, capacity)
+            worker.reported_load = load or {}
+            worker.last_seen = time.time()
+            worker.healthy = True
+            self._condition.notify_all()
+            return worker
+
+    def workers(self) -> List[Dict[str, Any]]:
+        with self._condition:
+            return [worker.to_json() for worker in self._workers.values()]
+
+    def _is_available(self, worker: RemoteWorker, exclude: Set[str]) -> bool:
+        return (worker.healthy and worker.worker_id not in exclude
+                and time.time() - worker.last_seen <= self.worker_timeout)
+
+    def acquire(self, exclude: Set[str], timeout: float = DISPATCH_WAIT) -> Optional[RemoteWorker]:
+        # 負荷 (処理中のジョブ数 / 処理能力) が最も低いワーカーを選ぶ。全て処理中であれば空くまで待つ
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                candidates = [worker for worker in self._workers.values() if self._is_available(worker, exclude)]
+                if not candidates:
+                    return None
+                idle = [worker for worker in candidates if worker.active_jobs < worker.capacity]
+                if idle:
+                    worker = min(idle, key=lambda w: w.active_jobs / w.capacity)
+                    worker.active_jobs += 1
+                    return worker
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def release(self, worker: RemoteWorker, failed: bool = False):
+        with self._condition:
+            worker.active_jobs -= 1
+            if failed:
+                # 次のハートビートが届くまで割り当てない
+                worker.healthy = False
+                worker.failures += 1
+            self._condition.notify_all()
+
+    def process(self, process_type: str, input_file: str, params: Dict[str, Any],
+                threads: Optional[int] = None,
+                progress_callback: Optional[FFmpegProgressCallback] = None) -> Tuple[bool, str, Optional[str]]:
+        # VideoProcessor.process と同じ形で呼び出せるようにする
+        params = {k: v for k, v in params.items() if k not in NON_CACHE_KEY_PARAMS}
+        tried: Set[str] = set()
+        last_error: Optional[Exception] = None
+        for _ in range(self.max_attempts):
+            worker = self.acquire(tried)
+            if not worker:
+                break
+            tried.add(worker.worker_id)
+            try:
+                result = self.transport.run(worker, process_type, input_file, params, threads, progress_callback)
+            except WorkerBusyError as e:
+                self.release(worker)
+                last_error = e
+                continue
+            except (OSError, WorkerError) as e:
+                print(f"Worker {worker.worker_id} failed, retrying on another worker: {e}")
+                self.release(worker, failed=True)
+                last_error = e
+                continue
+            self.release(worker)
+            return result
+
+        if self.local_transport:
+            return self.run_locally(lambda local_threads: self.local_transport.run(
+                None, process_type, input_file, params, local_threads, progress_callback))
+        if last_error:
+            return False, f"No worker could process the job: {last_error}", None
+        return False, "No worker is available", None
+
+    def run_locally(self, func: Callable[[int], Any]) -> Any:
+        # コーディネーター自身で FFmpeg を実行する処理は、空きができるまで待ってから実行する
+        with self._local_slots:
+            return func(self.local_threads)
+
+    def expire(self) -> List[str]:
+        # 長時間ハートビートが届かず、処理中のジョブもないワーカーの登録を削除する
+        now = time.time()
+        with self._condition:
+            expired = [worker_id for worker_id, worker in self._workers.items()
+                       if worker.active_jobs == 0 and now - worker.last_seen > self.worker_timeout * 10]
+            for worker_id in expired:
+                del self._workers[worker_id]
+        return expired